@@ -4,6 +4,8 @@
 
 from multiprocessing import cpu_count
 
+import os
+
 ####################
 # API defaults
 ####################
@@ -34,3 +36,13 @@ proxy_host = 'localhost'
 proxy_port = 9000
 
 HTTP_CHUNK_SIZE = 1024 * 1024 * 1024  # 1 GiB
+
+####################
+# Job daemon
+####################
+
+# The Unix socket `gdc-client serve` listens on, only its owner can connect
+serve_socket = os.path.join(os.path.expanduser('~'), '.gdc-client-serve.sock')
+
+# Where `gdc-client serve --tcp` writes the token its requests need
+serve_token = os.path.join(os.path.expanduser('~'), '.gdc-client-serve.token')
@@ -0,0 +1,99 @@
+###############################################################################
+# File preallocation and page cache hints
+#
+# Files are preallocated with posix_fallocate so that they don't fragment
+# while they grow, and read or written with posix_fadvise hints so that
+# multi-TB transfers don't evict the page cache of co-located jobs.
+#
+# Python 2 has neither call in the os module, so they're taken from libc.
+# Everything here is a no-op where the calls aren't available.
+###############################################################################
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import platform
+
+
+log = logging.getLogger('diskio')
+
+POSIX_FADV_NORMAL = 0
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+# how much is read or written before the pages behind it are dropped
+DROP_INTERVAL = 64 * 1024 * 1024
+
+
+def _load_libc_calls():
+    if platform.system() != 'Linux':
+        return None, None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+    except OSError:
+        return None, None
+
+    calls = []
+    for name in ['posix_fallocate', 'posix_fadvise']:
+        # the 64 bit off_t versions, if this is a 32 bit libc
+        call = getattr(libc, name + '64', None) or getattr(libc, name, None)
+        if call is not None:
+            args = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            call.argtypes = args + [ctypes.c_int] if name == 'posix_fadvise' else args
+            call.restype = ctypes.c_int
+        calls.append(call)
+
+    return calls
+
+
+_fallocate, _fadvise = _load_libc_calls()
+
+
+def preallocate(fd, size):
+    # type: (int, long) -> bool
+    """ Allocate size bytes for the file behind fd up front
+
+    Returns whether the space was allocated. Filesystems that don't
+    support it are left to grow the file as it's written.
+    """
+
+    if not _fallocate or not size:
+        return False
+
+    err = _fallocate(fd, 0, size)
+    if err:
+        log.debug('Unable to preallocate {0} bytes: {1}'.format(
+            size, os.strerror(err)))
+        return False
+
+    return True
+
+
+def advise(fd, offset, length, advice):
+    # type: (int, long, long, int) -> None
+    """ posix_fadvise, length 0 meaning to the end of the file """
+
+    if not _fadvise:
+        return
+
+    err = _fadvise(fd, offset, length, advice)
+    if err:
+        log.debug('posix_fadvise({0}) failed: {1}'.format(
+            advice, os.strerror(err)))
+
+
+def drop_cache(path):
+    # type: (str) -> None
+    """ Drop the cached pages of a file that won't be read again soon """
+
+    if not _fadvise:
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        advise(fd, 0, 0, POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
@@ -0,0 +1,208 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tarfile
+
+
+log = logging.getLogger('gdc-download')
+
+# a kept group is stored as <dir>/group-<hash>/{group.tar, index.json}
+GROUP_PREFIX = 'group-'
+TARFILE_NAME = 'group.tar'
+INDEX_NAME = 'index.json'
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def group_name(file_ids):
+    # type: (List[str]) -> str
+    """ Directory name of a kept group, the same for every retry """
+
+    return GROUP_PREFIX + hashlib.md5(','.join(sorted(file_ids))).hexdigest()[:16]
+
+
+def index_tarfile(tarfile_name):
+    # type: (str) -> Dict[str, Dict]
+    """ Index the members of an uncompressed tarfile by UUID
+
+    The md5sum of every member is calculated on the way, in a single
+    sequential read of the tarfile.
+
+    Returns:
+        dict: {file_id: {name, offset, size, md5sum}}
+    """
+
+    index = dict()
+    with tarfile.open(tarfile_name, 'r:') as t:
+        for m in t:
+            if not m.isfile() or m.name == 'MANIFEST.txt':
+                continue
+
+            md5sum = hashlib.md5()
+            f = t.extractfile(m)
+            for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), ''):
+                md5sum.update(chunk)
+
+            index[m.name.split('/')[0]] = {
+                'name':   m.name,
+                'offset': m.offset_data,
+                'size':   m.size,
+                'md5sum': md5sum.hexdigest(),
+            }
+
+    return index
+
+
+def keep_group(tarfile_name, directory):
+    # type: (str, str) -> Dict[str, Dict]
+    """ Move a downloaded group tarfile into its group directory and write
+    the sidecar index next to it
+
+    Returns:
+        dict: the index of the group, see index_tarfile
+    """
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    path = os.path.join(directory, TARFILE_NAME)
+    shutil.move(tarfile_name, path)
+
+    index = index_tarfile(path)
+    with open(os.path.join(directory, INDEX_NAME), 'w') as f:
+        json.dump({'tarfile': TARFILE_NAME, 'files': index}, f,
+                  indent=2, sort_keys=True)
+
+    log.debug('Kept group of {0} files in {1}'.format(len(index), directory))
+    return index
+
+
+class MemberFile(object):
+    """ Read only file object over one member of a tarfile """
+
+    def __init__(self, path, offset, size):
+        self._file = open(path, 'rb')
+        self.offset = offset
+        self.size = size
+        self.position = 0
+        self._file.seek(offset)
+
+    def read(self, size=-1):
+        remaining = self.size - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+
+        data = self._file.read(size)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+
+        self.position = max(0, min(offset, self.size))
+        self._file.seek(self.offset + self.position)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class GroupArchive(object):
+    """ Random access to the files of a group kept with --keep-groups
+
+    Files are read by seeking into the group tarfile, so that they can be
+    used without creating a directory and file for each one.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        with open(os.path.join(directory, INDEX_NAME), 'r') as f:
+            index = json.load(f)
+
+        self.tarfile_name = os.path.join(directory, index['tarfile'])
+        self.files = index['files']
+
+    def __contains__(self, file_id):
+        return file_id in self.files
+
+    def ids(self):
+        # type: () -> List[str]
+        return self.files.keys()
+
+    def open(self, file_id):
+        # type: (str) -> MemberFile
+        """ Open a file of the group for reading """
+
+        member = self.files[file_id]
+        return MemberFile(self.tarfile_name, member['offset'], member['size'])
+
+    def read(self, file_id):
+        # type: (str) -> str
+        with self.open(file_id) as f:
+            return f.read()
+
+    def extract(self, file_id, directory):
+        # type: (str, str) -> str
+        """ Write a file of the group to <directory>/<uuid>/<file_name>
+
+        Returns the path of the extracted file
+        """
+
+        path = os.path.join(directory, self.files[file_id]['name'])
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with self.open(file_id) as source:
+            with open(path, 'wb') as target:
+                shutil.copyfileobj(source, target, READ_CHUNK_SIZE)
+
+        return path
+
+
+def load_archives(directories):
+    # type: (List[str]) -> Dict[str, GroupArchive]
+    """ Find the kept groups in the given download directories
+
+    Returns:
+        dict: {file_id: GroupArchive holding the file}
+    """
+
+    archives = dict()
+    for d in directories:
+        for index in glob.glob(os.path.join(d, GROUP_PREFIX + '*', INDEX_NAME)):
+            archive = GroupArchive(os.path.dirname(index))
+            for file_id in archive.ids():
+                archives[file_id] = archive
+
+    return archives
+
+
+def open_file(file_id, directories=('.',)):
+    # type: (str, List[str]) -> MemberFile
+    """ Open a downloaded file kept in a group tarfile
+
+    Example:
+        with open_file(file_id, ['/data/gdc']) as f:
+            header = f.read(1024)
+    """
+
+    archives = load_archives(directories)
+    if file_id not in archives:
+        raise KeyError('{0} is not in a kept group'.format(file_id))
+
+    return archives[file_id].open(file_id)
@@ -1,24 +1,155 @@
+from gdc_client import diskio
+from gdc_client.download import archive
+from gdc_client.download.endpoints import is_endpoint_error
+from multiprocessing.pool import ThreadPool
 from parcel import HTTPClient, UDTClient, utils
 from parcel.download_stream import DownloadStream
 from progressbar import Bar, ETA, FileTransferSpeed, Percentage, ProgressBar
+from requests.adapters import HTTPAdapter
 from StringIO import StringIO
 
 import hashlib
 import logging
 import os
+import re
 import requests
+import shutil
 import sys
 import tarfile
+import threading
 import time
 import urlparse
 
 
 log = logging.getLogger('gdc-download')
 
+# size of the writes when streaming a response to disk
+WRITE_CHUNK_SIZE = 1024 * 1024
+
+# plain text formats that shrink several-fold when gzipped in transfer
+COMPRESSIBLE_EXTENSIONS = (
+    '.bed', '.csv', '.fa', '.fasta', '.json', '.maf', '.sam', '.seg',
+    '.tsv', '.txt', '.vcf', '.xml',
+)
+
+# Content-Range: bytes 0-99/1000
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+# seconds between the attempts at a byte range
+RANGE_RETRY_WAIT = 1
+
+# big files are downloaded by parcel's segment processes, or in byte
+# ranges on threads where forking isn't safe
+PROCESSES = 'processes'
+THREADS = 'threads'
+ENGINES = [PROCESSES, THREADS]
+
+
+# download_compressed got a response without gzip content encoding
+NOT_COMPRESSED = 'not compressed'
+
+# tar header block and end of archive padding
+TAR_BLOCK_SIZE = 512
+
+
+class PreallocatingTarFile(tarfile.TarFile):
+    """ TarFile that preallocates the files it extracts """
+
+    def makefile(self, tarinfo, targetpath):
+        source = self.extractfile(tarinfo)
+        try:
+            with open(targetpath, 'wb') as target:
+                diskio.preallocate(target.fileno(), tarinfo.size)
+                shutil.copyfileobj(source, target, WRITE_CHUNK_SIZE)
+        finally:
+            source.close()
+
+
+# sessions reused by every client of a long running process, by pool size
+_shared_sessions = None
+_shared_sessions_lock = threading.Lock()
+
+
+def share_sessions():
+    # type: () -> None
+    """ Have clients reuse sessions, and their open connections, instead of
+    starting cold. Used by gdc-client serve """
+
+    global _shared_sessions
+    with _shared_sessions_lock:
+        if _shared_sessions is None:
+            _shared_sessions = dict()
+
+
+def make_session(pool_size):
+    # type: (int) -> requests.Session
+    """ Session whose connection pool can keep one connection per worker """
+
+    with _shared_sessions_lock:
+        if _shared_sessions is not None and pool_size in _shared_sessions:
+            return _shared_sessions[pool_size]
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        if _shared_sessions is not None:
+            _shared_sessions[pool_size] = session
+
+    return session
+
+
+def is_compressible(file_name):
+    # type: (str) -> bool
+    """ Whether a file is worth gzip transfer, judged by its extension """
+
+    return bool(file_name) and \
+        file_name.lower().endswith(COMPRESSIBLE_EXTENSIONS)
+
+
+def format_range(byte_range):
+    # type: (Tuple[long, long]) -> str
+    """ (0, 99) -> 0-99, (100, None) -> 100-, (None, 500) -> -500 """
+
+    start, end = byte_range
+    return '{0}-{1}'.format(
+        '' if start is None else start,
+        '' if end is None else end)
+
+
 class GDCDownloadMixin(object):
 
     annotation_name = 'annotations.txt'
 
+    # moves completed files out of a staging directory, see migrate.py
+    migrator = None
+
+    # places files on one of several roots, see placement.py
+    placement = None
+
+    # runs --on-complete for each verified file, see hooks.py
+    hooks = None
+
+    # spreads groups and big files across several servers, see endpoints.py
+    endpoints = None
+
+    # times a failed byte range is fetched again
+    range_retries = 0
+
+    # how big and related files are downloaded, see ENGINES
+    engine = PROCESSES
+
+    def _root(self, file_id):
+        # type: (str) -> str
+        """ The directory the <uuid>/ directory of a file is downloaded into """
+
+        # staged files are placed by the migrator
+        if self.placement and not self.migrator:
+            return self.placement.root(file_id, self.index.get_filesize(file_id))
+
+        return self.base_directory
+
     def download_related_files(self, file_id):
         # type: (str) -> None
         """Finds and downloads files related to the primary entity.
@@ -26,7 +157,7 @@ class GDCDownloadMixin(object):
         """
 
         # The primary entity's directory
-        directory = os.path.join(self.base_directory, file_id)
+        directory = os.path.join(self._root(file_id), file_id)
 
         related_files = self.index.get_related_files(file_id)
         if related_files:
@@ -35,7 +166,17 @@ class GDCDownloadMixin(object):
             for related_file in related_files:
 
                 log.debug("related file {0}".format(related_file))
-                related_file_url = urlparse.urljoin(self.data_uri, related_file)
+                endpoint = self.endpoints.choose() if self.endpoints else None
+                related_file_url = urlparse.urljoin(
+                    endpoint.data_uri if endpoint else self.data_uri,
+                    related_file)
+                if self.engine == THREADS:
+                    error = self._download_threads(related_file, directory)
+                    if error:
+                        log.warning('Unable to download related file '
+                                    '{0}: {1}'.format(related_file, error))
+                    continue
+
                 stream = DownloadStream(related_file_url, directory, self.token)
 
                 # TODO: un-set this when parcel is moved to dtt
@@ -49,14 +190,239 @@ class GDCDownloadMixin(object):
         else:
             log.debug("No related files")
 
-    def download_annotations(self, file_id):
-        # type: (str) -> None
-        """Finds and downloads annotations related to the primary entity.
-        :param str file_id: String containing the id of the primary entity
+    def _download_range(self, file_id, directory, byte_range, slices, lock,
+                        covered):
+        # type: (str, str, Tuple[long, long], bool, threading.Lock, List) -> str
+        """ Fetch one byte range and write it where it belongs, retrying
+        it up to range_retries times. The bytes written are added to covered
+
+        Returns an error message, or None if the range was written
         """
 
-        # The primary entity's directory
-        directory = os.path.join(self.base_directory, file_id)
+        for attempt in range(self.range_retries + 1):
+            if attempt:
+                log.warning('Retrying range {0}: {1}'.format(
+                    format_range(byte_range), error))
+                time.sleep(RANGE_RETRY_WAIT)
+
+            try:
+                error = self._write_range(
+                    file_id, directory, byte_range, slices, lock, covered)
+            except Exception as e:
+                error = '{0}: {1}'.format(format_range(byte_range), e)
+
+            if not error:
+                return None
+
+        return error
+
+    def _write_range(self, file_id, directory, byte_range, slices, lock,
+                     covered):
+        # type: (str, str, Tuple[long, long], bool, threading.Lock, List) -> str
+        start_time = time.time()
+        r, endpoint = self._get_data(file_id, {
+            'X-Auth-Token': self.token,
+            'Range': 'bytes={0}'.format(format_range(byte_range)),
+        })
+
+        try:
+            if r.status_code != requests.codes.partial_content:
+                return '[{0}] Range request {1} not served'.format(
+                    r.status_code, format_range(byte_range))
+
+            match = CONTENT_RANGE.match(r.headers.get('content-range', ''))
+            if not match:
+                return 'Invalid Content-Range for {0}'.format(
+                    format_range(byte_range))
+
+            start, end, total = match.groups()
+            start, end = long(start), long(end)
+
+            content_filename = r.headers.get('content-disposition')
+            if content_filename:
+                filename = content_filename.split('=')[1]
+            else:
+                filename = file_id
+
+            # ranges are written into a sparse file of the full size. The
+            # suffix keeps it from passing for a complete download
+            path = os.path.join(directory, '{0}.sparse'.format(filename))
+            if slices:
+                path = os.path.join(
+                    directory, '{0}.{1}-{2}'.format(filename, start, end))
+
+            with lock:
+                if not os.path.isfile(path):
+                    with open(path, 'wb') as f:
+                        if not slices and total != '*':
+                            f.truncate(long(total))
+
+            written = 0
+            with open(path, 'r+b') as f:
+                if not slices:
+                    f.seek(start)
+                try:
+                    for chunk in r.iter_content(WRITE_CHUNK_SIZE):
+                        f.write(chunk)
+                        written += len(chunk)
+                except requests.exceptions.RequestException:
+                    if endpoint:
+                        self.endpoints.failed(endpoint)
+                    raise
+
+                # a retry rewrites the slice from its start
+                if slices:
+                    f.truncate(written)
+
+            if written != end - start + 1:
+                if endpoint:
+                    self.endpoints.failed(endpoint)
+                return 'Range {0} cut short after {1} bytes'.format(
+                    format_range(byte_range), written)
+
+            if endpoint:
+                self.endpoints.succeeded(
+                    endpoint, written, time.time() - start_time)
+
+            log.debug('Wrote bytes {0}-{1} to {2}'.format(start, end, path))
+            with lock:
+                covered.append((start, end,
+                                long(total) if total != '*' else None, path))
+
+        finally:
+            r.close()
+
+    def download_ranges(self, file_id, ranges, slices=False):
+        # type: (str, List[Tuple[long, long]], bool) -> List[str]
+        """ Download byte ranges of a file using HTTP Range requests
+
+        The ranges are fetched concurrently over the pooled session and
+        written at their offsets in a sparse <filename>.sparse file, or to
+        separate <filename>.<start>-<end> slice files. Only a sparse file
+        that turns out to be the whole file is completed.
+
+        :param str file_id: String containing the id of the file
+        :param list ranges: (start, end) tuples, inclusive like HTTP.
+            end None reads to the end of the file, start None reads the
+            last end bytes
+        :param bool slices: Write each range to its own slice file
+        :returns: list of error messages for ranges that failed
+        """
+
+        directory = os.path.join(self._root(file_id), file_id)
+        errors, covered = self._fetch_ranges(file_id, directory, ranges, slices)
+        if not errors and not slices:
+            errors = filter(None, [ self._complete_ranges(file_id, covered) ])
+
+        for e in errors:
+            log.error('{0}: {1}'.format(file_id, e))
+
+        return errors
+
+    def _fetch_ranges(self, file_id, directory, ranges, slices):
+        # type: (str, str, List[Tuple[long, long]], bool) -> (List[str], List)
+        """ Fetch the byte ranges into directory on a pool of threads
+
+        Returns the errors of the ranges that failed and the ranges written
+        """
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        lock = threading.Lock()
+        covered = []
+
+        pool = ThreadPool(max(1, min(self.n_procs, len(ranges))))
+        try:
+            results = pool.map(
+                lambda byte_range: self._download_range(
+                    file_id, directory, byte_range, slices, lock, covered),
+                ranges)
+        finally:
+            pool.close()
+            pool.join()
+
+        return [ e for e in results if e ], covered
+
+    def _join_ranges(self, covered, md5sum=None):
+        # type: (List[Tuple[long, long, long, str]], str) -> (str, str)
+        """ Rename the sparse file the ranges were written to once they make
+        up the whole file and it matches md5sum, if there is one
+
+        Returns the path of the whole file, None if the ranges aren't the
+        whole file, and an error if it doesn't match md5sum
+        """
+
+        total, path = covered[0][2:]
+        end = -1
+        for start, last, _, _ in sorted(covered):
+            if start > end + 1:
+                return None, None
+            end = max(end, last)
+
+        if total is None or end + 1 != total:
+            return None, None
+
+        if md5sum:
+            md5 = hashlib.md5()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(WRITE_CHUNK_SIZE), ''):
+                    md5.update(chunk)
+            if md5.hexdigest() != md5sum:
+                return None, 'ranges of the whole file have invalid md5sum'
+
+        os.rename(path, path[:-len('.sparse')])
+        return path[:-len('.sparse')], None
+
+    def _complete_ranges(self, file_id, covered):
+        # type: (str, List[Tuple[long, long, long, str]]) -> str
+        """ A sparse file whose ranges make up the whole file is a download
+        of the file once it matches the md5sum of the index. It is renamed
+        and completed like any other, other range downloads are not
+
+        Returns an error if the whole file doesn't match its md5sum
+        """
+
+        expected = self.index.get_md5sum(file_id)
+        if not expected:
+            log.debug('No md5sum to check the ranges of {0} against'
+                      .format(file_id))
+            return None
+
+        path, error = self._join_ranges(covered, expected)
+        if path:
+            self._file_completed(file_id)
+        return error
+
+    def _download_threads(self, file_id, directory):
+        # type: (str, str) -> str
+        """ Download a whole file into directory in byte ranges on threads
+        of this process, instead of parcel's forked segment processes
+
+        Returns the error, if any
+        """
+
+        # one range per connection, or the whole file if its size is unknown
+        size = self.index.get_filesize(file_id)
+        ranges = [(0, None)]
+        if size:
+            part = -(-size // max(1, self.n_procs))
+            ranges = [ (start, min(start + part, size) - 1)
+                       for start in xrange(0, size, part) ]
+
+        errors, covered = self._fetch_ranges(file_id, directory, ranges, False)
+        if errors:
+            return errors[0]
+
+        md5sum = self.index.get_md5sum(file_id) if self.md5_check else None
+        path, error = self._join_ranges(covered, md5sum)
+        if not path and not error:
+            error = 'ranges do not make up the whole file'
+        return error
+
+    def _get_annotations(self, file_id):
+        # type: (str) -> str
+        """ Fetch the annotations.txt of a file, or None if it has none """
 
         annotations = self.index.get_annotations(file_id)
         annotation_list = ','.join(annotations)
@@ -64,29 +430,199 @@ class GDCDownloadMixin(object):
         if annotations:
             log.debug('Found {0} annotations for {1}.'.format(
                 len(annotations), file_id))
-            r = requests.get(
-                urlparse.urljoin(self.data_uri, annotation_list),
-                params={'compress': True},
-                verify=self.verify)
-            r.raise_for_status()
-            tar = tarfile.open(mode="r:gz", fileobj=StringIO(r.content))
-            if self.annotation_name in tar.getnames():
-                member = tar.getmember(self.annotation_name)
-                ann = tar.extractfile(member).read()
-                path = os.path.join(directory, self.annotation_name)
-                with open(path, 'w') as f:
-                    f.write(ann)
+            for endpoint in self._endpoints():
+                try:
+                    r = requests.get(
+                        urlparse.urljoin(
+                            endpoint.data_uri if endpoint else self.data_uri,
+                            annotation_list),
+                        params={'compress': True},
+                        verify=self.verify)
+                    r.raise_for_status()
+                except Exception as e:
+                    response = getattr(e, 'response', None)
+                    if not endpoint or not is_endpoint_error(
+                            response.status_code if response is not None else None):
+                        raise
+
+                    self.endpoints.failed(endpoint)
+                    log.warning('Unable to download annotations from {0}: '
+                                '{1}'.format(endpoint.base_uri, e))
+                    error = e
+                    continue
+
+                if endpoint:
+                    self.endpoints.succeeded(endpoint)
+
+                tar = tarfile.open(mode="r:gz", fileobj=StringIO(r.content))
+                if self.annotation_name in tar.getnames():
+                    member = tar.getmember(self.annotation_name)
+                    return tar.extractfile(member).read()
+                return None
+
+            raise error
+
+    def download_annotations(self, file_id):
+        # type: (str) -> None
+        """Finds and downloads annotations related to the primary entity.
+        :param str file_id: String containing the id of the primary entity
+        """
+
+        # The primary entity's directory
+        directory = os.path.join(self._root(file_id), file_id)
+
+        ann = self._get_annotations(file_id)
+        if ann is not None:
+            path = os.path.join(directory, self.annotation_name)
+            with open(path, 'w') as f:
+                f.write(ann)
 
             log.debug('Wrote annotations to {0}.'.format(path))
 
+    def _stream_url(self, file_id, directory, out, size=None, md5sum=None):
+        # type: (str, str, TarStream, long, str) -> bool
+        """ Stream a file into the tar stream as <directory>/<file_name> """
+
+        start = time.time()
+        try:
+            r, endpoint = self._get_data(file_id, {
+                'X-Auth-Token': self.token,
+                # the tar header needs the size before the content
+                'Accept-Encoding': 'identity',
+            })
+        except Exception as e:
+            log.error('Unable to download {0}: {1}'.format(file_id, e))
+            return False
+
+        size = size or long(r.headers.get('content-length') or 0)
+        if r.status_code != requests.codes.ok or not size:
+            log.error('[{0}] Unable to download {1}'.format(
+                r.status_code, file_id))
+            r.close()
+            return False
+
+        content_filename = r.headers.get('content-disposition')
+        if content_filename:
+            filename = content_filename.split('=')[1]
+        else:
+            filename = file_id
+
+        name = '{0}/{1}'.format(directory, filename)
+        complete = out.add(name, size, r.raw, md5sum)
+        r.close()
+
+        # a member cut short can't be retried in the stream
+        if endpoint and complete:
+            self.endpoints.succeeded(endpoint, size, time.time() - start)
+        elif endpoint:
+            self.endpoints.failed(endpoint)
+
+        return complete
+
+    def _stream_group(self, small_files, out):
+        # type: (List[str], TarStream) -> List[str]
+        """ Stream the members of a group tarfile as they are received """
+
+        for endpoint in self._endpoints():
+            start = time.time()
+            r = self._post(
+                    path='data?tarfile',
+                    headers={'X-Auth-Token': self.token},
+                    json={'ids': small_files},
+                    base_uri=endpoint and endpoint.base_uri)
+
+            status = r.status_code if r is not None else None
+            if not endpoint or not is_endpoint_error(status):
+                break
+
+            self.endpoints.failed(endpoint)
+            log.warning('[{0}] Unable to download group from {1}'.format(
+                status, endpoint.base_uri))
+            if r is not None:
+                r.close()
+
+        if r is None or r.status_code != requests.codes.ok:
+            log.warning('[{0}] Unable to download group'.format(
+                r.status_code if r is not None else 'no response'))
+            return small_files
+
+        r.raw.decode_content = True
+
+        streamed = set()
+        errors = []
+        t = tarfile.open(fileobj=r.raw, mode='r|*')
+        for m in t:
+            if not m.isfile() or m.name == 'MANIFEST.txt':
+                continue
+
+            file_id = m.name.split('/')[0]
+            md5sum = self.index.get_md5sum(file_id) if self.md5_check else None
+
+            if out.add(m.name, m.size, t.extractfile(m), md5sum):
+                streamed.add(file_id)
+            else:
+                errors.append(file_id)
+
+        t.close()
+        r.close()
+
+        if endpoint:
+            self.endpoints.succeeded(endpoint, sum([
+                self.index.get_filesize(f) or 0 for f in streamed ]),
+                time.time() - start)
+
+        return errors + [ f for f in small_files
+                          if f not in streamed and f not in errors ]
+
+    def stream_files(self, bigs, smalls, out):
+        # type: (List[str], List[List[str]], TarStream) -> List[str]
+        """ Download files into a single tar stream instead of to disk
+
+        Group members are passed through as they arrive and big files are
+        streamed one after another, each checked against its md5sum on the
+        way. Returns the UUIDs that failed.
+        """
+
+        errors = []
+        for s in smalls:
+            errors += self._stream_group(s, out)
+
+        for b in bigs:
+            md5sum = self.index.get_md5sum(b) if self.md5_check else None
+            if not self._stream_url(b, b, out, self.index.get_filesize(b),
+                                    md5sum):
+                errors.append(b)
+                continue
+
+            if self.related_files:
+                for related_file in self.index.get_related_files(b):
+                    self._stream_url(related_file, b, out)
+
+            if self.annotations:
+                try:
+                    ann = self._get_annotations(b)
+                    if ann is not None:
+                        out.add('{0}/{1}'.format(b, self.annotation_name),
+                                len(ann), StringIO(ann))
+                except Exception as e:
+                    log.warn('Unable to download annotations for {0}: {1}'
+                            .format(b, e))
+
+        return errors
 
     def _untar_file(self, tarfile_name):
         # type: (str) -> List[str]
         """ untar the file and return all the file names inside the tarfile """
 
-        t = tarfile.open(tarfile_name)
+        t = PreallocatingTarFile.open(tarfile_name)
         members = [ m for m in t.getmembers() if m.name != 'MANIFEST.txt' ]
-        t.extractall(members=members, path=self.base_directory)
+        for m in members:
+            path = self._root(m.name.split('/')[0])
+            t.extract(m, path=path)
+
+            # otherwise _md5_members drops them after reading
+            if not self.md5_check and m.isfile():
+                diskio.drop_cache(os.path.join(path, m.name))
         t.close()
 
         # cleanup
@@ -95,6 +631,29 @@ class GDCDownloadMixin(object):
         return [ m.name for m in members ]
 
 
+    def _keep_group(self, tarfile_name, file_ids):
+        # type: (str, List[str]) -> List[str]
+        """ Keep a group tarfile as is, with an index of its members,
+        instead of extracting it. Returns the UUIDs with invalid md5sums
+        """
+
+        name = archive.group_name(file_ids)
+        index = archive.keep_group(
+                tarfile_name, os.path.join(self._root(name), name))
+
+        errors = []
+        for file_id, member in index.iteritems():
+            if self.md5_check and \
+               self.index.get_md5sum(file_id) != member['md5sum']:
+                log.error('UUID {0} has invalid md5sum'.format(file_id))
+                errors.append(file_id)
+
+        # the group directory is moved and placed like a <uuid>/ directory
+        self.kept_groups[name] = [ f for f in index if f not in errors ]
+        self._file_completed(name)
+
+        return errors
+
     def _md5_members(self, members):
         # type: (List[str]) -> List[str]
         """ Calculate md5 hash and compare them with values given by the API """
@@ -105,9 +664,12 @@ class GDCDownloadMixin(object):
             log.debug('Validating checksum for {0}...'.format(member_uuid))
 
             md5sum = hashlib.md5()
-            filename = os.path.join(self.base_directory, m)
+            filename = os.path.join(self._root(member_uuid), m)
             with open(filename, 'rb') as f:
-                md5sum.update(f.read())
+                diskio.advise(f.fileno(), 0, 0, diskio.POSIX_FADV_SEQUENTIAL)
+                for chunk in iter(lambda: f.read(WRITE_CHUNK_SIZE), ''):
+                    md5sum.update(chunk)
+                diskio.advise(f.fileno(), 0, 0, diskio.POSIX_FADV_DONTNEED)
 
             if self.index.get_md5sum(member_uuid) != md5sum.hexdigest():
                 log.error('UUID {0} has invalid md5sum'.format(member_uuid))
@@ -116,18 +678,20 @@ class GDCDownloadMixin(object):
         return errors
 
 
-    def _post(self, path, headers={}, json={}, stream=True):
-        # type: (str, Dict[str]str, Dict[str]str, bool) -> requests.models.Response
+    def _post(self, path, headers={}, json={}, stream=True, base_uri=None):
+        # type: (str, Dict[str]str, Dict[str]str, bool, str) -> requests.models.Response
         """ custom post request that will query both active and legacy api
 
         return a python requests object to be handled by the method calling self._post
         """
 
+        base_uri = base_uri or self.base_uri
+
         r = None
         try:
             # try active
-            active = urlparse.urljoin(self.base_uri, path)
-            legacy = urlparse.urljoin(self.base_uri, 'legacy/{0}'.format(path))
+            active = urlparse.urljoin(base_uri, path)
+            legacy = urlparse.urljoin(base_uri, 'legacy/{0}'.format(path))
 
             r = requests.post(
                 active,
@@ -165,8 +729,33 @@ class GDCDownloadMixin(object):
         # {'ids': ['id1', 'id2'..., 'idn']}
         ids = {"ids": small_files}
 
-        # POST request avoids the MAX LEN character limit for URLs
-        r = self._post(path='data?tarfile', headers=headers, json=ids)
+        # mostly text groups are worth a gzipped tarfile,
+        # _untar_file handles both
+        path = 'data?tarfile'
+        if self.compress and not self.keep_groups and \
+           self.is_compressible(small_files):
+            path = 'data?compress'
+
+        for endpoint in self._endpoints():
+            start = time.time()
+
+            # POST request avoids the MAX LEN character limit for URLs
+            r = self._post(path=path, headers=headers, json=ids,
+                           base_uri=endpoint and endpoint.base_uri)
+
+            status = r.status_code if r is not None else None
+            if not endpoint or not is_endpoint_error(status):
+                break
+
+            self.endpoints.failed(endpoint)
+            log.warning('[{0}] Unable to download group from {1}'.format(
+                status, endpoint.base_uri))
+            if r is not None:
+                r.close()
+
+        if r is None:
+            errors.append(ids['ids'])
+            return '', errors
 
         if r.status_code == requests.codes.bad:
             log.error('Unable to connect to the API')
@@ -197,11 +786,24 @@ class GDCDownloadMixin(object):
             tarfile_name = time.strftime("gdc-client-%Y%m%d-%H%M%S.tar")
 
         with open(tarfile_name, 'wb') as f:
-            for chunk in r:
+            # headers and padding of each member, and the end of the archive
+            if path == 'data?tarfile':
+                diskio.preallocate(f.fileno(), sum([
+                    (self.index.get_filesize(s) or 0) + 3 * TAR_BLOCK_SIZE
+                    for s in small_files ]) + 2 * TAR_BLOCK_SIZE)
+
+            for chunk in r.iter_content(WRITE_CHUNK_SIZE):
                 f.write(chunk)
 
+            # give back what the estimate preallocated too much
+            f.truncate(f.tell())
+            size = f.tell()
+
         r.close()
 
+        if endpoint:
+            self.endpoints.succeeded(endpoint, size, time.time() - start)
+
         return tarfile_name, errors
 
 
@@ -233,27 +835,220 @@ class GDCDownloadMixin(object):
             log.debug('Saving grouping {0}/{1}'.format(i+1, groupings_len))
             tarfile_name, error = self._download_tarfile(s)
 
-            # this will happen in the result of an
-            # error that shouldn't be retried
-            if tarfile_name == '':
-                continue
-
             if error:
                 errors += error
                 time.sleep(0.5)
                 continue
 
+            # access was denied to the group. Only a group of files whose
+            # access wasn't queried (see load_manifest) can mix open and
+            # controlled files, so only its files are tried on their own
+            if tarfile_name == '':
+                if all([ self.index.get_access(f) is None for f in s ]):
+                    count, error = self._download_group_files(s)
+                    successful_count += count
+                    errors += error
+                continue
+
             successful_count += len(s)
+
+            if self.keep_groups:
+                errors += self._keep_group(tarfile_name, s)
+                pbar.update(1)
+                pbar.finish()
+                continue
+
             members = self._untar_file(tarfile_name)
 
+            md5_errors = []
             if self.md5_check:
-                errors += self._md5_members(members)
+                md5_errors = self._md5_members(members)
+                errors += md5_errors
+
+            for m in set([ m.split('/')[0] for m in members ]):
+                if m not in md5_errors:
+                    self._file_completed(m)
+
             pbar.update(1)
             pbar.finish()
 
         return errors, successful_count
 
 
+    def _download_group_files(self, file_ids):
+        # type: (List[str]) -> int, List[List[str]]
+        """ Download the files of a group that was refused one at a time.
+        Returns the number downloaded and the files that weren't, each as
+        a group of its own so they can be retried
+        """
+
+        log.warning('Unable to download group of {0} files, downloading '
+                    'them individually'.format(len(file_ids)))
+
+        downloaded, errors = self.download_big_files([
+            urlparse.urljoin(self.data_uri, f) for f in file_ids ])
+
+        for url, reason in errors.iteritems():
+            log.error('Unable to download file {0}: {1}'.format(
+                url.split('/')[-1], reason))
+
+        return len(downloaded), [ [url.split('/')[-1]] for url in errors ]
+
+    def _file_completed(self, file_id):
+        # type: (str) -> None
+        """ Called once a file and its related files are downloaded and verified """
+
+        if self.migrator:
+            # the hooks run once the file is moved to its destination
+            self.migrator.submit(file_id, self.kept_groups.get(file_id))
+            return
+
+        if self.placement:
+            self.placement.done(file_id)
+
+        self.run_hooks(file_id, self._root(file_id))
+
+    def run_hooks(self, file_id, root):
+        # type: (str, str) -> None
+        """ Schedule the completion hooks of a file in its final root
+
+        The files of a kept group get the group directory as their path.
+        """
+
+        if not self.hooks:
+            return
+
+        for f in self.kept_groups.pop(file_id, [file_id]):
+            path = os.path.join(root, file_id)
+            file_path = os.path.join(path, self.index.get_filename(f) or '')
+            if os.path.isfile(file_path):
+                path = file_path
+
+            self.hooks.submit(f, path,
+                self.index.get_filesize(f), self.index.get_md5sum(f))
+
+    def _endpoints(self):
+        # type: () -> Iterator[Endpoint]
+        """ The endpoints to try a request on in turn, each chosen from the
+        pool without the ones that were already tried. A single None
+        without a pool
+        """
+
+        if not self.endpoints:
+            yield None
+            return
+
+        tried = []
+        for _ in self.endpoints.endpoints:
+            endpoint = self.endpoints.choose(exclude=tried)
+            tried.append(endpoint)
+            yield endpoint
+
+    def _get_data(self, path, headers):
+        # type: (str, Dict[str, str]) -> Tuple[requests.Response, Endpoint]
+        """ Stream a GET of data/<path> over the session, failing over to
+        the other endpoints like the groups do
+
+        Returns the response and the endpoint it came from, raises the
+        error of the last endpoint if it couldn't be reached
+        """
+
+        r = None
+        for endpoint in self._endpoints():
+            if r is not None:
+                r.close()
+
+            try:
+                r = self.session.get(
+                    urlparse.urljoin(
+                        endpoint.data_uri if endpoint else self.data_uri,
+                        path),
+                    stream=True,
+                    verify=self.verify,
+                    headers=headers)
+            except Exception as e:
+                r, error = None, e
+
+            status = r.status_code if r is not None else None
+            if not endpoint or not is_endpoint_error(status):
+                break
+
+            self.endpoints.failed(endpoint)
+            log.warning('[{0}] Unable to download {1} from {2}'.format(
+                status, path, endpoint.base_uri))
+
+        if r is None:
+            raise error
+        return r, endpoint
+
+    def download_big_files(self, urls):
+        # type: (List[str]) -> List[str], Dict[str, str]
+        """ Download big files through parcel one at a time
+
+        Unlike parcel's download_files, each file is reported as completed
+        as soon as it is downloaded.
+
+        Returns the downloaded urls and the errors by url
+        """
+
+        downloaded = []
+        errors = dict()
+        for url in urls:
+            # parcel downloads into <directory>/<uuid>/
+            self.directory = self._root(url.split('/')[-1])
+            error = self._download_big_file(url)
+            if error:
+                errors[url] = error
+                continue
+
+            downloaded.append(url)
+            self._file_completed(url.split('/')[-1])
+
+        return downloaded, errors
+
+    def _download_big_file(self, url):
+        # type: (str) -> str
+        """ Download a big file through parcel, or in byte ranges with the
+        threads engine, failing over to the other endpoints if there are
+        several. Returns the error, if any
+        """
+
+        if self.engine == THREADS:
+            # the ranges fail over across the endpoints on their own
+            file_id = url.split('/')[-1]
+            error = self._download_threads(
+                    file_id, os.path.join(self.directory, file_id))
+            if not error:
+                self.download_extras(file_id)
+            return error
+
+        if not self.endpoints:
+            _, error = self.download_files([url])
+            return error.values()[0] if error else None
+
+        file_id = url.split('/')[-1]
+        for endpoint in self._endpoints():
+            start = time.time()
+            _, error = self.download_files(
+                    [urlparse.urljoin(endpoint.data_uri, file_id)])
+            if not error:
+                self.endpoints.succeeded(endpoint,
+                    self.index.get_filesize(file_id) or 0, time.time() - start)
+                return None
+
+            error = error.values()[0]
+
+            # access and missing files are the same on every endpoint
+            status = re.search(r'\b[45]\d\d\b', str(error))
+            if status and not is_endpoint_error(int(status.group(0))):
+                return error
+
+            self.endpoints.failed(endpoint)
+            log.warning('Unable to download {0} from {1}: {2}'.format(
+                file_id, endpoint.base_uri, error))
+
+        return error
+
     def parallel_download(self, stream, download_related_files=None,
                           download_annotations=None, *args, **kwargs):
 
@@ -262,6 +1057,20 @@ class GDCDownloadMixin(object):
         file_id = stream.url.split('/')[-1]
         super(GDCDownloadMixin, self).parallel_download(stream)
 
+        # parcel writes the segments, but the pages don't need to stay cached
+        if os.path.isfile(stream.temp_path):
+            diskio.drop_cache(stream.temp_path)
+
+        self.download_extras(file_id, download_related_files,
+                             download_annotations)
+
+    def download_extras(self, file_id, download_related_files=None,
+                        download_annotations=None):
+        # type: (str, bool, bool) -> None
+        """ Download the related files and annotations of a file
+        :param str file_id: String containing the id of the primary entity
+        """
+
         if download_related_files or \
            download_related_files is None and self.related_files:
             try:
@@ -282,6 +1091,104 @@ class GDCDownloadMixin(object):
                 if self.debug:
                     raise
 
+    def is_compressible(self, file_ids):
+        # type: (List[str]) -> bool
+        """ Whether most of the bytes of the files are compressible text """
+
+        compressible = 0
+        total = 0
+        for f in file_ids:
+            size = self.index.get_filesize(f) or 0
+            total += size
+            if is_compressible(self.index.get_filename(f)):
+                compressible += size
+
+        return total > 0 and compressible * 2 > total
+
+    def download_compressed(self, file_id):
+        # type: (str) -> str
+        """ Download a file with gzip transfer encoding
+
+        The response is decompressed while it is streamed to disk and the
+        md5sum is calculated on the decompressed bytes. If the server
+        doesn't compress the response NOT_COMPRESSED is returned before
+        the body is read, the file is better off downloaded by parcel.
+
+        :param str file_id: String containing the id of the file
+        :returns: an error message, or None if the file was downloaded
+        """
+
+        directory = os.path.join(self._root(file_id), file_id)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        start = time.time()
+        try:
+            r, endpoint = self._get_data(file_id, {
+                'X-Auth-Token': self.token,
+                'Accept-Encoding': 'gzip',
+            })
+        except Exception as e:
+            return str(e)
+
+        if r.status_code != requests.codes.ok:
+            r.close()
+            return '[{0}] Unable to download file'.format(r.status_code)
+
+        if r.headers.get('content-encoding') != 'gzip':
+            r.close()
+            return NOT_COMPRESSED
+
+        content_filename = r.headers.get('content-disposition')
+        if content_filename:
+            filename = content_filename.split('=')[1]
+        else:
+            filename = self.index.get_filename(file_id) or file_id
+
+        path = os.path.join(directory, filename)
+        temp_path = '{0}.partial'.format(path)
+
+        md5sum = hashlib.md5()
+        try:
+            with open(temp_path, 'wb') as f:
+                diskio.preallocate(f.fileno(), self.index.get_filesize(file_id))
+
+                # iter_content undoes the gzip content encoding
+                for chunk in r.iter_content(WRITE_CHUNK_SIZE):
+                    md5sum.update(chunk)
+                    f.write(chunk)
+
+                f.truncate(f.tell())
+                f.flush()
+                diskio.advise(f.fileno(), 0, 0, diskio.POSIX_FADV_DONTNEED)
+
+        # a dropped connection or a corrupt gzip stream
+        except Exception as e:
+            if endpoint and isinstance(e, requests.exceptions.RequestException):
+                self.endpoints.failed(endpoint)
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+            return str(e)
+
+        finally:
+            r.close()
+
+        if endpoint:
+            self.endpoints.succeeded(endpoint,
+                os.path.getsize(temp_path), time.time() - start)
+
+        log.debug('Downloaded {0} with gzip content encoding'.format(file_id))
+
+        expected = self.index.get_md5sum(file_id)
+        if self.md5_check and expected and expected != md5sum.hexdigest():
+            log.error('UUID {0} has invalid md5sum'.format(file_id))
+            os.remove(temp_path)
+            return 'invalid md5sum'
+
+        os.rename(temp_path, path)
+        self.download_extras(file_id)
+        self._file_completed(file_id)
+
     def fix_url(self, url):
         # type: (str) -> str
         """ Fix a url to be used in the rest of the program
@@ -300,9 +1207,13 @@ class GDCDownloadMixin(object):
 class GDCHTTPDownloadClient(GDCDownloadMixin, HTTPClient):
 
     def __init__(self, uri, index_client, download_related_files=True,
-                 download_annotations=True, *args, **kwargs):
+                 download_annotations=True, transfer_compression=False,
+                 keep_groups=False, engine=PROCESSES, *args, **kwargs):
 
         self.annotations = download_annotations
+        self.compress = transfer_compression
+        self.keep_groups = keep_groups
+        self.kept_groups = dict()
         self.base_directory = kwargs.get('directory')
         self.base_uri = self.fix_url(uri)
         self.data_uri = urlparse.urljoin(self.base_uri, 'data/')
@@ -310,6 +1221,9 @@ class GDCHTTPDownloadClient(GDCDownloadMixin, HTTPClient):
         self.md5_check = kwargs.get('file_md5sum')
         self.related_files = download_related_files
         self.verify = kwargs.get('verify')
+        self.session = make_session(kwargs.get('n_procs') or 1)
+        self.range_retries = int(kwargs.get('retry_amount') or 0)
+        self.engine = engine
 
         super(GDCDownloadMixin, self).__init__(self.data_uri, *args, **kwargs)
 
@@ -324,5 +1238,8 @@ class GDCUDTDownloadClient(GDCDownloadMixin, UDTClient):
         self.data_uri = urlparse.urljoin(remote_uri, 'data/')
         self.related_files = download_related_files
         self.annotations = download_annotations
+        self.compress = False
+        self.keep_groups = False
+        self.kept_groups = dict()
         self.directory = os.path.abspath(time.strftime("gdc-client-%Y%m%d-%H%M%S"))
         super(GDCDownloadMixin, self).__init__(*args, **kwargs)
@@ -0,0 +1,200 @@
+import logging
+import random
+import threading
+import time
+import urlparse
+
+import requests
+
+
+log = logging.getLogger('gdc-download')
+
+# consecutive failures that open an endpoint's circuit
+FAILURE_THRESHOLD = 3
+
+# seconds an open circuit waits before letting a trial request through
+RESET_TIMEOUT = 30.0
+
+# an endpoint this much slower than the fastest one counts as failing
+SLOW_FRACTION = 0.25
+
+# transfers smaller than this are dominated by latency, not throughput
+SLOW_MIN_BYTES = 16 * 1024 * 1024
+
+# weight of the newest throughput sample in the moving average
+SMOOTHING = 0.3
+
+
+def parse_servers(value):
+    # type: (str) -> List[Tuple[str, float]]
+    """ Parse a comma separated list of servers, each URL[=WEIGHT]
+
+    Example:
+        https://mirror-a.example.org/=3,https://mirror-b.example.org/
+    """
+
+    servers = []
+    for server in value.split(','):
+        server = server.strip()
+        if not server:
+            continue
+
+        uri, weight = server, 1.0
+        if '=' in server:
+            head, tail = server.rsplit('=', 1)
+            try:
+                uri, weight = head, float(tail)
+            except ValueError:
+                pass
+
+        servers.append((uri, weight))
+
+    return servers
+
+
+def is_endpoint_error(status_code):
+    # type: (int) -> bool
+    """ Whether a response says something about the endpoint rather than
+    about the request """
+
+    return status_code is None or status_code >= 500 or \
+        status_code == requests.codes.too_many_requests
+
+
+class Endpoint(object):
+    """ One API endpoint and the state of its circuit breaker """
+
+    def __init__(self, base_uri, weight=1.0):
+        # the same as GDCDownloadMixin.fix_url
+        if not base_uri.endswith('/'):
+            base_uri = '{0}/'.format(base_uri)
+        if not (base_uri.startswith('https://') or
+                base_uri.startswith('http://')):
+            base_uri = 'https://{0}'.format(base_uri)
+
+        self.base_uri = base_uri
+        self.data_uri = urlparse.urljoin(base_uri, 'data/')
+        self.weight = weight
+        self.failures = 0
+        self.opened = None
+        self.throughput = None
+
+    def __repr__(self):
+        return '<Endpoint {0}>'.format(self.base_uri)
+
+
+class EndpointPool(object):
+    """ Spreads groups and big files across several API endpoints
+
+    Endpoints are picked at random in proportion to their weight. An
+    endpoint that fails (or is much slower than the fastest one) a few
+    times in a row has its circuit opened and gets no requests until a
+    single trial request is let through after a timeout, so that one bad
+    mirror doesn't stall the download.
+    """
+
+    def __init__(self, servers, verify=True,
+                 failure_threshold=FAILURE_THRESHOLD,
+                 reset_timeout=RESET_TIMEOUT):
+        self.endpoints = [ Endpoint(uri, weight) for uri, weight in servers ]
+        self.verify = verify
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+
+    def check_health(self, timeout=10):
+        # type: (int) -> List[Endpoint]
+        """ Open the circuit of endpoints whose status can't be fetched
+
+        Returns the healthy endpoints
+        """
+
+        healthy = []
+        for e in self.endpoints:
+            try:
+                r = requests.get(urlparse.urljoin(e.base_uri, 'status'),
+                                 verify=self.verify, timeout=timeout)
+                ok = r.status_code == requests.codes.ok
+            except Exception as err:
+                log.debug('Health check of {0} failed: {1}'.format(
+                    e.base_uri, err))
+                ok = False
+
+            if ok:
+                healthy.append(e)
+            else:
+                log.warning('{0} is not healthy'.format(e.base_uri))
+                with self.lock:
+                    e.failures = self.failure_threshold
+                    e.opened = time.time()
+
+        return healthy
+
+    def _available(self, e, now):
+        return e.opened is None or now - e.opened >= self.reset_timeout
+
+    def choose(self, exclude=()):
+        # type: (List[Endpoint]) -> Endpoint
+        """ Pick the endpoint for the next request """
+
+        with self.lock:
+            now = time.time()
+            candidates = [ e for e in self.endpoints if e not in exclude ] \
+                or self.endpoints
+            available = [ e for e in candidates if self._available(e, now) ]
+
+            if not available:
+                # all of them are failing, try the one that opened first
+                e = min(candidates, key=lambda e: e.opened)
+            else:
+                total = sum([ e.weight for e in available ])
+                point = random.uniform(0, total)
+                for e in available:
+                    point -= e.weight
+                    if point <= 0:
+                        break
+
+            if e.opened is not None:
+                # half open, only one trial request at a time
+                e.opened = now
+
+            return e
+
+    def failed(self, e):
+        # type: (Endpoint) -> None
+        """ Record a failed request, opening the circuit if it keeps failing """
+
+        with self.lock:
+            e.failures += 1
+            if e.failures >= self.failure_threshold:
+                if e.opened is None:
+                    log.warning('{0} keeps failing, not using it for {1} '
+                                'seconds'.format(e.base_uri, self.reset_timeout))
+                e.opened = time.time()
+
+    def succeeded(self, e, size=0, elapsed=0):
+        # type: (Endpoint, long, float) -> None
+        """ Record a successful transfer of size bytes in elapsed seconds """
+
+        slow = False
+        with self.lock:
+            if size >= SLOW_MIN_BYTES and elapsed > 0:
+                speed = size / elapsed
+                e.throughput = speed if e.throughput is None else \
+                    SMOOTHING * speed + (1 - SMOOTHING) * e.throughput
+
+                fastest = max([ o.throughput for o in self.endpoints
+                                if o.throughput is not None ])
+                slow = e.throughput < SLOW_FRACTION * fastest
+
+        if slow:
+            log.debug('{0} is slow: {1:.0f} B/s'.format(
+                e.base_uri, e.throughput))
+            self.failed(e)
+            return
+
+        with self.lock:
+            if e.opened is not None:
+                log.info('{0} is back'.format(e.base_uri))
+            e.failures = 0
+            e.opened = None
@@ -0,0 +1,100 @@
+import logging
+import os
+import Queue
+import shlex
+import subprocess
+import threading
+
+
+log = logging.getLogger('gdc-download')
+
+
+class HookPool(object):
+    """ Runs a command or a callback for each verified file in background
+    threads, while the rest of the files are still downloading
+
+    The command is run with the UUID, path, size and md5sum of the file
+    appended to its arguments, and with them in the environment as
+    GDC_FILE_ID, GDC_FILE_PATH, GDC_FILE_SIZE and GDC_FILE_MD5SUM. The
+    callback is called as callback(file_id, path, size, md5sum).
+
+    Example:
+        client.hooks = HookPool(callback=index_file, workers=4)
+        ...
+        errors = client.hooks.join()
+    """
+
+    def __init__(self, command=None, callback=None, workers=2):
+        self.command = shlex.split(command) if command else None
+        self.callback = callback
+        self.queue = Queue.Queue()
+        self.errors = []
+        self.completed = []
+
+        self.threads = []
+        for _ in range(max(1, workers)):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, file_id, path, size=None, md5sum=None):
+        # type: (str, str, long, str) -> None
+        """ Schedule the hooks of a verified file """
+
+        self.queue.put((file_id, path, size, md5sum))
+
+    def join(self):
+        # type: () -> List[str]
+        """ Wait for all scheduled hooks and stop the workers
+
+        Returns the UUIDs whose hooks failed
+        """
+
+        for _ in self.threads:
+            self.queue.put(None)
+
+        for t in self.threads:
+            t.join()
+
+        return self.errors
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            file_id = item[0]
+            try:
+                self._hook(*item)
+                self.completed.append(file_id)
+            except Exception as e:
+                log.error('Completion hook failed for {0}: {1}'.format(
+                    file_id, e))
+                self.errors.append(file_id)
+
+    def _hook(self, file_id, path, size, md5sum):
+        # type: (str, str, long, str) -> None
+        if self.callback:
+            self.callback(file_id, path, size, md5sum)
+
+        if self.command:
+            size = '' if size is None else str(size)
+            md5sum = md5sum or ''
+
+            env = dict(os.environ)
+            env.update({
+                'GDC_FILE_ID': file_id,
+                'GDC_FILE_PATH': path,
+                'GDC_FILE_SIZE': size,
+                'GDC_FILE_MD5SUM': md5sum,
+            })
+
+            returncode = subprocess.call(
+                    self.command + [file_id, path, size, md5sum], env=env)
+            if returncode:
+                raise RuntimeError('{0} exited with {1}'.format(
+                    self.command[0], returncode))
+
+        log.debug('Ran completion hook for {0}'.format(file_id))
@@ -0,0 +1,127 @@
+import logging
+import os
+import Queue
+import shutil
+import threading
+
+
+log = logging.getLogger('gdc-download')
+
+
+def directory_size(path):
+    # type: (str) -> long
+    """ The bytes of the files under path """
+
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            size += os.path.getsize(os.path.join(dirpath, name))
+    return size
+
+
+class Migrator(object):
+    """ Moves completed downloads from a staging directory to their final
+    directory in background threads
+
+    Transfers and verification happen in the (fast, local) staging
+    directory. Each completed file's <uuid>/ directory is handed to the
+    migrator, which moves it to the destination with bounded concurrency so
+    that a slow destination filesystem never blocks the network transfer.
+    At most one directory waits to be moved, submit blocks until a worker
+    takes it, so the staging directory holds a file or group per worker,
+    the waiting one and the one downloading.
+    """
+
+    def __init__(self, staging_directory, directory, workers=2, placement=None,
+                 on_migrated=None):
+        self.staging_directory = staging_directory
+        self.directory = directory
+        self.placement = placement
+        # called with the UUID and destination root of each moved file
+        self.on_migrated = on_migrated
+        # bounds what piles up in the staging directory, see Preflight
+        self.queue = Queue.Queue(maxsize=1)
+        self.errors = []
+        self.migrated = []
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.threads = []
+        for _ in range(max(1, workers)):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, file_id, members=None):
+        # type: (str, List[str]) -> None
+        """ Schedule the staged directory of a verified file to be moved
+
+        A kept group's directory is named after the group, members are the
+        UUIDs of its files, which are the errors if it can't be moved.
+        """
+
+        self.queue.put((file_id, [file_id] if members is None else members))
+
+    def join(self):
+        # type: () -> List[str]
+        """ Wait for all scheduled moves and stop the workers
+
+        Returns the UUIDs that couldn't be moved to the destination
+        """
+
+        for _ in self.threads:
+            self.queue.put(None)
+
+        for t in self.threads:
+            t.join()
+
+        return self.errors
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            file_id, members = item
+            try:
+                self._migrate(file_id)
+                self.migrated.append(file_id)
+            except Exception as e:
+                log.error('Unable to move {0} to {1}: {2}'.format(
+                    file_id, self.directory, e))
+                self.errors += members
+
+    def _migrate(self, file_id):
+        # type: (str) -> None
+        source = os.path.join(self.staging_directory, file_id)
+        root = self.directory
+        if self.placement:
+            # what is moved, the file with its related files and annotations
+            root = self.placement.root(file_id, directory_size(source))
+        destination = os.path.join(root, file_id)
+
+        if not os.path.isdir(destination):
+            # copies and deletes if the destination is another filesystem
+            shutil.move(source, destination)
+
+        else:
+            # merge into what a previous download left behind
+            for name in os.listdir(source):
+                target = os.path.join(destination, name)
+                if os.path.isdir(target):
+                    shutil.rmtree(target)
+                elif os.path.exists(target):
+                    os.remove(target)
+                shutil.move(os.path.join(source, name), target)
+            os.rmdir(source)
+
+        if self.placement:
+            self.placement.done(file_id)
+
+        log.debug('Moved {0} to {1}'.format(file_id, destination))
+
+        if self.on_migrated:
+            self.on_migrated(file_id, root)
@@ -1,6 +1,16 @@
 from gdc_client import defaults
+from gdc_client import netbind
 from gdc_client.download.client import GDCUDTDownloadClient
 from gdc_client.download.client import GDCHTTPDownloadClient
+from gdc_client.download.client import NOT_COMPRESSED
+from gdc_client.download.client import ENGINES, PROCESSES
+from gdc_client.download import endpoints
+from gdc_client.download import plan
+from gdc_client.download import preflight
+from gdc_client.download.hooks import HookPool
+from gdc_client.download.migrate import Migrator
+from gdc_client.download.placement import Placement, POLICIES, ROUND_ROBIN
+from gdc_client.download.tarstream import TarStream, redirect_logging
 from gdc_client.query.index import GDCIndexClient
 from functools import partial
 from parcel import const
@@ -9,6 +19,7 @@ from parcel import manifest
 
 import argparse
 import logging
+import os
 import time
 import urlparse
 
@@ -22,13 +33,76 @@ UDT_SUPPORT = ' '.join([
     'please contact the GDC Help Desk at support@nci-gdc.datacommons.io.',
 ])
 
+def parse_range(value):
+    # type: (str) -> Tuple[long, long]
+    """ Parse an HTTP style byte range: START-END, START- or -SUFFIX
+    """
+    try:
+        start, end = [ v.strip() for v in value.split('-') ]
+        start = long(start) if start else None
+        end = long(end) if end else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'invalid byte range {0}, expected START-END'.format(value))
+
+    if start is None and end is None or \
+       start is not None and end is not None and end < start:
+        raise argparse.ArgumentTypeError(
+            'invalid byte range {0}, expected START-END'.format(value))
+
+    return start, end
+
+def load_ranges(path):
+    # type: (str) -> Dict[str, List[Tuple[long, long]]]
+    """ Load a ranges file with lines of: file_id range [range ...]
+    """
+    ranges = dict()
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#')[0].split()
+            if not line:
+                continue
+            ranges.setdefault(line[0], []).extend(
+                [ parse_range(r) for r in line[1:] ])
+
+    return ranges
+
 def validate_args(parser, args):
     """ Validate argparse namespace.
     """
-    if not args.file_ids and not args.manifest:
-        msg = 'must specify either --manifest or file_id'
+    if not args.file_ids and not args.manifest and not args.plan_in \
+       and not args.ranges_file:
+        msg = 'must specify either --manifest, --plan-in or file_id'
         parser.error(msg)
 
+    if args.manifest_metadata and not args.manifest:
+        parser.error('--manifest-metadata requires --manifest')
+
+    if args.plan_in and args.plan_out:
+        parser.error('--plan-in and --plan-out are mutually exclusive')
+
+    # the plan already lists the files to download
+    if args.plan_in and (args.file_ids or args.manifest or
+                         args.ranges or args.ranges_file):
+        parser.error('--plan-in can not be combined with --manifest, '
+                     'file_id or --range(s-file)')
+
+    if args.ranges and args.ranges_file:
+        parser.error('--range and --ranges-file are mutually exclusive')
+
+    if args.to_stdout and (args.staging_dir or args.keep_groups or
+                           args.ranges or args.ranges_file or args.plan_out):
+        parser.error('--to-stdout can not be combined with --staging-dir, '
+                     '--keep-groups, --range(s-file) or --plan-out')
+
+    if args.to_stdout and args.on_complete:
+        parser.error('--on-complete needs the files on disk, '
+                     'not --to-stdout')
+
+    if args.staging_dir and os.path.abspath(args.staging_dir) in \
+       [ os.path.abspath(d) for d in args.dir.split(os.pathsep) ]:
+        parser.error('--staging-dir must differ from --dir')
+
     if args.udt:
         # We were asked to remove 'error' in the message
         parser.exit(status=1, message=UDT_SUPPORT)
@@ -38,7 +112,7 @@ def get_client(args, index_client):
     kwargs = {
         'token': args.token_file,
         'n_procs': args.n_processes,
-        'directory': args.dir,
+        'directory': args.staging_dir or args.dir.split(os.pathsep)[0],
         'segment_md5sums': args.segment_md5sums,
         'file_md5sum': args.file_md5sum,
         'http_chunk_size': args.http_chunk_size,
@@ -48,6 +122,9 @@ def get_client(args, index_client):
         'no_auto_retry': args.no_auto_retry,
         'retry_amount': args.retry_amount,
         'verify': not args.no_verify,
+        'transfer_compression': args.transfer_compression,
+        'keep_groups': args.keep_groups,
+        'engine': args.download_engine,
     }
     # The option to use UDT should be hidden until
     # (1) the external library is packaged into the binary and
@@ -65,7 +142,7 @@ def get_client(args, index_client):
     else:
     '''
     return GDCHTTPDownloadClient(
-            uri=args.server,
+            uri=endpoints.parse_servers(args.server)[0][0],
             index_client=index_client,
             **kwargs
     )
@@ -83,9 +160,20 @@ def download(parser, args):
     unsuccessful_count = 0
     big_errors = []
     small_errors = []
+    migrate_errors = []
+    hook_errors = []
+    skipped = []
     total_download_count = 0
     validate_args(parser, args)
 
+    if args.to_stdout:
+        # stdout carries the tar stream
+        redirect_logging()
+
+    # groups, parcel streams and related files share the local addresses
+    if args.source_address:
+        netbind.bind_source_addresses(args.source_address)
+
     # sets do not allow duplicates in a list
     ids = set(args.file_ids)
     for i in args.manifest:
@@ -94,11 +182,96 @@ def download(parser, args):
             break
         ids.add(i['id'])
 
-    index_client = GDCIndexClient(args.server)
-    client = get_client(args, index_client)
+    servers = endpoints.parse_servers(args.server)
+    pool = None
+    if len(servers) > 1:
+        pool = endpoints.EndpointPool(
+                servers,
+                verify=not args.no_verify,
+                failure_threshold=args.server_failures,
+                reset_timeout=args.server_cooldown)
+
+        # the index is queried through the first healthy server
+        healthy = pool.check_health()
+        if healthy:
+            args.server = healthy[0].base_uri
+        else:
+            log.warning('None of the servers are healthy, trying them anyway')
 
-    # separate the smaller files from the larger files
-    bigs, smalls = index_client.separate_small_files(ids, args.http_chunk_size)
+    index_client = GDCIndexClient(endpoints.parse_servers(args.server)[0][0])
+    client = get_client(args, index_client)
+    client.endpoints = pool
+
+    # stripe the <uuid>/ directories across several roots
+    roots = args.dir.split(os.pathsep)
+    if len(roots) > 1 and not args.plan_out and not args.to_stdout:
+        client.placement = Placement(
+                roots, args.placement, args.placement_index)
+
+    # downstream processing starts on each file as soon as it's verified
+    if args.on_complete and not args.plan_out:
+        client.hooks = HookPool(args.on_complete, workers=args.hook_workers)
+
+    if args.staging_dir and not args.plan_out:
+        if not os.path.isdir(args.staging_dir):
+            os.makedirs(args.staging_dir)
+
+        # verified files are moved to --dir while the rest download
+        client.migrator = Migrator(
+                args.staging_dir,
+                roots[0],
+                args.migrate_workers,
+                placement=client.placement,
+                on_migrated=client.run_hooks)
+
+    if args.ranges or args.ranges_file:
+        return download_ranges(client, ids, args)
+
+    if args.plan_in:
+        # execute a previously resolved plan without querying the index
+        try:
+            bigs, smalls = plan.load(args.plan_in, index_client)
+        except (IOError, ValueError) as e:
+            log.error('Unable to load download plan: {0}'.format(e))
+            return [args.plan_in]
+        ids = set(bigs + [ s for group in smalls for s in group ])
+    else:
+        # the manifest already carries the size and md5sum of each file,
+        # but not their access or related files, so it's only trusted
+        # when asked to
+        if args.manifest_metadata:
+            index_client.load_manifest(args.manifest)
+
+        # separate the smaller files from the larger files
+        bigs, smalls = index_client.separate_small_files(
+                ids,
+                args.http_chunk_size,
+                related_files=args.download_related_files,
+                annotations=args.download_annotations)
+
+    if args.plan_out:
+        plan.dump(plan.build(index_client, client, bigs, smalls), args.plan_out)
+        return
+
+    if args.to_stdout:
+        return download_to_stdout(client, ids, bigs, smalls, args)
+
+    # don't find out the disk is full most of the way through
+    if args.preflight != preflight.OFF:
+        check = preflight.Preflight(
+                index_client,
+                roots,
+                staging_directory=args.staging_dir,
+                keep_groups=args.keep_groups,
+                placement=client.placement,
+                migrate_workers=args.migrate_workers)
+        fits, bigs, smalls, skipped = check.check(
+                bigs, smalls, trim=args.preflight == preflight.TRIM)
+
+        if not fits:
+            log.error('Not enough free space, free some space, add '
+                      'directories to --dir or use --preflight trim')
+            return list(ids)
 
     # the big files will be normal downloads
     # the small files will be joined together and tarfiled
@@ -117,6 +290,26 @@ def download(parser, args):
             successful_count += count
             i += 1
 
+    # text files are streamed with gzip transfer instead of through parcel
+    if bigs and args.transfer_compression:
+        compressed = [ b for b in bigs if client.is_compressible([b]) ]
+        bigs = list(set(bigs) - set(compressed))
+
+        # failures fall back to parcel, which resumes and retries them
+        for i, b in enumerate(compressed):
+            log.debug('Downloading {0} with transfer compression'.format(b))
+            error = client.download_compressed(b)
+            if error == NOT_COMPRESSED:
+                log.debug('The server does not compress in transfer')
+                bigs += compressed[i:]
+                break
+            elif error:
+                log.warning('Unable to download file {0} with transfer '
+                            'compression: {1}'.format(b, error))
+                bigs.append(b)
+            else:
+                successful_count += 1
+
     # client.download_files is located in parcel which calls
     # self.parallel_download, which goes back to to gdc-client's parallel_download
     if bigs:
@@ -124,7 +317,7 @@ def download(parser, args):
 
         # create URLs to send to parcel for download
         bigs = [ urlparse.urljoin(client.data_uri, b) for b in bigs ]
-        downloaded_files, big_error_dict = client.download_files(bigs)
+        downloaded_files, big_error_dict = client.download_big_files(bigs)
         not_downloaded_url = ''
         big_errors_count = 0
 
@@ -152,6 +345,18 @@ def download(parser, args):
 
         successful_count += len(bigs) - len(big_errors)
 
+    if client.migrator:
+        log.debug('Waiting for files to be moved to {0}'.format(args.dir))
+        migrate_errors = client.migrator.join()
+        successful_count -= len(migrate_errors)
+
+    if client.placement:
+        client.placement.write_index()
+
+    if client.hooks:
+        log.debug('Waiting for completion hooks')
+        hook_errors = client.hooks.join()
+
     unsuccessful_count = len(ids) - successful_count
 
     msg = 'Successfully downloaded'
@@ -165,7 +370,96 @@ def download(parser, args):
             colored(msg, 'red') if not args.color_off else msg,
             unsuccessful_count))
 
-    return small_errors or big_errors
+    if hook_errors:
+        msg = 'Failed completion hooks'
+        log.info('{0}: {1}'.format(
+            colored(msg, 'red') if not args.color_off else msg,
+            len(hook_errors)))
+
+    return small_errors or big_errors or \
+        migrate_errors or hook_errors or skipped
+
+
+def download_ranges(client, ids, args):
+    """ Downloads byte ranges of files instead of the whole files.
+    """
+
+    if args.ranges_file:
+        ranges = load_ranges(args.ranges_file)
+    else:
+        ranges = dict([ (i, args.ranges) for i in ids ])
+
+    # the md5sums of files whose ranges turn out to be the whole file
+    client.index._get_metadata(ranges.keys())
+
+    errors = []
+    for file_id, file_ranges in ranges.iteritems():
+        log.debug('Downloading {0} ranges of {1}'.format(
+            len(file_ranges), file_id))
+        if client.download_ranges(file_id, file_ranges, args.range_slices):
+            errors.append(file_id)
+
+    if client.migrator:
+        errors += client.migrator.join()
+
+    if client.placement:
+        client.placement.write_index()
+
+    hook_errors = client.hooks.join() if client.hooks else []
+
+    msg = 'Successfully downloaded ranges of'
+    log.info('{0}: {1}'.format(
+        colored(msg, 'green') if not args.color_off else msg,
+        len(ranges) - len(errors)))
+
+    if errors:
+        msg = 'Failed range downloads'
+        log.info('{0}: {1}'.format(
+            colored(msg, 'red') if not args.color_off else msg,
+            len(errors)))
+
+    if hook_errors:
+        msg = 'Failed completion hooks'
+        log.info('{0}: {1}'.format(
+            colored(msg, 'red') if not args.color_off else msg,
+            len(hook_errors)))
+
+    return errors or hook_errors
+
+
+def download_to_stdout(client, ids, bigs, smalls, args):
+    """ Writes the files to stdout as a single tar stream of
+    <uuid>/<file_name> members instead of to disk.
+
+        Members are written as they arrive, so the stream can be piped
+        straight into another program, e.g. | tar -x -C /scratch
+    """
+
+    out = TarStream()
+    errors = client.stream_files(bigs, smalls, out)
+
+    i = 0
+    while i < args.retry_amount and errors:
+        time.sleep(args.wait_time)
+        log.debug('Retrying {0} failed downloads'.format(len(errors)))
+        # a member written once stays in the stream, retry file by file
+        errors = client.stream_files(errors, [], out)
+        i += 1
+
+    out.close()
+
+    msg = 'Successfully downloaded'
+    log.info('{0}: {1}'.format(
+        colored(msg, 'green') if not args.color_off else msg,
+        len(ids) - len(errors)))
+
+    if errors:
+        msg = 'Failed downloads'
+        log.info('{0}: {1}'.format(
+            colored(msg, 'red') if not args.color_off else msg,
+            len(errors)))
+
+    return errors
 
 
 def retry_download(client, url, retry_amount, no_auto_retry, wait_time):
@@ -186,7 +480,7 @@ def retry_download(client, url, retry_amount, no_auto_retry, wait_time):
             time.sleep(wait_time)
             # client.download_files accepts a list of urls to download
             # but we want to only try one at a time
-            _, e = client.download_files([url])
+            _, e = client.download_big_files([url])
             if not e:
                 log.debug('Successfully downloaded {0}!'.format(url))
                 return
@@ -210,10 +504,47 @@ def config(parser):
 
     parser.add_argument('-d', '--dir', default='.',
                         help='Directory to download files to. '
-                        'Defaults to current dir')
+                        'Defaults to current dir. Several directories '
+                        'separated by {0} stripe the files across them'
+                        .format(os.pathsep))
+    parser.add_argument('--placement', choices=POLICIES,
+                        default=ROUND_ROBIN,
+                        help='How files are placed on several --dir '
+                        'directories. Defaults to {0}'.format(ROUND_ROBIN))
+    parser.add_argument('--placement-index', metavar='placement.json',
+                        dest='placement_index',
+                        help='File recording the directory of each file '
+                        'when downloading to several --dir directories. '
+                        'Defaults to the first directory')
+    parser.add_argument('--staging-dir', metavar='staging_dir',
+                        dest='staging_dir',
+                        help='Download and verify files in this (fast, local) '
+                        'directory, then move them to --dir in the background')
+    parser.add_argument('--migrate-workers', type=int, default=2,
+                        dest='migrate_workers',
+                        help='Number of files moved from --staging-dir '
+                        'to --dir at the same time')
     parser.add_argument('-s', '--server', metavar='server', type=str,
                         default=defaults.tcp_url,
-                        help='The TCP server address server[:port]')
+                        help='The TCP server address server[:port]. '
+                        'Several servers separated by commas, each '
+                        'optionally weighted as server=WEIGHT, share the '
+                        'download')
+    parser.add_argument('--server-failures', type=int,
+                        default=endpoints.FAILURE_THRESHOLD,
+                        dest='server_failures',
+                        help='Consecutive failures after which one of '
+                        'several servers is not used for a while')
+    parser.add_argument('--server-cooldown', type=float,
+                        default=endpoints.RESET_TIMEOUT,
+                        dest='server_cooldown',
+                        help='Seconds a failing server is not used for')
+    parser.add_argument('--source-address', metavar='ADDRESS[,ADDRESS...]',
+                        type=netbind.argparse_type, default=[],
+                        dest='source_address',
+                        help='Local addresses or interfaces the connections '
+                        'are bound to in turn, to spread the transfer '
+                        'across several NICs or addresses')
     parser.add_argument('--no-segment-md5sums', dest='segment_md5sums',
                         action='store_false',
                         help='Do not calculate inbound segment md5sums '
@@ -224,6 +555,11 @@ def config(parser):
     parser.add_argument('-n', '--n-processes', type=int,
                         default=defaults.processes,
                         help='Number of client connections.')
+    parser.add_argument('--download-engine', choices=ENGINES,
+                        default=PROCESSES, dest='download_engine',
+                        help='Download big files with parcel\'s pool of '
+                        'processes, or in byte ranges on threads of one '
+                        'process')
     parser.add_argument('--http-chunk-size', '-c', type=int,
                         default=const.HTTP_CHUNK_SIZE,
                         help='Size in bytes of standard HTTP block size.')
@@ -240,6 +576,36 @@ def config(parser):
     parser.add_argument('--no-annotations', action='store_false',
                         dest='download_annotations',
                         help='Do not download annotations.')
+    parser.add_argument('--preflight', choices=preflight.POLICIES,
+                        default=preflight.FAIL,
+                        help='Check the free space of --dir against the '
+                        'file sizes before downloading, and either fail or '
+                        'trim the download to what fits. Defaults to {0}'
+                        .format(preflight.FAIL))
+    parser.add_argument('--on-complete', metavar='CMD',
+                        dest='on_complete',
+                        help='Run CMD for each file as soon as it is '
+                        'verified, with its UUID, path, size and md5sum as '
+                        'arguments and as GDC_FILE_ID, GDC_FILE_PATH, '
+                        'GDC_FILE_SIZE and GDC_FILE_MD5SUM')
+    parser.add_argument('--hook-workers', type=int, default=2,
+                        dest='hook_workers',
+                        help='Number of --on-complete commands run '
+                        'at the same time')
+    parser.add_argument('--transfer-compression', action='store_true',
+                        dest='transfer_compression',
+                        help='Request gzip transfer for text files and '
+                        'groups and decompress them while downloading')
+    parser.add_argument('--keep-groups', action='store_true',
+                        dest='keep_groups',
+                        help='Keep grouped small files in their tarfile with '
+                        'an index instead of extracting them. '
+                        'See gdc-client extract')
+    parser.add_argument('--to-stdout', action='store_true',
+                        dest='to_stdout',
+                        help='Write the files to stdout as a single tar '
+                        'stream instead of to --dir, e.g. to pipe them '
+                        'into tar -x or another program')
     parser.add_argument('--no-auto-retry', action='store_true',
                         dest='no_auto_retry',
                         help='Ask before retrying to download a file')
@@ -270,11 +636,36 @@ def config(parser):
                         dest='external_proxy',
                         help='Do not create a local proxy but bind to an external one')
     '''
+    parser.add_argument('--plan-out', metavar='plan.json',
+                        dest='plan_out',
+                        help='Resolve the download plan, write it to a file '
+                        'and exit without downloading')
+    parser.add_argument('--plan-in', metavar='plan.json',
+                        dest='plan_in',
+                        help='Download a plan written by --plan-out '
+                        'without querying the index')
+    parser.add_argument('--range', metavar='START-END',
+                        type=parse_range, action='append',
+                        dest='ranges', default=[],
+                        help='Only download this byte range of each file '
+                        'using HTTP Range requests. May be repeated')
+    parser.add_argument('--ranges-file', metavar='ranges.txt',
+                        dest='ranges_file',
+                        help='Download the byte ranges listed per file id, '
+                        'one "file_id START-END [START-END ...]" per line')
+    parser.add_argument('--range-slices', action='store_true',
+                        dest='range_slices',
+                        help='Write each byte range to its own slice file '
+                        'instead of a sparse file')
     parser.add_argument('-m', '--manifest',
         type=manifest.argparse_type,
         default=[],
         help='GDC download manifest file',
     )
+    parser.add_argument('--manifest-metadata', action='store_true',
+                        dest='manifest_metadata',
+                        help='Take the size and md5sum of each file from '
+                        '--manifest instead of querying the index')
     parser.add_argument('file_ids',
         metavar='file_id',
         nargs='*',
@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+import threading
+
+
+log = logging.getLogger('gdc-download')
+
+ROUND_ROBIN = 'round-robin'
+LEAST_FULL = 'least-full'
+POLICIES = [ROUND_ROBIN, LEAST_FULL]
+
+INDEX_NAME = 'gdc-client-placement.json'
+
+
+def free_bytes(path):
+    # type: (str) -> long
+    """ Bytes available to the user on the filesystem holding path
+
+    Returns None where statvfs isn't available (Windows)
+    """
+
+    if not hasattr(os, 'statvfs'):
+        return None
+
+    stats = os.statvfs(path)
+    return long(stats.f_bavail) * stats.f_frsize
+
+
+class Placement(object):
+    """ Places the <uuid>/ directory of each file on one of several roots
+
+    Striping files across roots on different filesystems combines their
+    write bandwidth. A file stays on the root it was first placed on, and
+    every placement is recorded in a single index file so that the files
+    can be found (and resumed) later.
+    """
+
+    def __init__(self, roots, policy=ROUND_ROBIN, index_path=None):
+        self.roots = [ os.path.abspath(r) for r in roots ]
+        self.policy = policy
+        self.index_path = index_path or os.path.join(self.roots[0], INDEX_NAME)
+        self.lock = threading.Lock()
+        self.placed = dict()
+        self.i = 0
+
+        # bytes placed on a root that aren't written yet
+        self.pending = dict([ (r, 0) for r in self.roots ])
+        self.sizes = dict()
+
+        for r in self.roots:
+            if not os.path.isdir(r):
+                os.makedirs(r)
+
+        if policy == LEAST_FULL and not hasattr(os, 'statvfs'):
+            log.warning('Free space is unknown on this platform, '
+                        'placing files round-robin')
+            self.policy = ROUND_ROBIN
+
+        # keep files of a previous run where they are
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as f:
+                for file_id, directory in json.load(f).iteritems():
+                    self.placed[file_id] = os.path.dirname(directory)
+
+    def root(self, file_id, size=0):
+        # type: (str, long) -> str
+        """ The root the <uuid>/ directory of file_id belongs on """
+
+        with self.lock:
+            if file_id in self.placed:
+                return self.placed[file_id]
+
+            if self.policy == LEAST_FULL:
+                root = max(self.roots,
+                    key=lambda r: free_bytes(r) - self.pending[r])
+            else:
+                root = self.roots[self.i % len(self.roots)]
+                self.i += 1
+
+            self.placed[file_id] = root
+            self.pending[root] += size or 0
+            self.sizes[file_id] = size or 0
+
+            return root
+
+    def done(self, file_id):
+        # type: (str) -> None
+        """ The file is written, its root's free space accounts for it """
+
+        with self.lock:
+            if file_id in self.sizes:
+                self.pending[self.placed[file_id]] -= self.sizes.pop(file_id)
+
+    def release(self, file_id):
+        # type: (str) -> None
+        """ Forget the placement of a file that won't be downloaded after
+        all. Placements of a previous run are kept """
+
+        with self.lock:
+            if file_id in self.sizes:
+                self.pending[self.placed.pop(file_id)] -= self.sizes.pop(file_id)
+
+    def write_index(self):
+        # type: () -> None
+        """ Record where each UUID landed """
+
+        with self.lock:
+            index = dict([ (file_id, os.path.join(root, file_id))
+                for file_id, root in self.placed.iteritems() ])
+
+        with open(self.index_path, 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+
+        log.debug('Wrote placement of {0} files to {1}'.format(
+            len(index), self.index_path))
@@ -0,0 +1,110 @@
+import json
+import logging
+import time
+
+from gdc_client.version import __version__
+
+
+log = logging.getLogger('gdc-download')
+
+PLAN_VERSION = 1
+
+
+def build(index_client, client, bigs, smalls):
+    # type: (GDCIndexClient, GDCDownloadMixin, List[str], List[List[str]]) -> Dict
+    """ Build a serializable download plan
+
+    The plan records everything needed to execute a download without
+    querying the index again: the resolved small file groupings, the big
+    file list, the endpoints used and the metadata of every file.
+
+    Args:
+        index_client (GDCIndexClient): index client that resolved the plan
+        client (GDCDownloadMixin): download client the plan was built for
+        bigs (list): big file UUIDs
+        smalls (list): list of lists of grouped small file UUIDs
+
+    Returns:
+        dict: the download plan
+    """
+
+    groups = []
+    for group in smalls:
+        groups.append({
+            'ids': list(group),
+            'access': index_client.get_access(group[0]),
+            'bytes': sum([ index_client.get_filesize(g) or 0 for g in group ]),
+        })
+
+    files = dict()
+    for uuid in bigs + [ g for group in smalls for g in group ]:
+        if uuid in index_client.metadata:
+            files[uuid] = index_client.metadata[uuid]
+
+    return {
+        'version':      PLAN_VERSION,
+        'gdc_client':   __version__,
+        'created':      time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'server':       client.base_uri,
+        'data_uri':     client.data_uri,
+        'groups':       groups,
+        'bigs':         [ {
+            'id':    b,
+            'bytes': index_client.get_filesize(b),
+        } for b in bigs ],
+        'total_bytes':  sum([ g['bytes'] for g in groups ]) +
+                        sum([ index_client.get_filesize(b) or 0 for b in bigs ]),
+        'files':        files,
+    }
+
+
+def dump(plan, path):
+    # type: (Dict, str) -> None
+    """ Write a download plan to a json file """
+
+    with open(path, 'w') as f:
+        json.dump(plan, f, indent=2, sort_keys=True)
+
+    log.info('Wrote download plan for {0} groups and {1} big files to {2}'
+            .format(len(plan['groups']), len(plan['bigs']), path))
+
+
+def load(path, index_client):
+    # type: (str, GDCIndexClient) -> List[str], List[List[str]]
+    """ Load a download plan written by dump()
+
+    The file metadata stored in the plan is put into the index client so
+    that md5 checks, related files and annotations don't need to query the
+    API again.
+
+    Args:
+        path (str): path to the plan file
+        index_client (GDCIndexClient): index client to populate
+
+    Returns:
+        list: a list of big file UUIDs
+        list: a list of lists of UUIDs. Each inner list representing a
+            group of small files
+    """
+
+    with open(path, 'r') as f:
+        plan = json.load(f)
+
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError('Unsupported download plan version {0} in {1}'
+                .format(plan.get('version'), path))
+
+    if plan.get('server') and plan['server'] != index_client.uri:
+        log.debug('Plan was resolved against {0}, downloading from {1}'
+                .format(plan['server'], index_client.uri))
+
+    for uuid, meta in plan['files'].iteritems():
+        index_client.metadata.setdefault(uuid, meta)
+
+    bigs = [ b['id'] for b in plan['bigs'] ]
+    smalls = [ g['ids'] for g in plan['groups'] ]
+
+    log.debug('Loaded download plan with {0} groups and {1} big files'
+            .format(len(smalls), len(bigs)))
+
+    return bigs, smalls
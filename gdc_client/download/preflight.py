@@ -0,0 +1,256 @@
+import logging
+import os
+
+from gdc_client.download import archive
+from gdc_client.download.placement import free_bytes
+
+
+log = logging.getLogger('gdc-download')
+
+FAIL = 'fail'
+TRIM = 'trim'
+OFF = 'off'
+POLICIES = [FAIL, TRIM, OFF]
+
+
+def format_bytes(n):
+    # type: (long) -> str
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if abs(n) < 1024 or unit == 'TiB':
+            return '{0:.1f} {1}'.format(n, unit) if unit != 'B' \
+                else '{0} B'.format(n)
+        n /= 1024.0
+
+
+def filesystem(directory):
+    # type: (str) -> (int, long)
+    """ The device and free bytes of the filesystem holding directory,
+    free is None where statvfs isn't available
+    """
+
+    # the directory may not be created yet
+    d = os.path.abspath(directory)
+    while not os.path.isdir(d):
+        d = os.path.dirname(d)
+
+    return os.stat(d).st_dev, free_bytes(d)
+
+
+def filesystem_free(directories):
+    # type: (List[str]) -> long
+    """ Free bytes of the filesystems holding the directories, each
+    filesystem counted once. None where statvfs isn't available
+    """
+
+    free = dict()
+    for d in directories:
+        device, space = filesystem(d)
+        if space is None:
+            return None
+        free[device] = space
+
+    return sum(free.values())
+
+
+class Preflight(object):
+    """ Checks that the planned download fits on disk before transferring
+
+    The sizes come from the index (or the manifest or plan). Every file is
+    written once to the root it is placed on, and each filesystem has to
+    hold the files placed on its roots. Unless groups are kept, each group
+    tarfile also needs its own size next to the extracted files until it's
+    removed, and a staging directory needs to hold the largest files or
+    groups the migrator can hold back, one per worker, the one waiting and
+    the one downloading. Files already downloaded by a previous run,
+    related files and annotations aren't counted.
+    """
+
+    def __init__(self, index_client, roots, staging_directory=None,
+                 keep_groups=False, placement=None, migrate_workers=2):
+        self.index = index_client
+        self.roots = roots
+        self.staging_directory = staging_directory
+        self.migrate_workers = max(1, migrate_workers)
+        self.keep_groups = keep_groups
+        self.placement = placement
+
+    def _bytes(self, file_ids):
+        # type: (List[str]) -> long
+        return sum([ self.index.get_filesize(f) or 0 for f in file_ids ])
+
+    def _peak(self, smalls):
+        # type: (List[List[str]]) -> long
+        """ Bytes of the largest group tarfile while it's extracted """
+
+        if self.keep_groups or not smalls:
+            return 0
+        return max([ self._bytes(s) for s in smalls ])
+
+    def _completed(self, file_id):
+        # type: (str) -> bool
+        """ Whether a previous run left the whole file in one of the roots """
+
+        name = self.index.get_filename(file_id)
+        size = self.index.get_filesize(file_id)
+        if not name or size is None:
+            return False
+
+        for r in self.roots:
+            path = os.path.join(r, file_id, name)
+            if os.path.isfile(path) and os.path.getsize(path) == size:
+                return True
+        return False
+
+    def _root(self, name, size):
+        # type: (str, long) -> str
+        if self.placement:
+            return self.placement.root(name, size)
+        return os.path.abspath(self.roots[0])
+
+    def _names(self, file_ids, group):
+        # type: (List[str], bool) -> List[str]
+        """ What the files are placed as, a kept group is placed as a
+        single directory """
+
+        if group and self.keep_groups:
+            return [archive.group_name(file_ids)]
+        return file_ids
+
+    def _needs(self, file_ids, group, completed, devices):
+        # type: (List[str], bool, Set[str], Dict[str, int]) -> Dict[int, long]
+        """ Bytes the files not yet completed need on each filesystem once
+        placed """
+
+        remaining = [ f for f in file_ids if f not in completed ]
+        if not remaining:
+            return dict()
+
+        if group and self.keep_groups:
+            sizes = [ (self._names(file_ids, group)[0], self._bytes(remaining)) ]
+        else:
+            sizes = [ (f, self._bytes([f])) for f in remaining ]
+
+        needs = dict()
+        for name, size in sizes:
+            device = devices[self._root(name, size)]
+            needs[device] = needs.get(device, 0) + size
+        return needs
+
+    def check(self, bigs, smalls, trim=False):
+        # type: (List[str], List[List[str]], bool) -> (bool, List[str], List[List[str]], List[str])
+        """ Check the plan against the free space of the destinations
+
+        Files are placed on their roots as they're checked, the download
+        uses the same placement.
+
+        Args:
+            bigs (list): big file UUIDs
+            smalls (list): list of lists of grouped small file UUIDs
+            trim (bool): drop files from the end of the plan until it fits
+                instead of only reporting it
+
+        Returns:
+            tuple: whether the (trimmed) plan fits, the planned big files,
+                the planned groups and the UUIDs dropped to make it fit
+        """
+
+        planned = bigs + [ s for g in smalls for s in g ]
+
+        unknown = [ f for f in planned if self.index.get_filesize(f) is None ]
+        if unknown:
+            log.warning('Size of {0} files is unknown, they are not counted '
+                        'in the free space check'.format(len(unknown)))
+
+        completed = set([ f for f in planned if self._completed(f) ])
+        if completed:
+            log.debug('{0} files are already downloaded, they are not '
+                      'counted in the free space check'.format(len(completed)))
+
+        # the roots of each filesystem and its free bytes
+        roots = [ os.path.abspath(r) for r in self.roots ]
+        devices, free, names = dict(), dict(), dict()
+        for r in roots:
+            device, space = filesystem(r)
+            if space is None:
+                log.debug('Free space is unknown on this platform, '
+                          'skipping the free space check')
+                return True, bigs, smalls, []
+            devices[r] = device
+            free[device] = space
+            names.setdefault(device, []).append(r)
+
+        remaining = lambda file_ids: [ f for f in file_ids if f not in completed ]
+        small_groups = [ remaining(s) for s in smalls if remaining(s) ]
+
+        if self.staging_directory:
+            # what is being moved, waiting to be moved and downloading, with
+            # the tarfile of a group while it's extracted
+            sizes = sorted([ self._bytes([b]) for b in remaining(bigs) ] +
+                           [ self._bytes(s) for s in small_groups ],
+                           reverse=True)
+            staged = sum(sizes[:self.migrate_workers + 2]) + \
+                self._peak(small_groups)
+            staging_free = filesystem_free([self.staging_directory])
+            if staging_free is None:
+                log.debug('Free space of {0} is unknown, skipping its '
+                          'check'.format(self.staging_directory))
+            elif staged > staging_free:
+                log.error('{0} needs {1} free for the files waiting to be '
+                          'moved, {2} available'.format(self.staging_directory,
+                              format_bytes(staged), format_bytes(staging_free)))
+                return False, bigs, smalls, []
+
+        # the group tarfiles land in the first root, or the staging directory
+        needed = dict([ (d, 0) for d in free ])
+        if not self.staging_directory:
+            needed[devices[roots[0]]] += self._peak(small_groups)
+
+        # smalls before bigs, the order they're downloaded in
+        units = [ (s, True) for s in smalls ] + [ ([b], False) for b in bigs ]
+        units = [ (file_ids, group,
+                   self._needs(file_ids, group, completed, devices))
+                  for file_ids, group in units ]
+
+        total = dict(needed)
+        for _, _, needs in units:
+            for d, n in needs.iteritems():
+                total[d] += n
+
+        full = [ d for d in total if total[d] > free[d] ]
+        for d in sorted(total):
+            log.debug('Download needs {0} of {1} free in {2}'.format(
+                format_bytes(total[d]), format_bytes(free[d]),
+                os.pathsep.join(names[d])))
+
+        if not full:
+            return True, bigs, smalls, []
+
+        for d in full:
+            log.error('Download needs {0} but only {1} is free in {2}'.format(
+                format_bytes(total[d]), format_bytes(free[d]),
+                os.pathsep.join(names[d])))
+
+        if not trim:
+            return False, bigs, smalls, []
+
+        # keep the plan in order, skipping what doesn't fit anymore
+        kept_smalls, kept_bigs, dropped = [], [], []
+        for file_ids, group, needs in units:
+            if all([ needed[d] + n <= free[d] for d, n in needs.iteritems() ]):
+                for d, n in needs.iteritems():
+                    needed[d] += n
+                if group:
+                    kept_smalls.append(file_ids)
+                else:
+                    kept_bigs += file_ids
+                continue
+
+            dropped += file_ids
+            if self.placement:
+                for name in self._names(file_ids, group):
+                    self.placement.release(name)
+
+        log.warning('Skipping {0} files ({1}) that do not fit'.format(
+            len(dropped), format_bytes(self._bytes(dropped))))
+
+        return True, kept_bigs, kept_smalls, dropped
@@ -0,0 +1,94 @@
+import hashlib
+import logging
+import os
+import platform
+import sys
+import tarfile
+import threading
+import time
+
+
+log = logging.getLogger('gdc-download')
+
+
+class VerifyingReader(object):
+    """ Reads exactly size bytes from a source while hashing them
+
+    A tar stream can't be taken back once a member header is written, so a
+    source that ends early is padded with zeros and marked truncated
+    instead of breaking the stream.
+    """
+
+    def __init__(self, source, size):
+        self.source = source
+        self.remaining = size
+        self.md5 = hashlib.md5()
+        self.truncated = False
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        data = ''
+        while len(data) < size and not self.truncated:
+            chunk = self.source.read(size - len(data))
+            if not chunk:
+                self.truncated = True
+                break
+            data += chunk
+
+        self.md5.update(data)
+        self.remaining -= size
+
+        return data + '\0' * (size - len(data))
+
+
+class TarStream(object):
+    """ Writes downloaded files as members of a single tar stream """
+
+    def __init__(self, fileobj=None):
+        if fileobj is None:
+            fileobj = sys.stdout
+            if platform.system() == 'Windows':
+                import msvcrt
+                msvcrt.setmode(fileobj.fileno(), os.O_BINARY)
+
+        self.tar = tarfile.open(fileobj=fileobj, mode='w|')
+        self.lock = threading.Lock()
+
+    def add(self, name, size, source, md5sum=None):
+        # type: (str, long, file, str) -> bool
+        """ Stream size bytes of source as the member name
+
+        Returns whether the member is complete and matches md5sum
+        """
+
+        info = tarfile.TarInfo(name=name)
+        info.size = size
+        info.mtime = time.time()
+        info.mode = 0644
+
+        reader = VerifyingReader(source, size)
+        with self.lock:
+            self.tar.addfile(info, reader)
+
+        if reader.truncated:
+            log.error('{0} ended before {1} bytes'.format(name, size))
+            return False
+
+        if md5sum and md5sum != reader.md5.hexdigest():
+            log.error('{0} has invalid md5sum'.format(name))
+            return False
+
+        return True
+
+    def close(self):
+        self.tar.close()
+
+
+def redirect_logging(stream=sys.stderr):
+    # type: (file) -> None
+    """ Move the log output off stdout when stdout carries the data """
+
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler) and \
+           getattr(handler, 'stream', None) is sys.stdout:
+            handler.stream = stream
@@ -0,0 +1,53 @@
+from functools import partial
+from gdc_client.download import archive
+
+import logging
+import os
+
+
+log = logging.getLogger('gdc-extract')
+
+def extract(parser, args):
+    """ Extract files from the groups kept by download --keep-groups.
+    """
+
+    directories = args.dir.split(os.pathsep)
+    archives = archive.load_archives(directories)
+
+    file_ids = args.file_ids or archives.keys()
+    if not file_ids:
+        log.error('No kept groups found in {0}'.format(', '.join(directories)))
+
+    errors = []
+    for file_id in file_ids:
+        if file_id not in archives:
+            log.error('{0} is not in a kept group'.format(file_id))
+            errors.append(file_id)
+            continue
+
+        path = archives[file_id].extract(file_id, args.output_dir)
+        log.debug('Extracted {0} to {1}'.format(file_id, path))
+
+    log.info('Extracted: {0}'.format(len(file_ids) - len(errors)))
+
+    return errors
+
+def config(parser):
+    """ Configure a parser for extract.
+    """
+    func = partial(extract, parser)
+    parser.set_defaults(func=func)
+
+    parser.add_argument('-d', '--dir', default='.',
+                        help='Directory the groups were downloaded to. '
+                        'Defaults to current dir. Several directories '
+                        'are separated by {0}'.format(os.pathsep))
+    parser.add_argument('-o', '--output-dir', default='.',
+                        dest='output_dir',
+                        help='Directory to extract files to. '
+                        'Defaults to current dir')
+    parser.add_argument('file_ids',
+        metavar='file_id',
+        nargs='*',
+        help='The GDC UUID of the file(s) to extract. Defaults to all files',
+    )
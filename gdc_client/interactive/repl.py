@@ -88,7 +88,8 @@ class GDCREPL(Cmd):
             http_chunk_size=const.HTTP_CHUNK_SIZE,
             download_related_files=True,
             download_annotations=True,
-            part_size=defaults.HTTP_CHUNK_SIZE,
+            # chosen per file
+            part_size=0,
             multipart=True,
             verify=True,
         )
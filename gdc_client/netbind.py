@@ -0,0 +1,119 @@
+###############################################################################
+# Local source addresses for outgoing connections
+#
+# Transfer nodes often have several NICs or addresses, and per-flow rate
+# limits on the path cap each connection. Binding new connections round-robin
+# to several local addresses spreads the flows, so the aggregate throughput
+# can exceed what a single address gets.
+#
+# Every connection made through requests (grouped downloads, parcel streams,
+# upload parts) is created by urllib3's create_connection, which is wrapped
+# here for the whole process. Forked upload workers inherit it.
+###############################################################################
+
+import argparse
+import itertools
+import logging
+import platform
+import socket
+import struct
+import threading
+
+
+log = logging.getLogger('netbind')
+
+SIOCGIFADDR = 0x8915
+
+_original = dict()
+_lock = threading.Lock()
+
+
+def _connection_modules():
+    modules = []
+    try:
+        from urllib3.util import connection
+        modules.append(connection)
+    except ImportError:
+        pass
+
+    try:
+        # older requests vendor their own copy
+        from requests.packages.urllib3.util import connection
+        if connection not in modules:
+            modules.append(connection)
+    except ImportError:
+        pass
+
+    return modules
+
+
+def resolve(address):
+    # type: (str) -> str
+    """ The IP address of an address or (on Linux) interface name """
+
+    for family in [socket.AF_INET, socket.AF_INET6]:
+        try:
+            socket.inet_pton(family, address)
+            return address
+        except (socket.error, ValueError):
+            pass
+
+    if platform.system() == 'Linux':
+        import fcntl
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR,
+                                struct.pack('256s', address[:15]))
+            return socket.inet_ntoa(ifreq[20:24])
+        except IOError:
+            pass
+        finally:
+            s.close()
+
+    raise ValueError('{0} is not a local address or interface'.format(address))
+
+
+def bind_source_addresses(addresses):
+    # type: (List[str]) -> None
+    """ Bind new connections to the addresses in turn, or stop binding them
+    if the list is empty
+
+    Connections that ask for a source address of their own keep it.
+    """
+
+    with _lock:
+        for module in _connection_modules():
+            original = _original.setdefault(module, module.create_connection)
+
+            if not addresses:
+                module.create_connection = original
+                continue
+
+            module.create_connection = _rotating(original, addresses)
+
+    if addresses:
+        log.debug('Binding connections to {0}'.format(', '.join(addresses)))
+
+
+def _rotating(create_connection, addresses):
+    sources = itertools.cycle([ (a, 0) for a in addresses ])
+    lock = threading.Lock()
+
+    def rotating_create_connection(address, *args, **kwargs):
+        if len(args) < 2 and kwargs.get('source_address') is None:
+            with lock:
+                kwargs['source_address'] = next(sources)
+
+        return create_connection(address, *args, **kwargs)
+
+    return rotating_create_connection
+
+
+def argparse_type(value):
+    # type: (str) -> List[str]
+    """ Parse a comma separated list of local addresses or interfaces """
+
+    try:
+        return [ resolve(a.strip()) for a in value.split(',') if a.strip() ]
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
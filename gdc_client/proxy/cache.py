@@ -0,0 +1,172 @@
+from contextlib import contextmanager
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+log = logging.getLogger('gdc-proxy')
+
+METADATA_SUFFIX = '.json'
+PARTIAL_SUFFIX = '.partial'
+
+
+class DiskCache(object):
+    """ Size bounded cache of whole data files on disk
+
+    Each file is stored as <cache_dir>/<namespace>/<uuid> with its metadata
+    next to it in <uuid>.json. Files are evicted least recently used first
+    once the cache grows past max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.key_locks = dict()
+
+        # key: [size, last used]
+        self.entries = dict()
+        self.total = 0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self._load()
+
+    def _load(self):
+        """ Pick up the files cached by a previous run """
+
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith(PARTIAL_SUFFIX):
+                    os.remove(path)
+                    continue
+
+                if name.endswith(METADATA_SUFFIX) or \
+                   not os.path.isfile(path + METADATA_SUFFIX):
+                    continue
+
+                key = os.path.relpath(path, self.directory)
+                stat = os.stat(path)
+                self.entries[key] = [stat.st_size, stat.st_atime]
+                self.total += stat.st_size
+
+        log.debug('Loaded {0} cached files, {1} bytes'.format(
+            len(self.entries), self.total))
+
+    def path(self, key):
+        # type: (str) -> str
+        path = os.path.normpath(os.path.join(self.directory, key))
+        if not path.startswith(self.directory + os.sep):
+            raise ValueError('Invalid cache key {0}'.format(key))
+        return path
+
+    @contextmanager
+    def key_lock(self, key):
+        # type: (str) -> None
+        """ Lock held while a file is fetched, so it's fetched only once.
+        It's dropped once no request is waiting on it """
+
+        with self.lock:
+            entry = self.key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.key_locks[key]
+
+    def get(self, key):
+        # type: (str) -> Dict
+        """ The metadata of a cached file, or None if it isn't cached """
+
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries[key][1] = time.time()
+
+        try:
+            with open(self.path(key) + METADATA_SUFFIX, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def put(self, key, source, metadata, size=None, md5sum=None,
+            chunk_size=1024 * 1024):
+        # type: (str, file, Dict, long, str, int) -> Dict
+        """ Write a file read from source to the cache
+
+        The file isn't cached if it doesn't have the size or md5sum given,
+        an IOError is raised instead.
+
+        Returns the metadata, with the size of the file
+        """
+
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        written = 0
+        md5 = hashlib.md5()
+        try:
+            with open(path + PARTIAL_SUFFIX, 'wb') as f:
+                for chunk in iter(lambda: source.read(chunk_size), ''):
+                    f.write(chunk)
+                    md5.update(chunk)
+                    written += len(chunk)
+
+            if size is not None and written != size:
+                raise IOError('{0} is {1} bytes, expected {2}'.format(
+                    key, written, size))
+            if md5sum and md5.hexdigest() != md5sum:
+                raise IOError('{0} has invalid md5sum'.format(key))
+
+        except Exception:
+            if os.path.exists(path + PARTIAL_SUFFIX):
+                os.remove(path + PARTIAL_SUFFIX)
+            raise
+
+        size = written
+        metadata['size'] = size
+        with open(path + METADATA_SUFFIX, 'w') as f:
+            json.dump(metadata, f)
+        os.rename(path + PARTIAL_SUFFIX, path)
+
+        with self.lock:
+            if key in self.entries:
+                self.total -= self.entries[key][0]
+            self.entries[key] = [size, time.time()]
+            self.total += size
+
+        self.evict(keep=key)
+        return metadata
+
+    def evict(self, keep=None):
+        # type: (str) -> None
+        """ Remove the least recently used files until the cache fits """
+
+        with self.lock:
+            lru = sorted(self.entries.items(), key=lambda e: e[1][1])
+            while self.total > self.max_bytes and lru:
+                key, (size, _) = lru.pop(0)
+                if key == keep:
+                    continue
+
+                del self.entries[key]
+                self.total -= size
+
+                # readers that have it open keep reading it
+                for p in [self.path(key), self.path(key) + METADATA_SUFFIX]:
+                    if os.path.exists(p):
+                        os.remove(p)
+
+                log.debug('Evicted {0} ({1} bytes)'.format(key, size))
@@ -0,0 +1,46 @@
+from functools import partial
+from gdc_client import defaults
+from gdc_client.proxy import server
+
+import logging
+
+
+log = logging.getLogger('gdc-proxy')
+
+GIB = 1024 ** 3
+
+def proxy(parser, args):
+    """ Serve the GDC API data and index endpoints from a local disk cache.
+    """
+
+    server.serve(
+            args.host,
+            args.port,
+            args.server,
+            args.cache_dir,
+            long(args.cache_size * GIB),
+            verify=not args.no_verify)
+
+def config(parser):
+    """ Configure a parser for proxy.
+    """
+    func = partial(proxy, parser)
+    parser.set_defaults(func=func)
+
+    parser.add_argument('--cache-dir', required=True,
+                        dest='cache_dir',
+                        help='Directory the downloaded files are cached in')
+    parser.add_argument('--cache-size', type=float, default=100,
+                        dest='cache_size',
+                        help='Size of the cache in GiB, the least recently '
+                        'used files are removed past it. Defaults to 100')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on. Use 0.0.0.0 to serve '
+                        'other nodes. Defaults to 127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port to listen on. Defaults to 8080')
+    parser.add_argument('-s', '--server', metavar='server', type=str,
+                        default=defaults.tcp_url,
+                        help='The upstream GDC API address server[:port]')
+    parser.add_argument('--no-verify', dest='no_verify', action='store_true',
+                        help='Perform insecure SSL connection to the server')
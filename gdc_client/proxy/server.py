@@ -0,0 +1,455 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from gdc_client.download.client import make_session
+from gdc_client.proxy.cache import DiskCache
+from gdc_client.version import __version__
+
+import hashlib
+import json
+import logging
+import re
+import requests
+import tarfile
+import threading
+import time
+import urlparse
+
+
+log = logging.getLogger('gdc-proxy')
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# how long an index query or a token's access to a cached file is reused
+METADATA_TTL = 300
+AUTHORIZATION_TTL = 300
+
+# times a file evicted while it's about to be served is fetched again
+FETCH_ATTEMPTS = 3
+
+# response headers passed through from upstream
+FORWARDED_HEADERS = [
+    'Content-Type',
+    'Content-Disposition',
+    'Content-Length',
+    'Content-Range',
+    'Content-Encoding',
+    'Accept-Ranges',
+]
+
+RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+# only files named by a UUID are cached, the id names the file on disk
+UUID = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                  r'[0-9a-f]{12}$', re.IGNORECASE)
+
+
+class ProxyServer(ThreadingMixIn, HTTPServer):
+    """ Caching proxy in front of the GDC API for the download client
+
+    Whole data files are cached on disk and shared by every client of the
+    proxy, so that each file crosses the WAN once. Groups (data?tarfile) are
+    assembled from the cached files. Index queries (files) are cached for a
+    few minutes and everything else is forwarded as is.
+
+    The X-Auth-Token of each request is passed upstream. A cached file that
+    was fetched with a token is only served to a token that upstream still
+    accepts for that file.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, upstream, cache_dir, cache_size,
+                 verify=True, n_procs=8):
+        HTTPServer.__init__(self, address, ProxyHandler)
+        self.upstream = upstream if upstream.endswith('/') else upstream + '/'
+        self.cache = DiskCache(cache_dir, cache_size)
+        self.session = make_session(n_procs)
+        self.verify = verify
+
+        self.lock = threading.Lock()
+        self.metadata = dict()
+        self.authorized = dict()
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+
+    server_version = 'gdc-client-proxy/{0}'.format(__version__)
+
+    def log_message(self, format, *args):
+        log.debug('{0} - {1}'.format(self.client_address[0], format % args))
+
+    @property
+    def token(self):
+        return self.headers.getheader('X-Auth-Token')
+
+    def _route(self):
+        # type: () -> Tuple[str, str, str]
+        """ Split the request into namespace, endpoint and query
+
+        /v0/legacy/data/<uuid>?q is ('legacy/', 'data/<uuid>', 'q')
+        """
+
+        path, _, query = self.path.partition('?')
+        path = path.lstrip('/')
+        if path.startswith('v0/'):
+            path = path[len('v0/'):]
+
+        namespace = ''
+        if path.startswith('legacy/'):
+            namespace, path = 'legacy/', path[len('legacy/'):]
+
+        return namespace, path, query
+
+    def do_GET(self):
+        namespace, path, query = self._route()
+        file_id = path[len('data/'):] if path.startswith('data/') else None
+
+        # annotations and several ids are asked for as compressed tarfiles
+        if file_id and not query and UUID.match(file_id):
+            return self._serve_file(namespace, file_id)
+
+        self._forward()
+
+    def do_POST(self):
+        namespace, path, query = self._route()
+        body = self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+
+        if path == 'data' and query in ['tarfile', 'compress']:
+            try:
+                ids = json.loads(body)['ids']
+            except (ValueError, KeyError, TypeError):
+                return self._error(400, 'Expected {"ids": [...]}')
+            if not all([ isinstance(i, basestring) and UUID.match(i)
+                         for i in ids ]):
+                return self._error(400, 'Expected UUIDs')
+            return self._serve_group(namespace, ids, query == 'compress')
+
+        if path == 'files':
+            return self._forward(body, cache=True)
+
+        self._forward(body)
+
+    #############################################################
+    #                       Upstream
+    #############################################################
+
+    def _forward(self, body=None, cache=False):
+        """ Pass the request upstream and the response back """
+
+        # the response is only replayed to the same token
+        key = (self.command, self.path, body, self._token_hash())
+        if cache:
+            with self.server.lock:
+                cached = self.server.metadata.get(key)
+            if cached and time.time() - cached[0] < METADATA_TTL:
+                return self._respond(*cached[1:])
+
+        headers = dict([ (h, self.headers.getheader(h))
+            for h in ['X-Auth-Token', 'Content-Type', 'Range', 'Accept-Encoding']
+            if self.headers.getheader(h) ])
+
+        try:
+            r = self.server.session.request(
+                    self.command,
+                    urlparse.urljoin(self.server.upstream, self.path.lstrip('/')),
+                    data=body,
+                    headers=headers,
+                    stream=True,
+                    verify=self.server.verify)
+        except Exception as e:
+            log.error('Unable to reach {0}: {1}'.format(self.server.upstream, e))
+            return self._error(502, str(e))
+
+        response_headers = [ (h, r.headers[h])
+                for h in FORWARDED_HEADERS if h in r.headers ]
+
+        if cache and r.status_code == requests.codes.ok:
+            content = r.raw.read(decode_content=False)
+            with self.server.lock:
+                self.server.metadata[key] = (
+                    time.time(), r.status_code, response_headers, content)
+            return self._respond(r.status_code, response_headers, content)
+
+        self._respond(r.status_code, response_headers)
+        while True:
+            chunk = r.raw.read(COPY_CHUNK_SIZE, decode_content=False)
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+        r.close()
+
+    def _fetch(self, namespace, file_id):
+        # type: (str, str) -> Tuple[Dict, requests.Response]
+        """ The metadata of a cached file, fetching it on a miss
+
+        Returns the metadata, or the upstream response if it failed
+        """
+
+        key = namespace + file_id
+        metadata = self.server.cache.get(key)
+        if metadata:
+            return metadata, None
+
+        with self.server.cache.key_lock(key):
+            # fetched by another request while this one waited
+            metadata = self.server.cache.get(key)
+            if metadata:
+                return metadata, None
+
+            headers = {'Accept-Encoding': 'identity'}
+            if self.token:
+                headers['X-Auth-Token'] = self.token
+
+            r = self.server.session.get(
+                    urlparse.urljoin(self.server.upstream,
+                                     '{0}data/{1}'.format(namespace, file_id)),
+                    headers=headers,
+                    stream=True,
+                    verify=self.server.verify)
+
+            if r.status_code != requests.codes.ok:
+                return None, r
+
+            content_filename = r.headers.get('Content-Disposition') or ''
+            filename = content_filename.split('=')[-1] or file_id
+
+            # a response cut short or corrupted isn't cached
+            size = r.headers.get('Content-Length')
+
+            log.info('Caching {0}{1}'.format(namespace, file_id))
+            try:
+                md5sum = self._md5sum(namespace, file_id)
+                if not md5sum:
+                    raise IOError('No md5sum of {0} to check it against'
+                                  .format(file_id))
+                metadata = self.server.cache.put(key, r.raw, {
+                    'file_name': filename,
+                    'content_type': r.headers.get('Content-Type',
+                                                  'application/octet-stream'),
+                    # controlled files are only served to accepted tokens
+                    'authenticated': self.token is not None,
+                }, size=long(size) if size else None, md5sum=md5sum)
+            finally:
+                r.close()
+
+            self._remember_authorized(key)
+            return metadata, None
+
+    def _md5sum(self, namespace, file_id):
+        # type: (str, str) -> str
+        """ The md5sum the index has for a file """
+
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['X-Auth-Token'] = self.token
+
+        r = self.server.session.post(
+                urlparse.urljoin(self.server.upstream,
+                                 '{0}files'.format(namespace)),
+                data=json.dumps({
+                    'fields': 'file_id,md5sum',
+                    'filters': json.dumps({
+                        'op': 'in',
+                        'content': [{
+                            'op': 'in',
+                            'content': {
+                                'field': 'files.file_id',
+                                'value': [file_id],
+                            },
+                        }],
+                    }),
+                    'size': '1',
+                }),
+                headers=headers,
+                verify=self.server.verify)
+        if r.status_code != requests.codes.ok:
+            return None
+
+        hits = r.json()['data']['hits']
+        return hits[0].get('md5sum') if hits else None
+
+    def _remember_authorized(self, key):
+        if self.token:
+            with self.server.lock:
+                self.server.authorized[(self._token_hash(), key)] = time.time()
+
+    def _token_hash(self):
+        return hashlib.sha256(self.token or '').hexdigest()
+
+    def _authorize(self, namespace, file_id, metadata):
+        # type: (str, str, Dict) -> requests.Response
+        """ Check a token against upstream before serving a cached file
+        that was fetched with a token
+
+        Returns the upstream response if the token isn't accepted
+        """
+
+        if not metadata.get('authenticated'):
+            return None
+
+        key = namespace + file_id
+        with self.server.lock:
+            checked = self.server.authorized.get((self._token_hash(), key))
+        if checked and time.time() - checked < AUTHORIZATION_TTL:
+            return None
+
+        headers = {'Range': 'bytes=0-0', 'Accept-Encoding': 'identity'}
+        if self.token:
+            headers['X-Auth-Token'] = self.token
+
+        r = self.server.session.get(
+                urlparse.urljoin(self.server.upstream,
+                                 '{0}data/{1}'.format(namespace, file_id)),
+                headers=headers,
+                stream=True,
+                verify=self.server.verify)
+        r.close()
+
+        if r.status_code not in [requests.codes.ok, requests.codes.partial]:
+            return r
+
+        self._remember_authorized(key)
+        return None
+
+    #############################################################
+    #                     Cached responses
+    #############################################################
+
+    def _serve_file(self, namespace, file_id):
+        for _ in range(FETCH_ATTEMPTS):
+            try:
+                metadata, failed = self._fetch(namespace, file_id)
+                failed = failed or self._authorize(namespace, file_id, metadata)
+            except Exception as e:
+                log.error('Unable to fetch {0}: {1}'.format(file_id, e))
+                return self._error(502, str(e))
+
+            if failed is not None:
+                return self._respond(failed.status_code, [], failed.content)
+
+            try:
+                f = open(self.server.cache.path(namespace + file_id), 'rb')
+                break
+            except IOError:
+                # evicted since, fetch it again
+                continue
+        else:
+            return self._error(503, '{0} was evicted from the cache before '
+                               'it could be served'.format(file_id))
+
+        size = metadata['size']
+        start, end = 0, size - 1
+        status = requests.codes.ok
+        headers = [
+            ('Content-Type', metadata['content_type']),
+            ('Content-Disposition',
+             'attachment; filename={0}'.format(metadata['file_name'])),
+            ('Accept-Ranges', 'bytes'),
+        ]
+
+        byte_range = RANGE.match(self.headers.getheader('Range') or '')
+        if byte_range and size:
+            first, last = byte_range.groups()
+            if first:
+                start, end = int(first), min(int(last or end), end)
+            elif last:
+                start = max(0, size - int(last))
+
+            if start > end:
+                f.close()
+                return self._respond(416,
+                    [('Content-Range', 'bytes */{0}'.format(size))], '')
+
+            status = requests.codes.partial
+            headers.append(('Content-Range',
+                            'bytes {0}-{1}/{2}'.format(start, end, size)))
+
+        headers.append(('Content-Length', str(end - start + 1)))
+        self._respond(status, headers)
+
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+        f.close()
+
+    def _serve_group(self, namespace, ids, compress=False):
+        """ Assemble a group tarfile of <uuid>/<file_name> members from the
+        cache, fetching the files that aren't cached yet """
+
+        members = []
+        try:
+            for file_id in ids:
+                metadata, failed = self._fetch(namespace, file_id)
+                failed = failed or self._authorize(namespace, file_id, metadata)
+                if failed is not None:
+                    # the API fails the whole group too
+                    for _, f in members:
+                        f.close()
+                    return self._respond(failed.status_code, [], failed.content)
+
+                # opened now, so that an eviction can't take it away
+                members.append((
+                    tarfile.TarInfo('{0}/{1}'.format(file_id, metadata['file_name'])),
+                    open(self.server.cache.path(namespace + file_id), 'rb')))
+                members[-1][0].size = metadata['size']
+
+        except Exception as e:
+            log.error('Unable to fetch group: {0}'.format(e))
+            for _, f in members:
+                f.close()
+            return self._error(502, str(e))
+
+        name = time.strftime('gdc_download_%Y%m%d_%H%M%S.tar')
+        self._respond(requests.codes.ok, [
+            ('Content-Type', 'application/x-tar'),
+            ('Content-Disposition', 'attachment; filename={0}{1}'.format(
+                name, '.gz' if compress else '')),
+        ])
+
+        t = tarfile.open(fileobj=self.wfile, mode='w|gz' if compress else 'w|')
+        for info, f in members:
+            info.mtime = time.time()
+            info.mode = 0644
+            t.addfile(info, f)
+            f.close()
+        t.close()
+
+    #############################################################
+    #                        Responses
+    #############################################################
+
+    def _respond(self, status, headers, content=None):
+        self.send_response(status)
+        for header, value in headers:
+            if content is not None and header == 'Content-Length':
+                continue
+            self.send_header(header, value)
+        if content is not None:
+            self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+        if content is not None:
+            self.wfile.write(content)
+
+    def _error(self, status, message):
+        self._respond(status, [('Content-Type', 'application/json')],
+                      json.dumps({'message': message}))
+
+
+def serve(host, port, upstream, cache_dir, cache_size, verify=True):
+    # type: (str, int, str, str, long, bool) -> None
+    server = ProxyServer(
+            (host, port), upstream, cache_dir, cache_size, verify=verify)
+
+    log.info('Proxying {0} on {1}:{2}, caching in {3}'.format(
+        upstream, host, server.server_address[1], cache_dir))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
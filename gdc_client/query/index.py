@@ -1,20 +1,71 @@
 from urlparse import urljoin
 
+import copy
 import logging
 import requests
+import threading
+import time
 from json import dumps
 
 
 log = logging.getLogger('query')
 
+METADATA_FIELDS = 'file_id,file_name,file_size,md5sum,annotations.annotation_id,' \
+                  'metadata_files.file_id,index_files.file_id,access'
+
+# what a GDC download manifest doesn't already carry
+MANIFEST_MISSING_FIELDS = 'file_id,annotations.annotation_id,' \
+                          'metadata_files.file_id,index_files.file_id,access'
+
+# how long metadata shared between index clients is reused
+METADATA_CACHE_TTL = 600
+
+class MetadataCache(object):
+    """ File metadata shared by the index clients of a long running
+    process, such as gdc-client serve, so that jobs asking for the same
+    files don't query them again """
+
+    def __init__(self, ttl=METADATA_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (uri, file_id): (time, metadata)
+        self.entries = dict()
+
+    def get(self, uri, uuids):
+        # type: (str, List[str]) -> Dict[str, Dict]
+        """ The fresh metadata of the UUIDs that are cached """
+
+        now = time.time()
+        with self.lock:
+            found = dict()
+            for uuid in uuids:
+                entry = self.entries.get((uri, uuid))
+                if entry and now - entry[0] < self.ttl:
+                    found[uuid] = copy.deepcopy(entry[1])
+            return found
+
+    def update(self, uri, metadata):
+        # type: (str, Dict[str, Dict]) -> None
+        now = time.time()
+        with self.lock:
+            for uuid, m in metadata.iteritems():
+                self.entries[(uri, uuid)] = (now, copy.deepcopy(m))
+
 class GDCIndexClient(object):
 
+    # shared by every index client if set, see MetadataCache
+    cache = None
+
     def __init__(self, uri):
         self.uri = uri
         self.active_meta_endpoint = '/v0/files'
         self.legacy_meta_endpoint = '/v0/legacy/files'
         self.metadata = dict()
 
+        # UUIDs whose size and md5sum came from a manifest, but whose
+        # access, related files and annotations haven't been queried yet
+        self.manifest_ids = set()
+
     def get_related_files(self, uuid):
         # type: str -> List[str]
         if uuid in self.metadata.keys():
@@ -42,6 +93,11 @@ class GDCIndexClient(object):
         if uuid in self.metadata.keys():
             return self.metadata[uuid]['access']
 
+    def get_filename(self, uuid):
+        # type: str -> str
+        if uuid in self.metadata.keys():
+            return self.metadata[uuid].get('file_name')
+
     def _get_hits(self, url, metadata_query):
         """
         Get hits metadata from a given API endpoint
@@ -71,13 +127,50 @@ class GDCIndexClient(object):
 
         return json_response['data']['hits']
 
-    def _get_metadata(self, uuids):
+    def load_manifest(self, manifest):
+        """
+        Seed the metadata with the columns of a GDC download manifest so
+        that file sizes and md5sums don't need to be queried from the API.
+
+        Args:
+            manifest (list): rows of a parsed GDC download manifest
+                (id, filename, md5, size, state)
+
+        Return:
+            set: UUIDs that were seeded from the manifest
+        """
+
+        seeded = set()
+        for row in manifest:
+            if not row.get('id') or not row.get('md5') or not row.get('size'):
+                continue
+
+            if row['id'] not in self.metadata:
+                # access, related files and annotations are not part of the
+                # manifest and are filled in by _get_metadata if needed
+                self.metadata[row['id']] = {
+                    'access':        None,
+                    'file_name':     row.get('filename'),
+                    'file_size':     long(row['size']),
+                    'md5sum':        row['md5'],
+                    'annotations':   [],
+                    'related_files': [],
+                }
+                self.manifest_ids.add(row['id'])
+            seeded.add(row['id'])
+
+        log.debug('Loaded metadata of {0} files from manifest'.format(len(seeded)))
+        return seeded
+
+    def _get_metadata(self, uuids, fields=None):
         """
         Capture the metadata of all the UUIDs while making as little open
         connections as possible.
 
         Args:
             uuids (list): A list of UUIDs of the files
+            fields (str): Fields to query, defaults to all the fields
+                stored in the metadata
 
         Return:
             dict: metadata information
@@ -85,6 +178,7 @@ class GDCIndexClient(object):
             self.metadata = {
                 str file_id: {
                     str       access
+                    str       file_name
                     str       file_size
                     str       md5sum
                     List[str] annotations
@@ -93,6 +187,17 @@ class GDCIndexClient(object):
             }
         """
 
+        if self.cache is not None:
+            cached = self.cache.get(self.uri, uuids)
+            for uuid, m in cached.iteritems():
+                if uuid in self.manifest_ids:
+                    self.manifest_ids.discard(uuid)
+                self.metadata[uuid] = m
+
+            uuids = [ u for u in uuids if u not in cached ]
+            if not uuids:
+                return self.metadata
+
         filters = {
             'op': 'and',
             'content': [{
@@ -106,8 +211,7 @@ class GDCIndexClient(object):
         }
 
         metadata_query = {
-            'fields': 'file_id,file_size,md5sum,annotations.annotation_id,' \
-                      'metadata_files.file_id,index_files.file_id,access',
+            'fields': fields or METADATA_FIELDS,
             'filters': dumps(filters),
             'from': '0',
             'size': str(len(uuids)), # one big request
@@ -130,22 +234,39 @@ class GDCIndexClient(object):
 
             annotations = [ a['annotation_id'] for a in h.get('annotations', []) ]
 
+            # files seeded from a manifest only lack what the manifest
+            # doesn't carry, keep their size and md5sum
+            if h['id'] in self.manifest_ids:
+                self.metadata[h['id']].update({
+                    'access':        h.get('access'),
+                    'annotations':   annotations,
+                    'related_files': related_files,
+                })
+                self.manifest_ids.discard(h['id'])
+
             # set the metadata as a class data member so that it can be
             # references as much as needed without needing to calculate
             # everything over again
-            if h['id'] not in self.metadata.keys():
+            elif h['id'] not in self.metadata.keys():
                 # don't want to overwrite
                 self.metadata[h['id']] = {
                     'access':        h['access'],
+                    'file_name':     h.get('file_name'),
                     'file_size':     h['file_size'],
                     'md5sum':        h['md5sum'],
                     'annotations':   annotations,
                     'related_files': related_files,
                 }
 
+        if self.cache is not None:
+            self.cache.update(self.uri, dict([ (h['id'], self.metadata[h['id']])
+                for h in active_hits + legacy_hits
+                if h['id'] in self.metadata and h['id'] not in self.manifest_ids ]))
+
         return self.metadata
 
-    def separate_small_files(self, ids, chunk_size):
+    def separate_small_files(self, ids, chunk_size,
+                             related_files=True, annotations=True):
         """ Separate big and small files
 
         Separate the small files from the larger files in
@@ -156,9 +277,16 @@ class GDCIndexClient(object):
         so that if a controlled grouping failed, you can handle it as the same
         edge case.
 
+        Files whose size and md5sum were loaded from a manifest are only
+        queried for their access, related files and annotations. If related
+        files and annotations aren't wanted they are not queried at all and
+        are grouped regardless of their access.
+
         Args:
             ids (list): a set of file UUIDs
             chunk_size (int): the maximum allowed combined size of small files
+            related_files (bool): whether related files will be downloaded
+            annotations (bool): whether annotations will be downloaded
 
         Return:
             list: a list of big file UUIDs
@@ -169,20 +297,31 @@ class GDCIndexClient(object):
         bigs = set()
         smalls_open = []
         smalls_control = []
+        smalls_unknown = []
         potential_smalls = set()
 
         # go through all the UUIDs and pick out the ones with
         # relate and annotation files so they can be handled by parcel
         log.debug('Grouping ids by size')
 
-        self._get_metadata(ids)
+        missing = [ i for i in ids if i not in self.metadata ]
+        if missing:
+            self._get_metadata(missing)
+
+        from_manifest = [ i for i in ids if i in self.manifest_ids ]
+        if from_manifest and (related_files or annotations):
+            self._get_metadata(from_manifest, fields=MANIFEST_MISSING_FIELDS)
+        elif from_manifest:
+            log.debug('Skipping metadata query for {0} files from manifest'
+                    .format(len(from_manifest)))
+
         for uuid in ids:
             if uuid not in self.metadata.keys():
                 bigs.add(uuid)
                 continue
 
-            rf = self.get_related_files(uuid)
-            af = self.get_annotations(uuid)
+            rf = self.get_related_files(uuid) if related_files else []
+            af = self.get_annotations(uuid) if annotations else []
 
             # if there are any related files, add file to a regular/big file
             # download list
@@ -204,8 +343,11 @@ class GDCIndexClient(object):
         bundle_open_size = chunk_size + 1
         bundle_control_size = chunk_size + 1
 
+        bundle_unknown_size = chunk_size + 1
+
         i_open = -1
         i_control = -1
+        i_unknown = -1
 
         for uuid in potential_smalls:
             # grouping of file exceeds chunk_size, create a new grouping
@@ -219,6 +361,11 @@ class GDCIndexClient(object):
                 i_control += 1
                 bundle_control_size = 0
 
+            if bundle_unknown_size > chunk_size:
+                smalls_unknown.append([])
+                i_unknown += 1
+                bundle_unknown_size = 0
+
             # individual file is more than chunk_size, big file download
             if self.get_filesize(uuid) > chunk_size:
                 bigs.add(uuid)
@@ -233,8 +380,13 @@ class GDCIndexClient(object):
                     smalls_control[i_control].append(uuid)
                     bundle_control_size += self.get_filesize(uuid)
 
+                # access wasn't queried, see load_manifest
+                elif self.get_access(uuid) is None:
+                    smalls_unknown[i_unknown].append(uuid)
+                    bundle_unknown_size += self.get_filesize(uuid)
+
         # they are still small files to be downloaded in a group
-        smalls = smalls_open + smalls_control
+        smalls = smalls_open + smalls_control + smalls_unknown
 
         # for logging/reporting purposes
         total_count = len(bigs) + sum([ len(s) for s in smalls ])
@@ -0,0 +1,462 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from gdc_client import auth, download, upload
+from gdc_client import log as logger
+from gdc_client.download.client import share_sessions
+from gdc_client.query.index import GDCIndexClient, MetadataCache
+from gdc_client.upload.client import GDCUploadClient, PROCESSES, THREADS
+from gdc_client.version import __version__
+
+import argparse
+import binascii
+import ctypes
+import hmac
+import itertools
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+import traceback
+
+
+log = logging.getLogger('gdc-serve')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# log lines kept per job
+JOB_LOG_LINES = 1000
+
+# finished jobs kept for their status
+FINISHED_JOBS = 1000
+
+# carries the API token of a daemon listening on TCP
+TOKEN_HEADER = 'X-Serve-Token'
+
+
+class JobError(Exception):
+    pass
+
+
+class JobCancelled(BaseException):
+    """ Raised in the thread of a cancelled job. Like KeyboardInterrupt it
+    isn't an Exception, so the job's own error handling doesn't catch it """
+
+
+class JobArgumentParser(argparse.ArgumentParser):
+    """ Reports invalid job arguments instead of exiting the daemon """
+
+    def error(self, message):
+        raise JobError(message)
+
+    def exit(self, status=0, message=None):
+        raise JobError(message or 'exited with {0}'.format(status))
+
+
+def job_parsers():
+    # type: () -> Dict[str, argparse.ArgumentParser]
+    """ The download and upload parsers, as gdc-client configures them """
+
+    parsers = dict()
+    for name, command in [('download', download), ('upload', upload)]:
+        template = JobArgumentParser(add_help=False)
+        logger.parser.config(template)
+        auth.parser.config(template)
+
+        parser = JobArgumentParser(prog='gdc-client {0}'.format(name),
+                                   parents=[template], add_help=False)
+        command.parser.config(parser)
+        parsers[name] = parser
+
+    # forking the threads of the daemon isn't safe
+    parsers['download'].set_defaults(download_engine=THREADS)
+    parsers['upload'].set_defaults(upload_engine=THREADS)
+
+    return parsers
+
+
+class JobLogHandler(logging.Handler):
+    """ Keeps the log lines of the thread running each job """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.jobs = dict()
+        self.setFormatter(logging.Formatter('%(asctime)s: %(levelname)s: %(message)s'))
+
+    def emit(self, record):
+        job = self.jobs.get(threading.current_thread().ident)
+        if job is not None:
+            job.log.append(self.format(record))
+            del job.log[:-JOB_LOG_LINES]
+
+
+class Job(object):
+
+    def __init__(self, job_id, command, args, argv):
+        self.id = job_id
+        self.command = command
+        self.args = args
+        self.argv = argv
+        self.state = QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.errors = []
+        self.log = []
+        self.thread = None
+
+    def to_json(self):
+        return {
+            'id':       self.id,
+            'command':  self.command,
+            'args':     self.argv,
+            'state':    self.state,
+            'created':  self.created,
+            'started':  self.started,
+            'finished': self.finished,
+            'errors':   self.errors,
+            'log':      self.log,
+        }
+
+
+class JobManager(object):
+    """ Runs download and upload jobs in worker threads of one warm process
+
+    Imports, TLS connections and file metadata are reused between jobs,
+    so a small job costs a request instead of a new gdc-client process.
+    """
+
+    def __init__(self, workers=4, token=None):
+        self.parsers = job_parsers()
+        # the GDC token of every job, jobs can't read token files
+        self.token = token
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.jobs = dict()
+        self.ids = itertools.count(1)
+
+        self.log_handler = JobLogHandler()
+        logging.getLogger().addHandler(self.log_handler)
+
+        # warm connections and metadata shared by the jobs
+        share_sessions()
+        GDCIndexClient.cache = MetadataCache()
+
+        # there is no terminal to ask whether to resume an upload
+        GDCUploadClient.interactive = False
+
+        self.threads = []
+        for _ in range(max(1, workers)):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, command, argv):
+        # type: (str, List[str]) -> Job
+        """ Queue a job, parsing its arguments as gdc-client would """
+
+        if command not in self.parsers:
+            raise JobError('Unknown command {0}, expected one of {1}'.format(
+                command, ', '.join(sorted(self.parsers))))
+
+        if not isinstance(argv, list) or \
+           not all([ isinstance(a, basestring) for a in argv ]):
+            raise JobError('args must be a list of strings')
+
+        args = self.parsers[command].parse_args(argv)
+        if getattr(args, 'to_stdout', False) or \
+           getattr(args, 'no_auto_retry', False):
+            raise JobError('--to-stdout and --no-auto-retry need a terminal')
+
+        # bound for the whole process, they would apply to every job
+        if getattr(args, 'source_address', None):
+            raise JobError('--source-address is set for every job with '
+                           'gdc-client serve --source-address')
+
+        if getattr(args, 'upload_engine', None) == PROCESSES or \
+           getattr(args, 'download_engine', None) == PROCESSES:
+            raise JobError('--upload-engine and --download-engine processes '
+                           'can not be used in a job')
+
+        # whoever submits a job would run commands and read files as the
+        # user of the daemon
+        if getattr(args, 'on_complete', None):
+            raise JobError('--on-complete can not be used in a job')
+
+        if args.token_file:
+            raise JobError('--token-file is set for every job with '
+                           'gdc-client serve --token-file')
+        args.token_file = self.token
+
+        with self.lock:
+            job = Job(str(next(self.ids)), command, args, argv)
+            self.jobs[job.id] = job
+            self._forget()
+
+        self.queue.put(job)
+        log.info('Queued {0} job {1}'.format(command, job.id))
+        return job
+
+    def get(self, job_id):
+        # type: (str) -> Job
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        # type: () -> List[Job]
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda j: j.created)
+
+    def cancel(self, job_id):
+        # type: (str) -> Job
+        """ Cancel a queued job, or interrupt a running one
+
+        A running job is interrupted as soon as it runs Python code again,
+        e.g. after the chunk it is reading.
+        """
+
+        job = self.get(job_id)
+        if job is None:
+            return None
+
+        with self.lock:
+            if job.state == QUEUED:
+                job.state = CANCELLED
+                job.finished = time.time()
+
+            elif job.state == RUNNING and job.thread:
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                    ctypes.c_long(job.thread), ctypes.py_object(JobCancelled))
+
+        return job
+
+    def _forget(self):
+        """ Drop the oldest finished jobs """
+
+        finished = sorted([ j for j in self.jobs.values() if j.finished ],
+                          key=lambda j: j.finished)
+        for job in finished[:-FINISHED_JOBS]:
+            del self.jobs[job.id]
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self._run_job(job)
+            except JobCancelled:
+                # cancelled just as the job finished
+                with self.lock:
+                    if job.state == RUNNING:
+                        job.state = CANCELLED
+                        job.finished = time.time()
+                        job.thread = None
+
+    def _run_job(self, job):
+        # type: (Job) -> None
+        with self.lock:
+            if job.state != QUEUED:
+                return
+            job.state = RUNNING
+            job.started = time.time()
+            job.thread = threading.current_thread().ident
+
+        self.log_handler.jobs[job.thread] = job
+        try:
+            errors = job.args.func(job.args)
+            state = FAILED if errors else SUCCEEDED
+            job.errors = list(errors) if errors else []
+        except JobCancelled:
+            state = CANCELLED
+        except (Exception, SystemExit) as e:
+            log.error('Job {0} failed: {1}'.format(job.id, e))
+            job.log.append(traceback.format_exc())
+            state = FAILED
+        finally:
+            self.log_handler.jobs.pop(job.thread, None)
+
+        with self.lock:
+            job.state = state
+            job.finished = time.time()
+            job.thread = None
+
+        log.info('Job {0} {1}'.format(job.id, state))
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """ JSON job API
+
+        GET    /status         daemon version and job counts
+        GET    /jobs           every job
+        POST   /jobs           {"command": "download", "args": [...]}
+        GET    /jobs/<id>      state, errors and log of a job
+        DELETE /jobs/<id>      cancel a job
+    """
+
+    server_version = 'gdc-client-serve/{0}'.format(__version__)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def _job_id(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'jobs':
+            return parts[1]
+
+    def _authorized(self):
+        # type: () -> bool
+        """ Whether the request carries the API token, if there is one """
+
+        if self.server.token is None:
+            return True
+
+        token = self.headers.getheader(TOKEN_HEADER) or ''
+        if hmac.compare_digest(token, self.server.token):
+            return True
+
+        self._respond(401, {'message': 'Missing or invalid {0}'.format(
+            TOKEN_HEADER)})
+        return False
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+
+        manager = self.server.manager
+
+        if self.path.rstrip('/') == '/status':
+            counts = dict()
+            for job in manager.list():
+                counts[job.state] = counts.get(job.state, 0) + 1
+            return self._respond(200, {'version': __version__, 'jobs': counts})
+
+        if self.path.rstrip('/') == '/jobs':
+            return self._respond(200, [
+                dict(j.to_json(), log=None) for j in manager.list() ])
+
+        job = manager.get(self._job_id())
+        if job is None:
+            return self._respond(404, {'message': 'No such job'})
+
+        self._respond(200, job.to_json())
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+
+        if self.path.rstrip('/') != '/jobs':
+            return self._respond(404, {'message': 'Not found'})
+
+        try:
+            body = json.loads(self.rfile.read(
+                int(self.headers.getheader('Content-Length') or 0)))
+            job = self.server.manager.submit(
+                    body.get('command'), body.get('args', []))
+        except (ValueError, AttributeError) as e:
+            return self._respond(400, {'message': 'Invalid job: {0}'.format(e)})
+        except JobError as e:
+            return self._respond(400, {'message': str(e)})
+
+        self._respond(202, job.to_json())
+
+    def do_DELETE(self):
+        if not self._authorized():
+            return
+
+        job = self.server.manager.cancel(self._job_id())
+        if job is None:
+            return self._respond(404, {'message': 'No such job'})
+
+        self._respond(202, job.to_json())
+
+    def _respond(self, status, content):
+        content = json.dumps(content, indent=2)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class JobServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, manager, token):
+        HTTPServer.__init__(self, address, JobHandler)
+        self.manager = manager
+        # any local user can connect, only the holder of the token is served
+        self.token = token
+
+
+class UnixJobServer(ThreadingMixIn, UnixStreamServer):
+
+    daemon_threads = True
+
+    # the socket itself is only open to its owner
+    token = None
+
+    def __init__(self, path, manager):
+        if os.path.exists(path):
+            os.remove(path)
+
+        UnixStreamServer.__init__(self, path, UnixJobHandler)
+        # only the user running the daemon can submit jobs
+        os.chmod(path, 0600)
+        self.manager = manager
+
+
+class UnixJobHandler(JobHandler):
+
+    def address_string(self):
+        return self.server.server_address
+
+    def setup(self):
+        # the peer of a unix socket has no address
+        self.client_address = ('unix', 0)
+        JobHandler.setup(self)
+
+
+def write_api_token(path):
+    # type: (str) -> str
+    """ Write a new random API token to path, readable by its owner only """
+
+    token = binascii.hexlify(os.urandom(32))
+    if os.path.exists(path):
+        os.remove(path)
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+
+    return token
+
+
+def serve(manager, host='127.0.0.1', port=8081, socket_path=None,
+          token_path=None):
+    # type: (JobManager, str, int, str, str) -> None
+    """ Serve the job API on the Unix socket, or on host and port if there
+    is no socket. Requests over TCP need the API token written to token_path
+    """
+
+    if socket_path:
+        server = UnixJobServer(socket_path, manager)
+        log.info('Serving jobs on {0}'.format(socket_path))
+    else:
+        server = JobServer((host, port), manager, write_api_token(token_path))
+        log.info('Serving jobs on {0}:{1}, send the token in {2} as {3}'
+                 .format(host, server.server_address[1], token_path,
+                         TOKEN_HEADER))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        path = socket_path or token_path
+        if os.path.exists(path):
+            os.remove(path)
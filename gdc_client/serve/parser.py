@@ -0,0 +1,61 @@
+from functools import partial
+from gdc_client import defaults, netbind
+from gdc_client.serve import daemon
+
+import logging
+import socket
+
+
+log = logging.getLogger('gdc-serve')
+
+def serve(parser, args):
+    """ Run download and upload jobs submitted to a local job API.
+    """
+
+    if not args.tcp and not hasattr(socket, 'AF_UNIX'):
+        parser.error('Unix sockets are not available here, use --tcp')
+
+    # the same for every job
+    if args.source_address:
+        netbind.bind_source_addresses(args.source_address)
+
+    manager = daemon.JobManager(workers=args.workers, token=args.token_file)
+    daemon.serve(
+            manager,
+            host=args.host,
+            port=args.port,
+            socket_path=None if args.tcp else args.socket,
+            token_path=args.api_token_file)
+
+def config(parser):
+    """ Configure a parser for serve.
+    """
+    func = partial(serve, parser)
+    parser.set_defaults(func=func)
+
+    parser.add_argument('--socket', metavar='PATH',
+                        default=defaults.serve_socket,
+                        help='Unix socket to listen on, only its owner can '
+                        'submit jobs. Defaults to {0}'
+                        .format(defaults.serve_socket))
+    parser.add_argument('--tcp', action='store_true',
+                        help='Listen on localhost HTTP instead of the Unix '
+                        'socket. Requests need the token written to '
+                        '--api-token-file in the {0} header'
+                        .format(daemon.TOKEN_HEADER))
+    parser.add_argument('--api-token-file', metavar='PATH',
+                        default=defaults.serve_token,
+                        dest='api_token_file',
+                        help='Where --tcp writes the token of its API. '
+                        'Defaults to {0}'.format(defaults.serve_token))
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address --tcp listens on. Defaults to 127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081,
+                        help='Port --tcp listens on. Defaults to 8081')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of jobs run at the same time')
+    parser.add_argument('--source-address', metavar='ADDRESS[,ADDRESS...]',
+                        type=netbind.argparse_type, default=[],
+                        dest='source_address',
+                        help='Local addresses or interfaces the connections '
+                        'of every job are bound to in turn')
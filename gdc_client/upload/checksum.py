@@ -0,0 +1,90 @@
+import hashlib
+import logging
+import math
+import mmap
+import threading
+
+from .. import diskio
+
+
+log = logging.getLogger('upload-checksum')
+
+
+class FileHasher(object):
+    """ md5sum of a file uploaded in parts, computed in a thread
+
+    Parts are uploaded out of order, so each is hashed once the parts
+    before it are. By then the pages of the part were just read to upload
+    it, so they're hashed from the page cache and only dropped after.
+    """
+
+    def __init__(self, path, file_size, part_size):
+        self.path = path
+        self.file_size = file_size
+        self.part_size = part_size
+        self.part_count = int(math.ceil(file_size / float(part_size)))
+
+        self.md5 = hashlib.md5()
+        self.uploaded = set()
+        self.next_part = 1
+        self.cancelled = False
+        self.error = None
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, part_number):
+        # type: (int) -> None
+        """ Mark a part as uploaded """
+
+        with self.condition:
+            self.uploaded.add(part_number)
+            self.condition.notify()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify()
+
+    def hexdigest(self):
+        # type: () -> str
+        """ Wait for every part to be hashed and return the md5sum """
+
+        self.thread.join()
+        if self.error:
+            raise self.error
+        return self.md5.hexdigest()
+
+    def _run(self):
+        try:
+            with open(self.path, 'rb') as f:
+                while self.next_part <= self.part_count:
+                    with self.condition:
+                        while self.next_part not in self.uploaded and \
+                              not self.cancelled:
+                            self.condition.wait()
+                        if self.cancelled:
+                            return
+
+                    self._hash_part(f)
+                    self.next_part += 1
+
+        except Exception as e:
+            log.error('Unable to hash {0}: {1}'.format(self.path, e))
+            self.error = e
+
+    def _hash_part(self, f):
+        offset = (self.next_part - 1) * self.part_size
+        size = min(self.part_size, self.file_size - offset)
+
+        part = mmap.mmap(f.fileno(), size, offset=offset,
+                         access=mmap.ACCESS_READ)
+        try:
+            self.md5.update(part)
+        finally:
+            part.close()
+
+        # the part was uploaded and hashed, it won't be read again
+        diskio.advise(f.fileno(), offset, size, diskio.POSIX_FADV_DONTNEED)
@@ -1,24 +1,34 @@
 from urlparse import urljoin
 import random
-from multiprocessing import Pool, Manager
+from multiprocessing import Pool
+from multiprocessing.queues import SimpleQueue
+from multiprocessing.pool import ThreadPool
 import requests
 import platform
 from lxml import etree
+import base64
+import errno
+import hashlib
 import math
 import os
 import signal
 import json
+import Queue
 import sys
+import threading
 import yaml
 from mmap import mmap, PAGESIZE
-import contextlib
 from progressbar import ProgressBar, Percentage, Bar
-from collections import deque
 import time
-import copy
 import logging
+from functools import partial
+from StringIO import StringIO
 
 from . import manifest
+from .checksum import FileHasher
+from .journal import PartJournal
+from .. import diskio
+from ..download.client import make_session
 import logging
 
 log = logging.getLogger('upload')
@@ -27,6 +37,37 @@ MAX_RETRIES = 10
 MAX_TIMEOUT = 60
 MIN_PARTSIZE = 5242880
 
+# S3 takes at most 10,000 parts per multipart upload
+MAX_PARTS = 10000
+
+# parts asked for in each page of ListParts
+LIST_PARTS_PAGE_SIZE = 1000
+
+# when the part size is chosen per file, files of at least this many
+# minimum size parts go multipart, split so that each worker gets a few
+# parts of up to MAX_AUTO_PARTSIZE
+MULTIPART_MIN_PARTS = 2
+PARTS_PER_WORKER = 4
+MAX_AUTO_PARTSIZE = 1024 * 1024 * 1024
+
+# ids resolved by each aliased graphql query
+METADATA_BATCH_SIZE = 200
+
+# threads resolving and stat'ing the files of a manifest
+PREFLIGHT_WORKERS = 16
+
+# seconds between the checks for upload workers that died
+WORKER_CHECK_INTERVAL = 1
+
+# files with open handles and scheduled parts at a time, per worker,
+# unless given
+FILES_PER_WORKER = 2
+
+# how the parts are uploaded in parallel
+PROCESSES = 'processes'
+THREADS = 'threads'
+ENGINES = [PROCESSES, THREADS]
+
 OS_WINDOWS = platform.system() == 'Windows'
 
 if not OS_WINDOWS:
@@ -38,71 +79,190 @@ else:
 
     from multiprocessing.pool import ThreadPool as Pool
 
-    # Fake multiprocessing manager namespace
-    class FakeNamespace(object):
-
-        def __init__(self):
-            self.completed = 0
-
     from mmap import ALLOCATIONGRANULARITY as PAGESIZE
     from mmap import ACCESS_READ
 
 
 log = logging.getLogger('upload-client')
 
-def upload_multipart_wrapper(args):
-    return upload_multipart(*args)
+# where a worker process says which task it started, set in each worker
+started_tasks = None
+
+
+def watch_tasks(started):
+    """ Initialize a worker process of the upload pool """
+
+    global started_tasks
+    started_tasks = started
+
+
+def upload_task(task):
+    """ Run a task of the upload pool, returns its key and result """
+
+    key, func, args = task
+    if started_tasks is not None:
+        # for the task to be failed if this worker dies
+        started_tasks.put((os.getpid(), key))
+    try:
+        return key, func(*args)
+    except Exception as e:
+        # the result is waited for, it has to come back
+        log.error('Upload task {0} failed: {1}'.format(key, e))
+        return key, False
 
 
 class Stream(object):
 
-    def __init__(self, file, pbar, filesize):
+    def __init__(self, file, pbar=None, filesize=None):
         self._file = file
         self.pbar = pbar
         self.filesize = filesize
+        self.dropped = 0
+        # md5sum of what was read
+        self.md5 = hashlib.md5()
+        diskio.advise(file.fileno(), 0, 0, diskio.POSIX_FADV_SEQUENTIAL)
 
     def __getattr__(self, attr):
         return getattr(self._file, attr)
 
     def read(self, num):
-        self.pbar.update(min(self.pbar.currval+num, self.filesize))
-        return self._file.read(num)
+        if self.pbar:
+            self.pbar.update(min(self.pbar.currval+num, self.filesize))
+        data = self._file.read(num)
+        self.md5.update(data)
+
+        # what has been sent won't be read again
+        position = self._file.tell()
+        if position - self.dropped >= diskio.DROP_INTERVAL or not data:
+            diskio.advise(self._file.fileno(), self.dropped,
+                          position - self.dropped, diskio.POSIX_FADV_DONTNEED)
+            self.dropped = position
+
+        return data
+
+
+# state of a pool worker (process, or thread on Windows), kept between the
+# parts it uploads
+_worker = threading.local()
+
+
+def worker_session():
+    # type: () -> requests.Session
+    """ The worker's session, whose connection is reused for every part """
+
+    if getattr(_worker, 'session', None) is None:
+        _worker.session = requests.Session()
+    return _worker.session
+
+
+def reset_worker_session():
+    # type: () -> None
+    """ Drop a session whose connection is broken """
+
+    session = getattr(_worker, 'session', None)
+    if session is not None:
+        session.close()
+    _worker.session = None
+
+
+def worker_file(filename):
+    # type: (str) -> file
+    """ The worker's handle of the file, reopened only for another file """
+
+    f = getattr(_worker, 'file', None)
+    if f is None or f.closed or f.name != filename:
+        if f is not None:
+            f.close()
+        f = _worker.file = open(filename, 'rb')
+    return f
+
+
+def upload_simple(filename, url, headers, verify=True, md5sum=None,
+                  session=None):
+    """ Upload a whole file with one PUT, returns its md5sum, hashed as it
+    was sent, or False if it wasn't uploaded
+
+    The md5sum of the manifest is sent as Content-MD5, for the server to
+    refuse a body that doesn't match it
+    """
+
+    try:
+        r = (session or worker_session()).put(
+            url + "/_dry_run", headers=headers, verify=verify)
+        if r.status_code != 200:
+            log.error("Can't upload {0}: {1}".format(filename, r.text))
+            return False
+
+        # the dry run has no body to check
+        if md5sum:
+            headers = dict(headers, **{
+                'Content-MD5': base64.b64encode(md5sum.decode('hex'))})
+
+        with open(filename, 'rb') as f:
+            stream = Stream(f)
+            r = (session or worker_session()).put(
+                url, data=stream, headers=headers, verify=verify)
+        if r.status_code != 200:
+            log.error("Upload failed {0}".format(r.text))
+            return False
+        return stream.md5.hexdigest()
+
+    except Exception as e:
+        if session is None:
+            reset_worker_session()
+        log.error("Upload failed {0}: {1}".format(filename, e))
+        return False
 
 
 def upload_multipart(filename, offset, bytes, url, upload_id, part_number,
-                     headers, verify=True, pbar=None, ns=None):
+                     headers, verify=True, session=None, fileobj=None):
+    """ Upload a part, returns its ETag and md5sum, or False if it wasn't
+    uploaded
+
+    Threads pass the session and file they share, processes use their own
+    """
+
     tries = MAX_RETRIES
+    chunk_file = None
+    md5sum = None
     while tries > 0:
         try:
             log.debug("Start upload part {0}".format(part_number))
-            f = open(filename, 'rb')
-            if OS_WINDOWS:
-                chunk_file = mmap(
-                    fileno=f.fileno(),
-                    length=bytes,
-                    offset=offset,
-                    access=ACCESS_READ
-                )
-            else:
-                chunk_file = mmap(
-                    fileno=f.fileno(),
-                    length=bytes,
-                    offset=offset,
-                    prot=PROT_READ
-                )
-            res = requests.put(
+            f = fileobj or worker_file(filename)
+            if chunk_file is None:
+                diskio.advise(f.fileno(), offset, bytes,
+                              diskio.POSIX_FADV_SEQUENTIAL)
+                if OS_WINDOWS:
+                    chunk_file = mmap(
+                        fileno=f.fileno(),
+                        length=bytes,
+                        offset=offset,
+                        access=ACCESS_READ
+                    )
+                else:
+                    chunk_file = mmap(
+                        fileno=f.fileno(),
+                        length=bytes,
+                        offset=offset,
+                        prot=PROT_READ
+                    )
+                md5 = hashlib.md5(chunk_file)
+                md5sum = md5.hexdigest()
+                part_headers = dict(headers, **{
+                    'Content-MD5': base64.b64encode(md5.digest())})
+
+            # a retry sends the part from the start again
+            chunk_file.seek(0)
+            res = (session or worker_session()).put(
                 url +
                 "?uploadId={0}&partNumber={1}".format(upload_id, part_number),
-                headers=headers, data=chunk_file, verify=verify)
-            chunk_file.close()
-            f.close()
+                headers=part_headers, data=chunk_file, verify=verify)
             if res.status_code == 200:
-                if pbar:
-                    pbar.fd = sys.stderr
-                    ns.completed += 1
-                    pbar.update(ns.completed)
+                # the pages stay cached for the FileHasher
+                chunk_file.close()
                 log.debug("Finish upload part {0}".format(part_number))
-                return True
+                # stores that don't return one have it listed later
+                return res.headers.get('ETag'), md5sum
             else:
                 time.sleep(get_sleep_time(tries))
 
@@ -110,12 +270,47 @@ def upload_multipart(filename, offset, bytes, url, upload_id, part_number,
                 log.debug(
                     "Retry upload part {0}, {1}".format(part_number, res.text))
 
+        except requests.exceptions.ConnectionError:
+            # the next try opens a new connection
+            if session is None:
+                reset_worker_session()
+            time.sleep(get_sleep_time(tries))
+            tries -= 1
+
         except:
             time.sleep(get_sleep_time(tries))
             tries -= 1
+
+    if chunk_file is not None:
+        chunk_file.close()
     return False
 
 
+def part_size_for(file_size, workers, part_size=None):
+    """ The part size of a file's multipart upload
+
+    Without a part size, it's chosen so that every worker gets a few parts
+    of the file. It's raised to keep within S3's minimum part size and
+    MAX_PARTS, and rounded to pages so that each part can be mmap'd.
+    """
+
+    if not part_size:
+        part_size = min(MAX_AUTO_PARTSIZE,
+                        file_size / (max(1, workers) * PARTS_PER_WORKER))
+
+    part_size = max(part_size, MIN_PARTSIZE,
+                    int(math.ceil(file_size / float(MAX_PARTS))))
+    return int(math.ceil(part_size / float(PAGESIZE))) * PAGESIZE
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
 def get_sleep_time(tries):
     timeout = (min(MAX_TIMEOUT, 2**(MAX_RETRIES-tries)))
     return timeout * (0.5 + random.random()/2)
@@ -139,9 +334,14 @@ def create_resume_path(file_path):
 
 class GDCUploadClient(object):
 
+    # ask before resuming a previous upload, gdc-client serve resumes
+    # without a terminal to ask on
+    interactive = True
+
     def __init__(self, token, processes, server, part_size,
                  multipart=True, debug=False,
-                 files={}, verify=True, manifest_name=None):
+                 files={}, verify=True, manifest_name=None, engine=PROCESSES,
+                 files_in_flight=None):
         self.headers = {'X-Auth-Token': token.strip()}
         self.manifest_name = manifest_name
         self.verify = verify
@@ -153,7 +353,6 @@ class GDCUploadClient(object):
             log.info('Using system default CA')
 
         self.files = files
-        self.incompleted = deque(copy.deepcopy(self.files))
 
         if not (server.startswith('http://') or server.startswith('https://')):
             server = 'https://' + server
@@ -163,12 +362,76 @@ class GDCUploadClient(object):
         self.upload_id = None
         self.debug = debug
         self.processes = processes
-        self.part_size = (max(part_size, MIN_PARTSIZE)/PAGESIZE+1)*PAGESIZE
+        self.engine = THREADS if OS_WINDOWS else engine
+        self.session = None
+        self.pool = None
+        # each file in flight has an open handle and a hashing thread
+        self.files_in_flight = files_in_flight or \
+            FILES_PER_WORKER * max(1, processes)
+        # chosen per file if not given
+        self.part_size = part_size and part_size_for(0, processes, part_size)
+        # project_id and file_name by node id, for this run
         self._metadata = {}
         self.resume_path = "resume_{0}".format(self.manifest_name)
 
-    def metadata(self, field):
-        return self._metadata.get(field) or self.get_metadata(self.node_id)[field]
+    def metadata(self, node_id, field):
+        metadata = self._metadata.get(node_id) or self.get_metadata(node_id)
+        return metadata[field]
+
+    def graphql(self, query):
+        # type: (str) -> Dict
+        r = requests.post(
+            urljoin(self.server, "v0/submission/graphql"),
+            headers=self.headers,
+            data=json.dumps({'query': query}),
+            verify=self.verify)
+
+        if r.status_code != 200:
+            raise Exception(r.text)
+
+        result = r.json()
+        if 'errors' in result:
+            raise Exception(', '.join(result['errors']))
+        return result['data']
+
+    def prefetch_metadata(self, ids):
+        # type: (List[str]) -> None
+        ''' Resolve the project_id and file_name of many files at once
+
+        Each batch of ids takes two aliased graphql queries, one for the
+        node types and one for the files of every type. Ids that can't be
+        resolved here are left to get_metadata, which reports their error.
+        '''
+
+        ids = [ i for i in ids if i not in self._metadata ]
+        for start in xrange(0, len(ids), METADATA_BATCH_SIZE):
+            batch = ids[start:start+METADATA_BATCH_SIZE]
+            try:
+                nodes = self.graphql('query Files { %s }' % ' '.join([
+                    'n%d: node (id: "%s") { type }' % (i, node_id)
+                    for i, node_id in enumerate(batch) ]))
+
+                types = [ (node_id, nodes['n%d' % i][0]['type'])
+                          for i, node_id in enumerate(batch)
+                          if nodes.get('n%d' % i) ]
+                if not types:
+                    continue
+
+                files = self.graphql('query Files { %s }' % ' '.join([
+                    'f%d: %s (id: "%s") { project_id, file_name }'
+                    % (i, file_type, node_id)
+                    for i, (node_id, file_type) in enumerate(types) ]))
+
+            except Exception as e:
+                log.debug('Unable to query metadata in a batch: {0}'.format(e))
+                continue
+
+            for i, (node_id, _) in enumerate(types):
+                if files.get('f%d' % i):
+                    self._metadata[node_id] = files['f%d' % i][0]
+
+            log.debug('Resolved metadata of {0} of {1} files'.format(
+                len([ i for i in batch if i in self._metadata ]), len(batch)))
 
     def get_metadata(self, id):
         '''
@@ -176,7 +439,6 @@ class GDCUploadClient(object):
         '''
 
         # first get the file_type
-        self._metadata = {}
         query = {'query': 'query Files { node (id: "%s") { type }}' % id}
 
         r = requests.post(
@@ -219,8 +481,8 @@ class GDCUploadClient(object):
 
             # get first result only
             if len(result['data'][file_type]) > 0:
-                self._metadata = result['data'][file_type][0]
-                return self._metadata
+                self._metadata[id] = result['data'][file_type][0]
+                return self._metadata[id]
 
             raise Exception("File with id {0} not found".format(id))
 
@@ -229,114 +491,552 @@ class GDCUploadClient(object):
         # </metadata>
 
     def get_files(self, action='download'):
-        '''Parse file information from manifest'''
-        try:
-            self.file_entities = []
-            for f in self.files:
-                file_entity = FileEntity()
-                file_entity.node_id = f['id']
-                # cache node_id to use metadata property
-                self.node_id = file_entity.node_id
-                project_id = f.get('project_id') or self.metadata('project_id')
-                tokens = project_id.split('-')
-                program = (tokens[0]).upper()
-                project = ('-'.join(tokens[1:])).upper()
-
-                if not program or not project:
-                    raise RuntimeError('Unable to parse project id {0}'
-                                       .format(project_id))
-
-                file_entity.url = urljoin(
-                    self.server, 'v0/submission/{0}/{1}/files/{2}'
-                    .format(program, project, f['id']))
-
-
-                # https://github.com/NCI-GDC/gdcapi/pull/426#issue-146068652
-                # [[[ --path takes precedence over everything ]]]
-                # -----------------------------------------------
-                # 1)--path and f[file_name] from manifest_file
-                # 2) --path and UUID's filename, pull filename from API
-                # 3) manifest's local_file_path
-                # 4) manifest's file_name (in current directory)
-                # 5) UUID's resolved files
-
-                # 1) --path and f[file_name] from manifest_file
-                if f.get('path') and f.get('file_name') and \
-                        os.path.exists(os.path.join(f.get('path'), f.get('file_name'))):
-                    file_entity.file_path = os.path.join(f.get('path'), f.get('file_name'))
-
-                # 2) --path and UUID's filename, pull filename from API
-                elif f.get('path') and f.get('id') and\
-                        os.path.exists(os.path.join(f.get('path'), self.metadata('file_name'))):
-                    file_entity.file_path = os.path.join(f.get('path'), self.metadata('file_name'))
-
-                # 3) only local_file_path from manifest file
-                elif f.get('local_file_path') and \
-                        os.path.basename(f.get('local_file_path')) and os.path.exists(f.get('local_file_path')):
-                    file_entity.file_path = f.get('local_file_path')
-
-                # 4) only file_name provided by manifest
-                elif f.get('file_name') and os.path.exists(f.get('file_name')):
-                    file_entity.file_path = f.get('file_name')
-
-                # 5) UUID given, get filename from api
-                else:
-                    file_entity.file_path = self.metadata('file_name')
-
-                if action == 'delete':
-                    self.file_entities.append(file_entity)
-                    continue
-
-                with open(file_entity.file_path, 'rb') as fp:
-                    file_entity.file_size = os.fstat(fp.fileno()).st_size
-
-                file_entity.upload_id = f.get('upload_id')
-                self.file_entities.append(file_entity)
+        '''Parse file information from manifest
 
+        The files are resolved and stat'd from a pool of threads, since each
+        takes a few round trips on a network filesystem. Every problem is
+        reported before any transfer starts, and only the files without
+        one are uploaded.
+        '''
+        self.file_entities = []
+        try:
+            # the files the manifest doesn't describe are looked up together
+            self.prefetch_metadata([ f['id'] for f in self.files
+                if not f.get('project_id') or not f.get('file_name') and
+                   (f.get('path') or not f.get('local_file_path')) ])
         except KeyError as e:
             log.error(
                 "Please provide {0} from manifest or as an argument"
                 .format(e.message))
             return False
 
-        # this makes things very hard to debug
-        # comment out if you need
+        pool = ThreadPool(processes=max(1, min(PREFLIGHT_WORKERS, len(self.files))))
+        try:
+            results = pool.map_async(
+                partial(self.resolve_file, action=action),
+                self.files).get(9999999)
+        finally:
+            pool.close()
+            pool.join()
+
+        errors = [ error for _, error in results if error ]
+        for error in errors:
+            log.error(error)
+        if errors:
+            log.error("{0} of {1} files can't be uploaded"
+                      .format(len(errors), len(self.files)))
+
+        self.file_entities = [ f for f, error in results if not error ]
+        return not errors
+
+    def resolve_file(self, f, action='download'):
+        # type: (Dict, str) -> Tuple[FileEntity, str]
+        ''' Resolve the url, path and size of a manifest entry
+
+        Returns the file, or the problem with the entry
+        '''
+        try:
+            file_entity = FileEntity()
+            file_entity.node_id = f['id']
+            project_id = f.get('project_id') or self.metadata(f['id'], 'project_id')
+            tokens = project_id.split('-')
+            program = (tokens[0]).upper()
+            project = ('-'.join(tokens[1:])).upper()
+
+            if not program or not project:
+                raise RuntimeError('Unable to parse project id {0}'
+                                   .format(project_id))
+
+            file_entity.url = urljoin(
+                self.server, 'v0/submission/{0}/{1}/files/{2}'
+                .format(program, project, f['id']))
+
+
+            # https://github.com/NCI-GDC/gdcapi/pull/426#issue-146068652
+            # [[[ --path takes precedence over everything ]]]
+            # -----------------------------------------------
+            # 1)--path and f[file_name] from manifest_file
+            # 2) --path and UUID's filename, pull filename from API
+            # 3) manifest's local_file_path
+            # 4) manifest's file_name (in current directory)
+            # 5) UUID's resolved files
+
+            # 1) --path and f[file_name] from manifest_file
+            if f.get('path') and f.get('file_name') and \
+                    os.path.exists(os.path.join(f.get('path'), f.get('file_name'))):
+                file_entity.file_path = os.path.join(f.get('path'), f.get('file_name'))
+
+            # 2) --path and UUID's filename, pull filename from API
+            elif f.get('path') and f.get('id') and\
+                    os.path.exists(os.path.join(f.get('path'), self.metadata(f['id'], 'file_name'))):
+                file_entity.file_path = os.path.join(f.get('path'), self.metadata(f['id'], 'file_name'))
+
+            # 3) only local_file_path from manifest file
+            elif f.get('local_file_path') and \
+                    os.path.basename(f.get('local_file_path')) and os.path.exists(f.get('local_file_path')):
+                file_entity.file_path = f.get('local_file_path')
+
+            # 4) only file_name provided by manifest
+            elif f.get('file_name') and os.path.exists(f.get('file_name')):
+                file_entity.file_path = f.get('file_name')
+
+            # 5) UUID given, get filename from api
+            else:
+                file_entity.file_path = self.metadata(f['id'], 'file_name')
+
+            if action == 'delete':
+                return file_entity, None
+
+            with open(file_entity.file_path, 'rb') as fp:
+                file_entity.file_size = os.fstat(fp.fileno()).st_size
+
+            if f.get('file_size') is not None and \
+               int(f['file_size']) != file_entity.file_size:
+                raise RuntimeError(
+                    '{0} is {1} bytes, the manifest says {2}'.format(
+                        file_entity.file_path, file_entity.file_size,
+                        f['file_size']))
+
+            file_entity.upload_id = f.get('upload_id')
+            file_entity.part_size = f.get('part_size')
+            file_entity.md5sum = f.get('md5sum')
+            return file_entity, None
+
+        except KeyError as e:
+            return None, "Please provide {0} from manifest or as an argument" \
+                .format(e.message)
+
         except Exception as e:
-            log.error(e)
-            return False
+            return None, '{0}: {1}'.format(f.get('id'), e)
 
     def load_file(self, file_entity):
         # Load attributes from a UploadFile to self for easy access
         self.__dict__.update(file_entity.__dict__)
 
-    def called(self, arg):
-        if arg:
-            self.pbar.update(self.pbar.currval+1)
-
     def upload(self):
         """ Upload files to the GDC.
+
+        The simple uploads and multipart parts of the files in flight share
+        one pool of workers, so small files and the parts of different files
+        overlap. Each file is completed as soon as its last part is
+        uploaded, and the next file is started in its place.
+
+        Returns the ids of the files that weren't uploaded
         """
-        if os.path.isfile(self.resume_path):
-            use_resume = raw_input("Found an {0}. Press Y to resume last upload and n to start a new upload [Y/n]: ".format(self.resume_path))
+        self.journal = PartJournal(self.resume_path + '.journal')
+        journaled = {}
+        if os.path.isfile(self.resume_path) or os.path.isfile(self.journal.path):
+            found = self.resume_path if os.path.isfile(self.resume_path) \
+                else self.journal.path
+            if self.interactive:
+                use_resume = raw_input("Found an {0}. Press Y to resume last upload and n to start a new upload [Y/n]: ".format(found))
+            else:
+                log.info('Resuming the upload saved in {0}'.format(found))
+                use_resume = 'y'
             if use_resume.lower() not in ['n','no']:
-                with open(self.resume_path,'r') as f:
-                    self.files = manifest.load(f)['files']
+                if os.path.isfile(self.resume_path):
+                    with open(self.resume_path,'r') as f:
+                        self.files = manifest.load(f)['files']
+                journaled = self.journal.load()
+            else:
+                self.journal.remove()
 
         self.get_files()
-        for f in self.file_entities:
-            self.load_file(f)
+        self.uploaded = 0
+        self.open_files = {}
+        self.start_pool()
+        try:
+            indexes = []
+            for index, f in enumerate(self.file_entities):
+                f.pending = f.failed = 0
+                f.done, f.error, f.retried = False, None, False
+                self.apply_journal(f, journaled.get(f.node_id))
+                if f.done:
+                    log.info("Already uploaded file {0}".format(f.node_id))
+                    continue
+                indexes.append(index)
+
+            self.pbar = ProgressBar(widgets=[Percentage(), Bar()],
+                maxval=max(1, sum([ self.file_entities[i].file_size
+                                    for i in indexes ]))).start()
+            self.run_files(indexes)
+            self.pbar.finish()
+
+        except KeyboardInterrupt:
+            log.error("Caught KeyboardInterrupt, terminating workers")
+            self.pool.terminate()
+            self.save_incompleted()
+            raise Exception("Process canceled by user")
+
+        finally:
+            self.stop_pool()
+            for f in self.file_entities:
+                if f.hasher:
+                    f.hasher.cancel()
+
+        return self.save_incompleted()
+
+    def apply_journal(self, f, state):
+        ''' Pick up a file where the journal says a previous run stopped '''
+
+        if not state:
+            return
+
+        if state.get('done'):
+            f.done = True
+            return
+
+        if state['file_size'] != f.file_size or \
+           f.upload_id not in [None, state['upload_id']]:
+            # the file or the upload changed since
+            return
+
+        f.upload_id = state['upload_id']
+        f.part_size = f.part_size or state['part_size']
+        f.journaled = state['parts']
+
+    def start_pool(self):
+        """ One pool of processes, or of threads sharing a session, for
+        every file of the upload """
+
+        self.lost = 0
+
+        if self.engine == THREADS:
+            self.pool = ThreadPool(processes=self.processes)
+            self.session = make_session(self.processes)
+            self.started = None
+        elif OS_WINDOWS:
+            # where Pool is a pool of threads
+            self.pool = Pool(processes=self.processes)
+            self.started = None
+        else:
+            # written through before the task starts, a worker killed
+            # right after still has its task known
+            self.started = SimpleQueue()
+            self.pool = Pool(processes=self.processes,
+                             initializer=watch_tasks,
+                             initargs=(self.started,))
+
+    def stop_pool(self):
+        if self.lost:
+            # the pool waits for the results of the lost tasks otherwise
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+        for f in self.open_files.values():
+            f.close()
+        self.open_files = {}
+
+    def worker_args(self, index, f):
+        """ The session and file handle the threads share """
+
+        if self.engine != THREADS:
+            return []
+
+        if index not in self.open_files:
+            self.open_files[index] = open(f.file_path, 'rb')
+        return [self.session, self.open_files[index]]
 
-            log.info("Attempting to upload to {0}".format(self.url))
-            if not self.multipart:
-                self._upload()
+    def file_tasks(self, index, f):
+        """ The tasks uploading a file, keyed by (index, part, bytes) """
+
+        log.info("Attempting to upload to {0}".format(f.url))
+        threshold = self.part_size or MULTIPART_MIN_PARTS * MIN_PARTSIZE
+        if not self.multipart or f.file_size < threshold:
+            if self.multipart:
+                log.info("File size smaller than {0}, do simple upload".format(threshold))
+            f.pending = 1
+            return [((index, None, f.file_size), upload_simple,
+                     [f.file_path, f.url, self.headers, self.verify,
+                      f.md5sum] +
+                     ([self.session] if self.engine == THREADS else []))]
+
+        try:
+            if f.upload_id and self.list_parts(f) is None:
+                log.warning("Multipart upload {0} is gone, starting over"
+                            .format(f.upload_id))
+                f.upload_id = f.part_size = None
+
+            recorded = f.part_size
+            if f.upload_id and len(f.multiparts):
+                # a resumed upload keeps the part size its parts were
+                # uploaded with, whatever was recorded or asked for since
+                part_size = f.multiparts.part_size(f.file_size, f.part_size)
+                if not part_size:
+                    f.error = "Can't tell the part size of multipart " \
+                              "upload {0}, not resuming it".format(f.upload_id)
+                    log.error(f.error)
+                    return []
+                if part_size != f.part_size:
+                    log.warning('Resuming {0} in parts of {1} bytes, as it '
+                                'was started'.format(f.node_id, part_size))
+                f.part_size = part_size
+
+            if f.upload_id:
+                self.reconcile(f)
+            elif self.initiate(f):
+                # a new upload has no parts to list yet
+                f.multiparts = Multiparts()
             else:
+                f.error = 'Fail to initiate multipart upload'
+                return []
+
+            if not f.part_size:
+                f.part_size = part_size_for(
+                    f.file_size, self.processes, self.part_size)
+            if f.part_size != recorded:
+                self.journal.start(
+                    f.node_id, f.upload_id, f.part_size, f.file_size)
+            log.debug('Uploading {0} in parts of {1} bytes'.format(
+                f.node_id, f.part_size))
+        except Exception as e:
+            log.error('Failure: {0}'.format(e))
+            f.error = e
+            return []
+
+        return self.part_tasks(index, f)
+
+    def reconcile(self, f):
+        ''' Upload again the parts the server lists with another ETag than
+        the journal '''
+
+        for part_number, entry in f.journaled.items():
+            etag = f.multiparts.etags.get(part_number)
+            if etag and entry['etag'] and \
+               etag.strip('"') != entry['etag'].strip('"'):
+                log.warning('Part {0} of {1} changed on the server'.format(
+                    part_number, f.node_id))
+                del f.multiparts.etags[part_number]
+
+    def part_tasks(self, index, f):
+        tasks = []
+        part_amount = f.part_count = \
+            int(math.ceil(f.file_size / float(f.part_size)))
+
+        # started with the file's first parts, not before
+        started = f.hasher is not None
+        if not started:
+            f.hasher = FileHasher(f.file_path, f.file_size, f.part_size)
+
+        for i in xrange(part_amount):
+            offset = i * f.part_size
+            bytes = min(f.file_size - offset, f.part_size)
+            if not f.multiparts.uploaded(i+1):
+                tasks.append(((index, i+1, bytes), upload_multipart,
+                              [f.file_path, offset, bytes,
+                               f.url, f.upload_id, i+1,
+                               self.headers, self.verify] +
+                              self.worker_args(index, f)))
+            else:
+                # uploaded by a previous run, it's read from disk to hash
+                f.hasher.add(i+1)
+                if not started:
+                    self.uploaded += bytes
+                    self.pbar.update(self.uploaded)
+
+        f.pending = len(tasks)
+        if not tasks:
+            # every part was uploaded by a previous run
+            self.finish_multipart(index, f)
+        return tasks
+
+    def run_files(self, indexes):
+        """ Upload the files, with at most files_in_flight of them started
+        at a time. Workers only report whether each task succeeded, the
+        progress and the state of each file are kept here """
+
+        self.results = Queue.Queue()
+        self.in_flight = set()
+        self.scheduled = 0
+        # the tasks whose results are waited for, and the worker process
+        # running each
+        self.outstanding = set()
+        self.running = {}
+
+        waiting = list(reversed(indexes))
+        while waiting or self.scheduled:
+            while waiting and len(self.in_flight) < self.files_in_flight:
+                index = waiting.pop()
+                self.in_flight.add(index)
+                f = self.file_entities[index]
+                self.schedule(index, self.file_tasks(index, f))
+
+            if not self.scheduled:
+                continue
+
+            # a timeout keeps the wait interruptible by Ctrl-C, and
+            # notices the workers that died
+            try:
+                key, uploaded = self.results.get(timeout=WORKER_CHECK_INTERVAL)
+            except Queue.Empty:
+                for key in self.lost_tasks():
+                    self.results.put((key, False))
+                continue
+
+            if key not in self.outstanding:
+                continue
+            self.outstanding.discard(key)
+            self.scheduled -= 1
+            index, part_number, bytes = key
+            self.task_done(index, part_number, bytes, uploaded)
+
+    def lost_tasks(self):
+        """ The tasks of the worker processes that died, whose results
+        will never come """
+
+        if self.started is None:
+            return []
+
+        while not self.started.empty():
+            pid, key = self.started.get()
+            self.running[pid] = key
+
+        lost = []
+        for pid, key in self.running.items():
+            if key not in self.outstanding:
+                del self.running[pid]
+            elif not process_alive(pid):
+                log.error('Upload worker {0} died while uploading part {1} '
+                          'of {2}'.format(pid, key[1],
+                                          self.file_entities[key[0]].node_id))
+                del self.running[pid]
+                lost.append(key)
+        self.lost += len(lost)
+        return lost
+
+    def schedule(self, index, tasks):
+        """ Hand the tasks of a file to the workers, the file is closed
+        if there's nothing left to upload """
+
+        for task in tasks:
+            self.outstanding.add(task[0])
+            self.pool.apply_async(upload_task, (task,),
+                                  callback=self.results.put)
+        self.scheduled += len(tasks)
+
+        f = self.file_entities[index]
+        if f.pending == 0:
+            self.close_file(index, f)
+
+    def close_file(self, index, f):
+        """ Release the handle and hashing thread of a finished file,
+        making room for the next one """
+
+        if index in self.open_files:
+            self.open_files.pop(index).close()
+        if f.hasher and not f.done:
+            f.hasher.cancel()
+        self.in_flight.discard(index)
+
+    def retry_file(self, index, f):
+        """ Upload the parts of a file that failed once more """
+
+        f.retried = True
+        f.failed = 0
+        try:
+            if f.part_size:
+                self.check_multipart(f)
+                return self.part_tasks(index, f)
+            return self.file_tasks(index, f)
+        except Exception as e:
+            log.error('Failure: {0}'.format(e))
+            f.error = e
+            return []
+
+    def task_done(self, index, part_number, bytes, uploaded):
+        f = self.file_entities[index]
+        f.pending -= 1
+        if uploaded:
+            self.uploaded += bytes
+            self.pbar.update(self.uploaded)
+        else:
+            f.failed += 1
+
+        if part_number is None:
+            f.done = bool(uploaded) and self.verify_md5sum(f, uploaded)
+            if f.done:
+                self.journal.done(f.node_id, uploaded)
+                log.info("Upload finished for file {0}".format(f.node_id))
+
+        elif uploaded:
+            etag, md5sum = uploaded
+            f.hasher.add(part_number)
+            if etag:
+                f.multiparts.add(part_number, etag)
+            self.journal.part(f.node_id, f.upload_id, part_number,
+                              etag, bytes, md5sum)
+
+        if f.pending:
+            return
+
+        if not f.failed:
+            if part_number is not None:
+                self.finish_multipart(index, f)
+            self.close_file(index, f)
+
+        elif not f.retried and not f.error:
+            # try again in case some parts failed
+            self.schedule(index, self.retry_file(index, f))
 
-                if self.file_size < self.part_size:
-                    log.info("File size smaller than part size {0}, do simple upload".format(self.part_size))
-                    self._upload()
-                else:
-                    self.multipart_upload()
-            self.incompleted.popleft()
+        else:
+            self.close_file(index, f)
+
+    def finish_multipart(self, index, f):
+        try:
+            md5sum = f.hasher.hexdigest()
+            if not self.verify_md5sum(f, md5sum):
+                return
+            self.complete(f)
+            f.done = True
+            self.journal.done(f.node_id, md5sum)
+        except Exception as e:
+            log.error('Failure: {0}'.format(e))
+            f.error = e
+
+    def verify_md5sum(self, f, md5sum):
+        ''' Check the md5sum of what was uploaded against the manifest '''
+
+        if f.md5sum and f.md5sum != md5sum:
+            f.error = 'md5sum of {0} is {1}, the manifest says {2}'.format(
+                f.file_path, md5sum, f.md5sum)
+            log.error(f.error)
+            return False
+
+        log.debug('md5sum of {0} is {1}'.format(f.file_path, md5sum))
+        return True
+
+    def save_incompleted(self):
+        """ Save the files that weren't uploaded, with their multipart
+        upload ids, so that the upload can be resumed. Returns their ids """
+
+        entities = dict([ (f.node_id, f) for f in self.file_entities ])
+        incompleted = []
+        for entry in self.files:
+            f = entities.get(entry['id'])
+            if f and f.done:
+                continue
+            if f and f.upload_id:
+                entry = dict(entry, upload_id=f.upload_id,
+                             part_size=f.part_size)
+            incompleted.append(entry)
+
+        if not incompleted:
+            self.journal.remove()
+            self.cleanup()
+            return []
+
+        self.journal.close()
+
+        log.warning("Saving unfinished upload file")
+        with open(self.resume_path, 'w') as f:
+            f.write(
+                yaml.dump({"files": incompleted},
+                          default_flow_style=False))
+        log.info('Saved to {0}'.format(self.resume_path))
+        if self.debug:
+            raise Exception('{0} files were not uploaded'.format(len(incompleted)))
+        return [ entry.get('id') for entry in incompleted ]
 
     def abort(self):
         ''' Abort multipart upload'''
@@ -364,168 +1064,99 @@ class GDCUploadClient(object):
             else:
                 log.warning("Fail to delete file {0}: {1}".format(self.node_id, r.text))
 
-    def _upload(self):
-        '''Simple S3 PUT'''
-
-        with open(self.file_path, 'rb') as f:
-            try:
-                r = requests.put(self.url+"/_dry_run", headers=self.headers, verify=self.verify)
-                if r.status_code != 200:
-                    log.error("Can't upload:{0}".format(r.text))
-                    return
-                self.pbar = ProgressBar(
-                    widgets=[Percentage(), Bar()], maxval=self.file_size).start()
-                stream = Stream(f, self.pbar, self.file_size)
-
-
-                r = requests.put(
-                    self.url, data=stream, headers=self.headers,
-                    verify=self.verify)
-                if r.status_code != 200:
-                    log.error("Upload failed {0}".format(r.text))
-                    return
-                self.pbar.finish()
-                self.cleanup()
-                log.info("Upload finished for file {0}".format(self.node_id))
-            except Exception as e:
-                log.error("Upload failed {0}".format(e.message))
-
-    def multipart_upload(self):
-        '''S3 Multipart upload'''
-        if self.initiate():
-            with self.handle_multipart():
-                # wait for S3 server to create this multipart upload
-                self.check_multipart()
-                self.upload_parts()
-                self.check_multipart()
-                # try again in case some parts failed
-                if self.ns.completed != self.total_parts:
-                    self.upload_parts()
-                self.complete()
-
-    @contextlib.contextmanager
-    def handle_multipart(self):
-        try:
-            yield
-            self.upload_id = None
-            if os.path.isfile(self.resume_path):
-                os.remove(self.resume_path)
-        except Exception as e:
-            log.warning("Saving unfinished upload file")
-            if self.upload_id:
-                self.incompleted[0]['upload_id'] = self.upload_id
-            path = self.resume_path
-            with open(path, 'w') as f:
-                f.write(
-                    yaml.dump({"files": list(self.incompleted)},
-                              default_flow_style=False))
-            log.info('Saved to {0}'.format(path))
-            if self.debug:
-                raise
-            else:
-                log.error('Failure: {0}'.format(e.message))
-
-    def check_multipart(self):
-        tries = MAX_RETRIES
-
-        while tries:
-            if self.list_parts() is None:
-                tries -= 1
-                time.sleep(get_sleep_time(tries))
-
-            else:
-                return
-        raise Exception(
-            "Can't find multipart upload with upload id {0}"
-            .format(self.upload_id))
+    def check_multipart(self, f):
+        if self.list_parts(f) is None:
+            raise Exception(
+                "Can't find multipart upload with upload id {0}"
+                .format(f.upload_id))
 
-    def initiate(self):
-        if not self.upload_id:
+    def initiate(self, f):
+        if not f.upload_id:
             r = requests.post(
-                self.url+"?uploads", headers=self.headers, verify=self.verify)
+                f.url+"?uploads", headers=self.headers, verify=self.verify)
             if r.status_code == 200:
                 xml = XMLResponse(r.text)
-                self.upload_id = xml.get_key('UploadId')
-                log.info("Start multipart upload: {0}".format(self.upload_id))
+                f.upload_id = xml.get_key('UploadId')
+                log.info("Start multipart upload: {0}".format(f.upload_id))
                 return True
             else:
                 log.error("Fail to initiate multipart upload: {0}".format(r.text))
                 return False
         return True
 
-    def upload_parts(self):
-        args_list = []
-        if OS_WINDOWS:
-            self.ns = FakeNamespace()
-        else:
-            manager = Manager()
-            self.ns = manager.Namespace()
-            self.ns.completed = 0
-        part_amount = int(math.ceil(self.file_size / float(self.part_size)))
-        self.total_parts = part_amount
-        self.pbar = ProgressBar(
-            widgets=[Percentage(), Bar()], maxval=self.total_parts).start()
-        try:
-            for i in xrange(part_amount):
-                offset = i * self.part_size
-                remaining_bytes = self.file_size - offset
-                bytes = min(remaining_bytes, self.part_size)
-                if not self.multiparts.uploaded(i+1):
-                    args_list.append([self.file_path, offset, bytes,
-                                      self.url, self.upload_id, i+1,
-                                      self.headers, self.verify,
-                                      self.pbar, self.ns])
-                else:
-                    self.total_parts -= 1
-            if self.total_parts == 0:
-                return
-            self.pbar.maxval = self.total_parts
+    def list_parts(self, f):
+        ''' List every uploaded part, a page at a time
 
-            pool = Pool(processes=self.processes)
-            pool.map_async(upload_multipart_wrapper, args_list).get(9999999)
-            pool.close()
-            pool.join()
-        except KeyboardInterrupt:
-            log.error("Caught KeyboardInterrupt, terminating workers")
-            pool.terminate()
-            pool.join()
-            raise Exception("Process canceled by user")
+        Returns None if the upload is gone. A page that fails for a while
+        is asked for again, any other failure is raised
+        '''
 
-    def list_parts(self):
-        r = requests.get(self.url+"?uploadId={0}".format(self.upload_id),
-                         headers=self.headers, verify=self.verify)
-        if r.status_code == 200:
-            self.multiparts = Multiparts(r.text)
-            return self.multiparts
-        elif r.status_code in [403, 400]:
-            raise Exception(r.text)
-        return None
+        multiparts = Multiparts()
+        marker = None
+        tries = MAX_RETRIES
+        while True:
+            url = f.url+"?uploadId={0}&max-parts={1}".format(
+                f.upload_id, LIST_PARTS_PAGE_SIZE)
+            if marker:
+                url += "&part-number-marker={0}".format(marker)
 
-    def complete(self):
-        self.check_multipart()
-        if self.ns.completed != self.total_parts:
+            try:
+                r = requests.get(url, headers=self.headers,
+                                 verify=self.verify, stream=True)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                error, r = str(e), None
+
+            if r is not None and r.status_code == 404:
+                # NoSuchUpload: aborted, completed or expired
+                log.debug('Multipart upload {0} not found: {1}'.format(
+                    f.upload_id, r.text))
+                r.close()
+                return None
+            elif r is None or r.status_code >= 500 or r.status_code == 429:
+                if r is not None:
+                    error = '{0} {1}'.format(r.status_code, r.text)
+                    r.close()
+                tries -= 1
+                if not tries:
+                    raise Exception("Fail to list the parts of {0}: {1}"
+                                    .format(f.upload_id, error))
+                log.warning("Fail to list the parts of {0}, retrying: {1}"
+                            .format(f.upload_id, error))
+                time.sleep(get_sleep_time(tries))
+                continue
+            elif r.status_code != 200:
+                error = r.text
+                r.close()
+                raise Exception(error)
+
+            r.raw.decode_content = True
+            marker = multiparts.update(r.raw)
+            r.close()
+            if marker is None:
+                break
+
+        f.multiparts = multiparts
+        return f.multiparts
+
+    def complete(self, f):
+        # the ETags of the parts were kept as they were uploaded
+        if len(f.multiparts) < f.part_count:
+            self.check_multipart(f)
+        if len(f.multiparts) != f.part_count:
             raise Exception(
                 """Multipart upload failed for file {0}:
                 completed parts:{1}, total parts: {2}, please try to resume"""
-                .format(self.node_id, self.ns.completed, self.total_parts))
+                .format(f.node_id, len(f.multiparts), f.part_count))
 
-        self.pbar.finish()
-        url = self.url+"?uploadId={0}".format(self.upload_id)
-        tries = MAX_RETRIES
-        tries = 1
-        while tries > 0:
-            r = requests.post(url,
-                              data=self.multiparts.to_xml(),
-                              headers=self.headers,
-                              verify=self.verify)
-            if r.status_code != 200:
-                tries -= 1
-                time.sleep(get_sleep_time(tries))
-
-            else:
-                log.info("Multipart upload finished for file {0}".format(self.node_id))
-                return
-        raise Exception("Multipart upload complete failed: {0}".format(r.text))
+        url = f.url+"?uploadId={0}".format(f.upload_id)
+        r = requests.post(url,
+                          data=f.multiparts.to_xml(),
+                          headers=self.headers,
+                          verify=self.verify)
+        if r.status_code != 200:
+            raise Exception("Multipart upload complete failed: {0}".format(r.text))
+        log.info("Multipart upload finished for file {0}".format(f.node_id))
 
     def cleanup(self):
         if os.path.isfile(self.resume_path):
@@ -543,29 +1174,108 @@ class FileEntity(object):
         self.path = None
         self.file_size = None
         self.upload_id = None
+        self.part_size = None
+
+        # multipart upload state
+        self.multiparts = None
+        self.part_count = 0
+        self.journaled = {}
+        self.md5sum = None
+        self.hasher = None
+        self.pending = 0
+        self.failed = 0
+        self.done = False
+        self.error = None
 
 
 class Multiparts(object):
+    ''' The ETags of the uploaded parts of a multipart upload '''
 
-    def __init__(self, xml_string):
-        self.xml = XMLResponse(xml_string)
-        self.parts = self.xml.parse("Part")
+    def __init__(self, xml=None):
+        # part number: ETag
+        self.etags = dict()
+        # part number: size, of the parts listed by the server
+        self.sizes = dict()
+        if xml is not None:
+            self.update(xml)
+
+    def __len__(self):
+        return len(self.etags)
+
+    def update(self, xml):
+        ''' Add the parts of a page of ListParts, read as it streams in
+
+        Returns the part number marker of the next page, if the parts are
+        truncated
+        '''
+
+        if isinstance(xml, basestring):
+            xml = StringIO(str(xml))
+
+        part = dict()
+        truncated, marker, last = False, None, None
+        for _, element in etree.iterparse(xml, events=('end',)):
+            tag = element.tag.split('}')[-1]
+            if tag in ['PartNumber', 'ETag', 'Size']:
+                part[tag] = element.text
+            elif tag == 'Part':
+                last = int(part['PartNumber'])
+                self.add(last, part['ETag'])
+                if part.get('Size') is not None:
+                    self.sizes[last] = long(part['Size'])
+                part = dict()
+                element.clear()
+            elif tag == 'IsTruncated':
+                truncated = element.text == 'true'
+            elif tag == 'NextPartNumberMarker':
+                marker = element.text
+
+        return (marker or last) if truncated else None
+
+    def add(self, part_number, etag):
+        self.etags[part_number] = etag
 
     def to_xml(self):
         root = etree.Element("CompleteMultipartUpload")
-        for part in self.parts:
+        for number, tag in sorted(self.etags.items()):
             xml_part = etree.SubElement(root, "Part")
             part_number = etree.SubElement(xml_part, "PartNumber")
-            part_number.text = part['PartNumber']
+            part_number.text = str(number)
             etag = etree.SubElement(xml_part, "ETag")
-            etag.text = part["ETag"]
+            etag.text = tag
         return str(etree.tostring(root))
 
     def uploaded(self, part_number):
-        for part in self.parts:
-            if int(part['PartNumber']) == part_number:
-                return True
-        return False
+        return part_number in self.etags
+
+    def part_size(self, file_size, recorded=None):
+        ''' The part size the listed parts were uploaded with, the recorded
+        one if it fits them
+
+        Every part but the last of the file is a whole part, so each listed
+        part is either one, or the rest of the file. None if the sizes
+        don't tell, or fit no part size
+        '''
+
+        if not self.sizes or len(self.sizes) < len(self.etags):
+            return None
+
+        candidates = set(self.sizes.values())
+        for n, size in self.sizes.items():
+            if n > 1 and (file_size - size) % (n - 1) == 0:
+                candidates.add((file_size - size) / (n - 1))
+        if recorded:
+            candidates.add(recorded)
+
+        def fits(part_size):
+            return part_size > 0 and all([
+                size == min(part_size, file_size - (n - 1) * part_size)
+                for n, size in self.sizes.items() ])
+
+        fitting = [ c for c in candidates if fits(c) ]
+        if recorded in fitting:
+            return recorded
+        return fitting[0] if len(fitting) == 1 else None
 
 
 class XMLResponse(object):
@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+
+
+log = logging.getLogger('upload-journal')
+
+
+class PartJournal(object):
+    """ Append-only record of the multipart uploads of a manifest
+
+    A line is appended, and synced to disk, as each upload is started, each
+    part is uploaded and each file is finished. Unlike the resume manifest,
+    which is only written when an upload fails cleanly, the journal is
+    there after the process is killed, so a restart can continue each
+    upload where it stopped.
+
+        {"id": ..., "upload_id": ..., "part_size": ..., "file_size": ...}
+        {"id": ..., "upload_id": ..., "part": 1, "etag": ..., "size": ..., "md5": ...}
+        {"id": ..., "done": true, "md5": ...}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def load(self):
+        # type: () -> Dict[str, Dict]
+        """ The state of each file, by id
+
+        The last upload started for a file wins, and a line cut short by a
+        crash is ignored.
+        """
+
+        files = dict()
+        if not os.path.isfile(self.path):
+            return files
+
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+
+                file_id = entry.get('id')
+                if entry.get('done'):
+                    files[file_id] = {'done': True}
+
+                elif 'part' in entry:
+                    state = files.get(file_id)
+                    if state and state.get('upload_id') == entry['upload_id']:
+                        state['parts'][entry['part']] = entry
+
+                elif 'upload_id' in entry:
+                    files[file_id] = dict(entry, parts=dict())
+
+        return files
+
+    def _append(self, entry):
+        if self.f is None:
+            self.f = open(self.path, 'a')
+
+        self.f.write(json.dumps(entry) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def start(self, file_id, upload_id, part_size, file_size):
+        self._append({'id': file_id, 'upload_id': upload_id,
+                      'part_size': part_size, 'file_size': file_size})
+
+    def part(self, file_id, upload_id, part_number, etag, size, md5sum):
+        self._append({'id': file_id, 'upload_id': upload_id,
+                      'part': part_number, 'etag': etag, 'size': size,
+                      'md5': md5sum})
+
+    def done(self, file_id, md5sum=None):
+        self._append({'id': file_id, 'done': True, 'md5': md5sum})
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def remove(self):
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
@@ -3,11 +3,12 @@ import argparse
 from functools import partial
 
 from .. import defaults
+from .. import netbind
 
 from . import manifest
 from . import exceptions
 
-from .client import GDCUploadClient
+from .client import GDCUploadClient, ENGINES, PROCESSES
 import logging
 
 
@@ -33,6 +34,10 @@ def upload(parser, args):
     """
     validate_args(parser, args)
 
+    # the part uploads are spread across the local addresses
+    if args.source_address:
+        netbind.bind_source_addresses(args.source_address)
+
     files = manifest.load(args.manifest)['files'] if args.manifest else []
 
     for f in files:
@@ -58,14 +63,16 @@ def upload(parser, args):
         server=args.server,
         files=files,
         verify=args.insecure,
-        manifest_name=manifest_name)
+        manifest_name=manifest_name,
+        engine=args.upload_engine,
+        files_in_flight=args.files_in_flight)
 
     if args.abort:
         client.abort()
     elif args.delete:
         client.delete()
     else:
-        client.upload()
+        return client.upload()
 
 def config(parser):
     """ Configure a parser for upload.
@@ -87,13 +94,26 @@ def config(parser):
     parser.add_argument('--server', '-s',
                         default=defaults.tcp_url,
                         help='GDC API server address')
+    parser.add_argument('--source-address', metavar='ADDRESS[,ADDRESS...]',
+                        type=netbind.argparse_type, default=[],
+                        dest='source_address',
+                        help='Local addresses or interfaces the connections '
+                        'are bound to in turn')
     parser.add_argument('--http-chunk-size', '-c',
-                        default=defaults.HTTP_CHUNK_SIZE,
                         type=int,
-                        help='Part size for multipart upload')
+                        help='Part size for multipart upload, chosen per '
+                        'file from its size and -n by default')
     parser.add_argument('-n', '--n-processes', type=int,
                         default=defaults.processes,
                         help='Number of client connections')
+    parser.add_argument('--files-in-flight', type=int,
+                        dest='files_in_flight',
+                        help='Number of files uploaded at a time, each with '
+                        'an open handle. Defaults to twice -n')
+    parser.add_argument('--upload-engine', choices=ENGINES,
+                        default=PROCESSES,
+                        help='Upload the parts from a pool of processes, or '
+                        'of threads sharing one session and file handle')
     parser.add_argument('--disable-multipart',
                         action="store_false",
                         help='Disable multipart upload')
@@ -99,3 +99,12 @@ uuids = {
         'access': 'open',
     },
 }
+
+# the proxy only caches files named by a UUID
+proxy_uuids = {
+    'small': '0a1b2c3d-0000-4000-8000-000000000001',
+    'small_no_friends': '0a1b2c3d-0000-4000-8000-000000000002',
+    'big': '0a1b2c3d-0000-4000-8000-000000000003',
+}
+for name, uuid in proxy_uuids.items():
+    uuids[uuid] = uuids[name]
@@ -2,8 +2,12 @@ from flask import Flask, Response, jsonify, request
 from StringIO import StringIO
 from conftest import uuids, make_tarfile
 
+import base64
+import gzip
+import hashlib
 import json
 import os
+import re
 import tarfile
 
 app = Flask(__name__)
@@ -95,6 +99,11 @@ def files():
     result['data']['pagination']['size'] = size
     return jsonify(result)
 
+@app.route('/status', methods=['GET'])
+@app.route('/v0/status', methods=['GET'])
+def status():
+    return jsonify({'status': 'OK'})
+
 @app.route('/data', methods=['POST'])
 @app.route('/v0/data', methods=['POST'])
 @app.route('/legacy/data', methods=['POST'])
@@ -146,10 +155,141 @@ def download(ids=''):
     else:
         data = uuids[ids[0]]['contents']
 
+    byte_range = request.headers.get('Range')
+    if byte_range and not (is_tarfile or is_compress):
+        start, end = byte_range.split('=')[1].split('-')
+        if not start:
+            start, end = len(data) - int(end), len(data) - 1
+        start, end = int(start), min(int(end or len(data) - 1), len(data) - 1)
+
+        resp = Response(data[start:end+1], status=206)
+        resp.headers['Content-Range'] = \
+            'bytes {0}-{1}/{2}'.format(start, end, len(data))
+        resp.headers['Content-Disposition'] = \
+            'attachment; filename={0}'.format(filename)
+        return resp
+
+    # only the client's transfer compression asks for gzip alone
+    is_gzip = request.headers.get('Accept-Encoding') == 'gzip'
+    if is_gzip and not (is_tarfile or is_compress):
+        s = StringIO()
+        with gzip.GzipFile(fileobj=s, mode='wb') as g:
+            g.write(data)
+        data = s.getvalue()
+
     resp = Response(data)
     resp.headers['Content-Disposition'] = \
         'attachment; filename={0}'.format(filename)
 
+    if is_gzip and not (is_tarfile or is_compress):
+        resp.headers['Content-Encoding'] = 'gzip'
+
     resp.headers['Content-Type'] = 'application/octet-stream'
     return resp
 
+
+
+# submission graphql: every node is a submitted_unaligned_reads of TCGA-TEST
+# whose file name is <node id>.bam, unless its id starts with missing
+GRAPHQL_FIELD = re.compile(r'(?:(\w+): )?(\w+) \(id: "([^"]+)"\)')
+
+@app.route('/v0/submission/graphql', methods=['POST'])
+def graphql():
+    data = {}
+    for alias, field, node_id in GRAPHQL_FIELD.findall(
+            json.loads(request.get_data())['query']):
+        if node_id.startswith('missing'):
+            node = []
+        elif field == 'node':
+            node = [{'type': 'submitted_unaligned_reads'}]
+        else:
+            node = [{'project_id': 'TCGA-TEST',
+                     'file_name': '{0}.bam'.format(node_id)}]
+        data[alias or field] = node
+
+    return jsonify({'data': data})
+
+# uploaded files and the parts of unfinished multipart uploads
+uploads = {}
+uploaded = {}
+
+S3_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+@app.route('/v0/submission/<program>/<project>/files/<file_id>',
+           methods=['GET', 'PUT', 'POST', 'DELETE'])
+@app.route('/v0/submission/<program>/<project>/files/<file_id>/_dry_run',
+           methods=['PUT'])
+def submission(program, project, file_id):
+
+    if request.path.endswith('/_dry_run'):
+        content_md5 = request.headers.get('Content-MD5')
+        if content_md5 and \
+           base64.b64decode(content_md5) != hashlib.md5('').digest():
+            return Response('BadDigest', status=400)
+        return ''
+
+    upload_id = request.args.get('uploadId')
+
+    if request.method == 'POST' and 'uploads' in request.args:
+        uploads[file_id] = {}
+        return '<InitiateMultipartUploadResult xmlns="{0}">' \
+               '<UploadId>{1}</UploadId>' \
+               '</InitiateMultipartUploadResult>'.format(S3_NAMESPACE, file_id)
+
+    if request.method == 'PUT' and upload_id:
+        data = request.get_data()
+        content_md5 = request.headers.get('Content-MD5')
+        if content_md5 and \
+           base64.b64decode(content_md5) != hashlib.md5(data).digest():
+            return Response('BadDigest', status=400)
+        uploads[upload_id][int(request.args['partNumber'])] = data
+        resp = Response('')
+        resp.headers['ETag'] = '"{0}"'.format(hashlib.md5(data).hexdigest())
+        return resp
+
+    if request.method == 'GET' and upload_id:
+        if upload_id not in uploads:
+            return Response('NoSuchUpload', status=404)
+        marker = int(request.args.get('part-number-marker', 0))
+        max_parts = int(request.args.get('max-parts', 1000))
+        page = [ (n, data) for n, data in sorted(uploads[upload_id].items())
+                 if n > marker ]
+        truncated = len(page) > max_parts
+        page = page[:max_parts]
+
+        parts = ''.join([
+            '<Part><PartNumber>{0}</PartNumber><ETag>"{1}"</ETag>'
+            '<Size>{2}</Size></Part>'.format(
+                n, hashlib.md5(data).hexdigest(), len(data))
+            for n, data in page ])
+        if truncated:
+            parts += '<IsTruncated>true</IsTruncated>' \
+                     '<NextPartNumberMarker>{0}</NextPartNumberMarker>' \
+                     .format(page[-1][0])
+        return '<ListPartsResult xmlns="{0}">{1}</ListPartsResult>'.format(
+                S3_NAMESPACE, parts)
+
+    if request.method == 'POST' and upload_id:
+        parts = uploads.pop(upload_id)
+        uploaded[file_id] = ''.join([ parts[n] for n in sorted(parts) ])
+        return '<CompleteMultipartUploadResult xmlns="{0}">' \
+               '</CompleteMultipartUploadResult>'.format(S3_NAMESPACE)
+
+    if request.method == 'PUT':
+        data = request.get_data()
+        content_md5 = request.headers.get('Content-MD5')
+        if content_md5 and \
+           base64.b64decode(content_md5) != hashlib.md5(data).digest():
+            return Response('BadDigest', status=400)
+        uploaded[file_id] = data
+        return ''
+
+    if request.method == 'DELETE':
+        uploads.pop(upload_id, None)
+        uploaded.pop(file_id, None)
+        return Response('', status=204)
+
+    # what was uploaded, for the tests to check
+    if file_id not in uploaded:
+        return Response('Not found', status=404)
+    return uploaded[file_id]
@@ -1,16 +1,29 @@
-from conftest import md5, uuids, make_tarfile
-from gdc_client.download.client import GDCHTTPDownloadClient
+from conftest import md5, uuids, make_tarfile, proxy_uuids
+from gdc_client import netbind
+from gdc_client.download import archive, endpoints, plan, preflight
+from gdc_client.download.client import GDCHTTPDownloadClient, NOT_COMPRESSED
+from gdc_client.download.client import THREADS
+from gdc_client.download.hooks import HookPool
+from gdc_client.download.migrate import Migrator, directory_size
+from gdc_client.download.placement import Placement
+from gdc_client.download.tarstream import TarStream
+from gdc_client.proxy.server import ProxyServer
 from gdc_client.query.index import GDCIndexClient
 from multiprocessing import Process, cpu_count
 from parcel.const import HTTP_CHUNK_SIZE, SAVE_INTERVAL
+from requests.packages.urllib3.util import connection
 from unittest import TestCase
 
+import json
 import logging
 import mock_server
 import os
 import os.path
+import requests
+import shutil
 import StringIO
 import tarfile
+import threading
 import time
 
 # default values for flask
@@ -139,3 +152,534 @@ class DownloadClientTest(TestCase):
                 contents = m.read()
                 assert contents == uuids[m.name]['contents']
                 os.remove(tarfile_name)
+
+    def test_refused_group(self):
+        files_to_dl = ['small', 'small_no_friends']
+
+        index_client = GDCIndexClient(base_url)
+        index_client._get_metadata(files_to_dl)
+
+        client = GDCHTTPDownloadClient(
+                uri=base_url,
+                index_client=index_client,
+                **client_kwargs)
+
+        client._download_tarfile = lambda s: ('', [])
+        client.download_big_files = lambda urls: (
+            urls[:1], dict([ (u, '403 Forbidden') for u in urls[1:] ]))
+
+        # the access of the group is known, so it stays refused
+        errors, count = client.download_small_groups([files_to_dl])
+        assert count == 0
+        assert errors == []
+
+        # the access came from nowhere, so each file is tried on its own
+        for f in files_to_dl:
+            index_client.metadata[f]['access'] = None
+
+        errors, count = client.download_small_groups([files_to_dl])
+        assert count == 1
+        assert errors == [['small_no_friends']]
+
+    def test_plan_round_trip(self):
+        files_to_dl = ['small_no_friends', 'big_no_friends']
+        plan_name = 'test_plan.json'
+
+        index_client = GDCIndexClient(base_url)
+        bigs, smalls = index_client.separate_small_files(
+                files_to_dl, HTTP_CHUNK_SIZE)
+
+        client = GDCHTTPDownloadClient(
+                uri=base_url,
+                index_client=index_client,
+                **client_kwargs)
+
+        plan.dump(plan.build(index_client, client, bigs, smalls), plan_name)
+
+        # a fresh index client is populated from the plan alone
+        planned_index = GDCIndexClient(base_url)
+        planned_bigs, planned_smalls = plan.load(plan_name, planned_index)
+        os.remove(plan_name)
+
+        assert planned_bigs == bigs
+        assert planned_smalls == smalls
+        for f in files_to_dl:
+            assert planned_index.get_md5sum(f) == uuids[f]['md5sum']
+            assert planned_index.get_filesize(f) == uuids[f]['file_size']
+
+    def test_download_ranges(self):
+        index_client = GDCIndexClient(base_url)
+        client = GDCHTTPDownloadClient(
+                uri=base_url,
+                index_client=index_client,
+                **client_kwargs)
+
+        contents = uuids['small_no_friends']['contents']
+        errors = client.download_ranges(
+                'small_no_friends', [(0, 4), (None, 3)])
+        assert errors == []
+
+        path = os.path.join('small_no_friends', 'test_file.txt.sparse')
+        with open(path, 'rb') as f:
+            sparse = f.read()
+        os.remove(path)
+
+        assert len(sparse) == len(contents)
+        assert sparse[:5] == contents[:5]
+        assert sparse[-3:] == contents[-3:]
+
+        errors = client.download_ranges(
+                'small_no_friends', [(6, 12)], slices=True)
+        assert errors == []
+
+        path = os.path.join('small_no_friends', 'test_file.txt.6-12')
+        with open(path, 'rb') as f:
+            assert f.read() == contents[6:13]
+        os.remove(path)
+
+        # neither was completed, ranges of the whole file are once they
+        # match its md5sum
+        completed = []
+        client._file_completed = completed.append
+        index_client._get_metadata(['small_no_friends'])
+        errors = client.download_ranges(
+                'small_no_friends', [(0, 6), (5, None)])
+        assert errors == [] and completed == ['small_no_friends']
+        with open(os.path.join('small_no_friends', 'test_file.txt')) as f:
+            assert f.read() == contents
+        shutil.rmtree('small_no_friends')
+
+        index_client.metadata['small_no_friends']['md5sum'] = md5('other')
+        errors = client.download_ranges('small_no_friends', [(0, None)])
+        assert len(errors) == 1 and completed == ['small_no_friends']
+        shutil.rmtree('small_no_friends')
+
+    def test_download_ranges_retry(self):
+        index_client = GDCIndexClient(base_url)
+        client = GDCHTTPDownloadClient(
+                uri=base_url,
+                index_client=index_client,
+                **client_kwargs)
+
+        # the first request of each range fails, the retry is written
+        get = client.session.get
+        attempts = []
+        def flaky_get(*args, **kwargs):
+            attempts.append(kwargs['headers']['Range'])
+            if attempts.count(kwargs['headers']['Range']) == 1:
+                raise IOError('connection reset')
+            return get(*args, **kwargs)
+        client.session.get = flaky_get
+
+        errors = client.download_ranges(
+                'small_no_friends', [(6, 12)], slices=True)
+        assert errors == []
+        assert len(attempts) == 2
+
+        path = os.path.join('small_no_friends', 'test_file.txt.6-12')
+        with open(path, 'rb') as f:
+            assert f.read() == uuids['small_no_friends']['contents'][6:13]
+        os.remove(path)
+
+        # out of retries, the failure is returned rather than raised
+        client.range_retries = 0
+        errors = client.download_ranges(
+                'small_no_friends', [(0, 4)], slices=True)
+        assert len(errors) == 1
+        os.rmdir('small_no_friends')
+
+    def test_threads_engine(self):
+        index_client = GDCIndexClient(base_url)
+        index_client._get_metadata(['big_no_friends'])
+
+        client = GDCHTTPDownloadClient(
+                uri=base_url,
+                index_client=index_client,
+                engine=THREADS,
+                **client_kwargs)
+
+        # downloaded in a range per connection and checked as a whole
+        completed = []
+        client._file_completed = completed.append
+        url = base_url + '/data/big_no_friends'
+        downloaded, errors = client.download_big_files([url])
+        assert downloaded == [url] and errors == {}
+        assert completed == ['big_no_friends']
+
+        path = os.path.join('big_no_friends', 'test_file.txt')
+        with open(path, 'rb') as f:
+            assert f.read() == uuids['big_no_friends']['contents']
+        shutil.rmtree('big_no_friends')
+
+        index_client.metadata['big_no_friends']['md5sum'] = md5('other')
+        downloaded, errors = client.download_big_files([url])
+        assert downloaded == [] and errors[url] == \
+            'ranges of the whole file have invalid md5sum'
+        assert completed == ['big_no_friends']
+        shutil.rmtree('big_no_friends')
+
+    def test_download_compressed(self):
+        index_client = GDCIndexClient(base_url)
+        index_client._get_metadata(['small_no_friends'])
+
+        client = GDCHTTPDownloadClient(
+                uri=base_url,
+                index_client=index_client,
+                **client_kwargs)
+
+        # decompressed on the fly and checked against the md5sum
+        assert client.download_compressed('small_no_friends') == None
+
+        path = os.path.join('small_no_friends', 'test_file.txt')
+        with open(path, 'rb') as f:
+            assert f.read() == uuids['small_no_friends']['contents']
+        os.remove(path)
+
+        # a stream that breaks off leaves nothing behind
+        get = client.session.get
+        def broken_get(*args, **kwargs):
+            r = get(*args, **kwargs)
+            def iter_content(size):
+                raise IOError('connection reset')
+            r.iter_content = iter_content
+            return r
+        client.session.get = broken_get
+
+        assert client.download_compressed('small_no_friends') == 'connection reset'
+        assert os.listdir('small_no_friends') == []
+
+        # left to parcel when the server doesn't compress
+        def plain_get(*args, **kwargs):
+            kwargs['headers'].pop('Accept-Encoding')
+            return get(*args, **kwargs)
+        client.session.get = plain_get
+
+        assert client.download_compressed('small_no_friends') == NOT_COMPRESSED
+        os.rmdir('small_no_friends')
+
+    def test_migrator(self):
+        staging, directory = 'test_staging', 'test_dir'
+        for d in [staging, directory]:
+            os.mkdir(d)
+
+        for f in ['small', 'small_ann']:
+            os.mkdir(os.path.join(staging, f))
+            with open(os.path.join(staging, f, 'test_file.txt'), 'w') as t:
+                t.write(uuids[f]['contents'])
+
+        assert directory_size(os.path.join(staging, 'small')) == \
+            uuids['small']['file_size']
+
+        migrator = Migrator(staging, directory, workers=2)
+        migrator.submit('small')
+        migrator.submit('small_ann')
+        migrator.submit('small_missing')
+
+        # each file of a group that can't be moved is an error
+        migrator.submit('group_missing', ['small_rel', 'small_no_friends'])
+
+        assert sorted(migrator.join()) == \
+            ['small_missing', 'small_no_friends', 'small_rel']
+        assert os.listdir(staging) == []
+        for f in ['small', 'small_ann']:
+            with open(os.path.join(directory, f, 'test_file.txt')) as t:
+                assert t.read() == uuids[f]['contents']
+
+        shutil.rmtree(staging)
+        shutil.rmtree(directory)
+
+    def test_placement(self):
+        roots = ['test_root_1', 'test_root_2']
+
+        placement = Placement(roots)
+        assert placement.root('small') == os.path.abspath(roots[0])
+        assert placement.root('small_ann') == os.path.abspath(roots[1])
+        assert placement.root('small_rel') == os.path.abspath(roots[0])
+
+        # a file stays where it was placed
+        assert placement.root('small_ann') == os.path.abspath(roots[1])
+        placement.write_index()
+
+        # and is found there on the next run
+        placement = Placement(list(reversed(roots)),
+                index_path=placement.index_path)
+        assert placement.root('small_ann') == os.path.abspath(roots[1])
+
+        for r in roots:
+            shutil.rmtree(r)
+
+    def test_keep_group(self):
+        files_to_tar = ['small', 'small_ann', 'small_no_friends']
+        tarfile_name = make_tarfile(files_to_tar)
+        directory = archive.group_name(files_to_tar)
+
+        index = archive.keep_group(tarfile_name, directory)
+        assert not os.path.exists(tarfile_name)
+
+        group = archive.load_archives(['.'])['small_ann']
+        for f in files_to_tar:
+            assert index[f]['md5sum'] == uuids[f]['md5sum']
+            assert group.read(f) == uuids[f]['contents']
+
+        with group.open('small') as f:
+            f.seek(6)
+            assert f.read(7) == uuids['small']['contents'][6:13]
+
+        shutil.rmtree(directory)
+
+    def test_stream_files(self):
+        index_client = GDCIndexClient(base_url)
+        index_client._get_metadata(['small', 'small_no_friends', 'big'])
+
+        client = GDCHTTPDownloadClient(
+                uri=base_url,
+                index_client=index_client,
+                **client_kwargs)
+
+        s = StringIO.StringIO()
+        out = TarStream(s)
+        errors = client.stream_files(['big'], [['small', 'small_no_friends']], out)
+        out.close()
+        assert errors == []
+
+        s.seek(0)
+        t = tarfile.open(fileobj=s, mode='r|')
+        members = dict([ (m.name, t.extractfile(m).read()) for m in t ])
+
+        # groups keep the member names of the server's tarfile
+        assert members['small'] == uuids['small']['contents']
+        assert members['small_no_friends'] == uuids['small_no_friends']['contents']
+        assert members['big/test_file.txt'] == uuids['big']['contents']
+
+    def test_hooks(self):
+        files_to_dl = ['small', 'small_no_friends']
+
+        index_client = GDCIndexClient(base_url)
+        index_client._get_metadata(files_to_dl)
+
+        client = GDCHTTPDownloadClient(
+                uri=base_url,
+                index_client=index_client,
+                **client_kwargs)
+
+        completed = dict()
+        def callback(file_id, path, size, md5sum):
+            if file_id == 'small_no_friends':
+                raise ValueError('hook failed')
+            completed[file_id] = (path, size, md5sum)
+
+        client.hooks = HookPool(callback=callback)
+        errors, count = client.download_small_groups([files_to_dl])
+        assert errors == [] and count == 2
+
+        # hook failures are reported, not download failures
+        assert client.hooks.join() == ['small_no_friends']
+        assert completed == {'small': (
+            os.path.join('.', 'small'),
+            uuids['small']['file_size'],
+            uuids['small']['md5sum'])}
+
+        for f in files_to_dl:
+            os.remove(f)
+
+    def test_preflight(self):
+        index_client = GDCIndexClient(base_url)
+        index_client._get_metadata(['small', 'small_ann', 'big'])
+
+        check = preflight.Preflight(index_client, ['.'])
+        bigs, smalls = ['big'], [['small', 'small_ann']]
+
+        # the current directory can hold a few small files
+        assert check.check(bigs, smalls) == (True, bigs, smalls, [])
+
+        free_bytes = preflight.free_bytes
+        filesystem = preflight.filesystem
+        try:
+            # both small files and the group tarfile while it's extracted
+            preflight.free_bytes = lambda d: 60
+            assert check.check(bigs, smalls)[0] == False
+            assert check.check(bigs, smalls, trim=True) == \
+                    (True, [], smalls, ['big'])
+
+            # a file left by a previous run isn't counted again
+            index_client.metadata['big']['file_name'] = 'big.txt'
+            os.mkdir('big')
+            with open(os.path.join('big', 'big.txt'), 'w') as f:
+                f.write(uuids['big']['contents'])
+            assert check.check(bigs, smalls)[0] == True
+            shutil.rmtree('big')
+
+            # each root on a filesystem of its own, the first one holds
+            # a small file, the big file and the group tarfile
+            roots = ['test_root_1', 'test_root_2']
+            preflight.filesystem = lambda d: (os.path.basename(d), 40)
+            check = preflight.Preflight(index_client, roots,
+                    placement=Placement(roots))
+            assert check.check(bigs, smalls)[0] == False
+
+            # the staging directory holds a file being moved next to the
+            # one downloading, not only the largest one
+            preflight.filesystem = lambda d: \
+                (d, 20 if d.endswith('test_staging') else 10 ** 9)
+            check = preflight.Preflight(index_client, roots,
+                    staging_directory='test_staging', migrate_workers=1)
+            assert check.check(['small'], [])[0] == True
+            assert check.check(['small', 'small_ann'], [])[0] == False
+        finally:
+            preflight.free_bytes = free_bytes
+            preflight.filesystem = filesystem
+            for r in ['test_root_1', 'test_root_2']:
+                if os.path.isdir(r):
+                    shutil.rmtree(r)
+
+    def test_endpoints(self):
+        files_to_dl = ['small', 'small_no_friends']
+
+        index_client = GDCIndexClient(base_url)
+        index_client._get_metadata(files_to_dl)
+
+        client = GDCHTTPDownloadClient(
+                uri=base_url,
+                index_client=index_client,
+                **client_kwargs)
+
+        # nothing listens on the second, much heavier, server
+        dead_url = server_host + ':5001'
+        client.endpoints = endpoints.EndpointPool(
+                endpoints.parse_servers('{0},{1}=1e9'.format(base_url, dead_url)),
+                failure_threshold=1)
+
+        healthy = client.endpoints.check_health()
+        assert [ e.base_uri for e in healthy ] == [base_url + '/']
+
+        # the open circuit keeps every group on the healthy server
+        errors, count = client.download_small_groups([files_to_dl] * 3)
+        assert errors == [] and count == 6
+
+        # until a trial request is let through, which fails over to the
+        # healthy server without retrying the dead one
+        dead = client.endpoints.endpoints[1]
+        dead.opened -= client.endpoints.reset_timeout
+        errors, count = client.download_small_groups([files_to_dl] * 3)
+        assert errors == [] and count == 6
+        assert dead.failures == 2
+
+        for f in files_to_dl:
+            os.remove(f)
+
+        # ranges, compressed and streamed files fail over the same way
+        dead.opened -= client.endpoints.reset_timeout
+        assert client.download_ranges('small_no_friends', [(0, 4)],
+                                      slices=True) == []
+        assert dead.failures == 3
+        shutil.rmtree('small_no_friends')
+
+        dead.opened -= client.endpoints.reset_timeout
+        assert client.download_compressed('small_no_friends') is None
+        assert dead.failures == 4
+        shutil.rmtree('small_no_friends')
+
+        dead.opened -= client.endpoints.reset_timeout
+        out = StringIO.StringIO()
+        assert client.stream_files(['small_no_friends'], [['small']],
+                                   TarStream(out)) == []
+        assert dead.failures == 5
+
+    def test_source_addresses(self):
+        assert netbind.resolve('127.0.0.2') == '127.0.0.2'
+        assert netbind.resolve('lo') == '127.0.0.1'
+
+        netbind.bind_source_addresses(['127.0.0.2', '127.0.0.3'])
+        try:
+            sources = []
+            for _ in range(3):
+                s = connection.create_connection(('127.0.0.1', 5000))
+                sources.append(s.getsockname()[0])
+                s.close()
+
+            assert sources == ['127.0.0.2', '127.0.0.3', '127.0.0.2']
+
+            # requests made by the clients go through the bound connections
+            index_client = GDCIndexClient(base_url)
+            index_client._get_metadata(['small'])
+            assert index_client.get_md5sum('small') == uuids['small']['md5sum']
+        finally:
+            netbind.bind_source_addresses([])
+
+    def test_proxy(self):
+        cache_dir = 'test_cache'
+        proxy = ProxyServer(('127.0.0.1', 0), base_url, cache_dir, 1024)
+        proxy_url = 'http://127.0.0.1:{0}'.format(proxy.server_address[1])
+        t = threading.Thread(target=proxy.serve_forever)
+        t.daemon = True
+        t.start()
+
+        try:
+            files_to_dl = [ proxy_uuids[f] for f in ['small', 'small_no_friends'] ]
+            small, big = proxy_uuids['small'], proxy_uuids['big']
+
+            # index queries are forwarded
+            index_client = GDCIndexClient(proxy_url)
+            index_client._get_metadata(files_to_dl + [big])
+            assert index_client.get_md5sum(small) == uuids[small]['md5sum']
+
+            # and only replayed to the token that asked
+            query = {'fields': 'file_id,md5sum', 'size': '1', 'filters':
+                json.dumps({'op': 'in', 'content': [{'op': 'in', 'content':
+                    {'field': 'files.file_id', 'value': [small]}}]})}
+            cached = []
+            for token in [None, 'other', 'other']:
+                requests.post(proxy_url + '/v0/files', json=query,
+                              headers={'X-Auth-Token': token} if token else {})
+                cached.append(len(proxy.metadata))
+            assert cached[1] == cached[0] + 1 and cached[2] == cached[1]
+
+            client = GDCHTTPDownloadClient(
+                    uri=proxy_url,
+                    index_client=index_client,
+                    **client_kwargs)
+
+            # groups are assembled from the cached files
+            errors, count = client.download_small_groups([files_to_dl])
+            assert errors == [] and count == 2
+            for f in files_to_dl:
+                path = os.path.join(f, 'test_file.txt')
+                with open(path, 'r') as g:
+                    assert g.read() == uuids[f]['contents']
+                shutil.rmtree(f)
+
+            assert os.path.isfile(os.path.join(cache_dir, small))
+            assert proxy.cache.key_locks == {}
+
+            # ranges of big files are served from the cache
+            r = client.session.get(proxy_url + '/data/' + big,
+                                   headers={'Range': 'bytes=10-19'})
+            assert r.status_code == 206
+            assert r.content == uuids[big]['contents'][10:20]
+
+            # the big file pushed the small ones out of the cache
+            assert not os.path.isfile(os.path.join(cache_dir, small))
+
+            # only UUIDs name files in the cache
+            r = client.session.post(proxy_url + '/data?tarfile',
+                                    json={'ids': ['../' + small]})
+            assert r.status_code == 400
+
+            # a file cut short isn't cached
+            try:
+                proxy.cache.put(small, StringIO.StringIO('small'), {}, size=10)
+                assert False
+            except IOError:
+                pass
+            # nor one that doesn't match the md5sum of the index
+            try:
+                proxy.cache.put(small, StringIO.StringIO('small'), {},
+                                md5sum=uuids[small]['md5sum'])
+                assert False
+            except IOError:
+                pass
+            assert os.listdir(cache_dir) == [big, big + '.json']
+        finally:
+            proxy.shutdown()
+            proxy.server_close()
+            shutil.rmtree(cache_dir)
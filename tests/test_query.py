@@ -1,5 +1,5 @@
 from conftest import md5, uuids
-from gdc_client.query.index import GDCIndexClient
+from gdc_client.query.index import GDCIndexClient, MetadataCache
 from multiprocessing import Process
 from parcel.const import HTTP_CHUNK_SIZE
 from unittest import TestCase
@@ -219,3 +219,71 @@ class QueryIndexTest(TestCase):
 
         assert bigs == ['big_no_friends']
         assert smalls == [['small_no_friends']]
+
+    ############ mock manifest metadata ############
+    def manifest_rows(self, ids):
+        return [{
+            'id':       i,
+            'filename': i + '.txt',
+            'md5':      uuids[i]['md5sum'],
+            'size':     str(uuids[i]['file_size']),
+            'state':    'submitted',
+        } for i in ids]
+
+    def test_manifest_no_query_separate_small_files(self):
+        index = GDCIndexClient(uri=base_url)
+        index.load_manifest(self.manifest_rows(['small', 'small_no_friends']))
+
+        bigs, smalls = index.separate_small_files(
+                ['small', 'small_no_friends'],
+                HTTP_CHUNK_SIZE,
+                related_files=False,
+                annotations=False)
+
+        # nothing was queried, access isn't known
+        assert index.get_access('small') == None
+        assert index.get_filesize('small') == uuids['small']['file_size']
+        assert index.get_md5sum('small') == uuids['small']['md5sum']
+        assert index.get_related_files('small') == []
+
+        assert bigs == []
+        assert len(smalls) == 1
+        assert set(smalls[0]) == set(['small', 'small_no_friends'])
+
+    def test_manifest_query_missing_separate_small_files(self):
+        index = GDCIndexClient(uri=base_url)
+        index.load_manifest(self.manifest_rows(['small', 'small_no_friends']))
+
+        bigs, smalls = index.separate_small_files(
+                ['small', 'small_no_friends'],
+                HTTP_CHUNK_SIZE)
+
+        assert index.get_access('small') == uuids['small']['access']
+        assert index.get_filesize('small') == uuids['small']['file_size']
+        assert index.get_related_files('small') == uuids['small']['related_files']
+        assert index.get_annotations('small') == uuids['small']['annotations']
+
+        assert bigs == ['small']
+        assert smalls == [['small_no_friends']]
+
+    def test_shared_metadata_cache(self):
+        cache = MetadataCache()
+        GDCIndexClient.cache = cache
+        try:
+            index = GDCIndexClient(uri=base_url)
+            index._get_metadata(['small', 'big'])
+
+            # answered from the cache, even with the server gone
+            self.server.terminate()
+            self.server.join()
+
+            other = GDCIndexClient(uri=base_url)
+            other._get_metadata(['small', 'big'])
+            assert other.get_md5sum('small') == uuids['small']['md5sum']
+            assert other.get_related_files('big') == uuids['big']['related_files']
+
+            # each client has its own copy
+            other.metadata['small']['annotations'].append('changed')
+            assert index.get_annotations('small') == uuids['small']['annotations']
+        finally:
+            GDCIndexClient.cache = None
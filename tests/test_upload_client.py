@@ -1,7 +1,23 @@
 
+from multiprocessing import Process
 from unittest import TestCase
 
-from gdc_client.upload.client import create_resume_path
+from gdc_client.upload import client as upload_client
+from gdc_client.upload.client import create_resume_path, GDCUploadClient
+from gdc_client.upload.client import reset_worker_session, worker_file, worker_session
+from gdc_client.upload.client import ENGINES, MAX_PARTS, MIN_PARTSIZE, PAGESIZE, part_size_for
+
+import hashlib
+import json
+import mock_server
+import os
+import requests
+import shutil
+import tempfile
+import time
+
+# same as --server flag for gdc-client
+base_url = 'http://127.0.0.1:5000/'
 
 class UploadClientTest(TestCase):
     def setup(self):
@@ -20,3 +36,464 @@ class UploadClientTest(TestCase):
                 'resume_file.yml']
         for i, t in enumerate(tests):
             assert create_resume_path(t) == results[i]
+
+    def test_worker_state(self):
+        # a worker keeps its session and file handle between parts
+        session = worker_session()
+        assert worker_session() is session
+
+        reset_worker_session()
+        assert worker_session() is not session
+
+        fd, name = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            f = worker_file(name)
+            assert worker_file(name) is f
+
+            other = worker_file(__file__)
+            assert f.closed and other.name == __file__
+            other.close()
+        finally:
+            os.remove(name)
+
+
+class UploadTest(TestCase):
+    def setUp(self):
+        self.server = Process(target=mock_server.app.run)
+        self.server.start()
+
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+
+        # give the server time to start
+        time.sleep(0.5)
+
+    def tearDown(self):
+        self.server.terminate()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_upload_files_concurrently(self):
+        # a simple upload and two multipart uploads share the workers
+        contents = {
+            'small': os.urandom(1000),
+            'big1': os.urandom(12 * 1024 * 1024),
+            'big2': os.urandom(6 * 1024 * 1024),
+        }
+        for name, content in contents.items():
+            with open(name, 'wb') as f:
+                f.write(content)
+
+        for engine in ENGINES:
+            files = [ {'id': name, 'project_id': 'TCGA-TEST',
+                       'local_file_path': name} for name in sorted(contents) ]
+
+            client = GDCUploadClient(
+                token='token', processes=3, server=base_url,
+                part_size=5 * 1024 * 1024, files=files,
+                manifest_name='manifest.yml', engine=engine)
+            client.upload()
+
+            assert all([ f.done for f in client.file_entities ])
+            assert not os.path.exists('resume_manifest.yml')
+
+            for name, content in contents.items():
+                r = requests.get(base_url +
+                        'v0/submission/TCGA/TEST/files/{0}'.format(name))
+                assert r.content == content
+
+    def test_files_in_flight(self):
+        # only a window of files has open handles and hashing threads
+        names = [ 'file{0}'.format(i) for i in range(6) ]
+        for name in names:
+            with open(name, 'wb') as f:
+                f.write(os.urandom(6 * 1024 * 1024))
+
+        client = GDCUploadClient(
+            token='token', processes=2, server=base_url,
+            part_size=5 * 1024 * 1024, files=[
+                {'id': name, 'project_id': 'TCGA-TEST', 'local_file_path': name}
+                for name in names ],
+            manifest_name='manifest.yml', engine=upload_client.THREADS,
+            files_in_flight=2)
+
+        peak = []
+        schedule = client.schedule
+        def counted_schedule(index, tasks):
+            peak.append(len(client.open_files))
+            schedule(index, tasks)
+        client.schedule = counted_schedule
+
+        assert client.upload() == []
+        assert max(peak) <= 2
+        assert client.open_files == {} and client.in_flight == set()
+        assert not any([ f.hasher.thread.is_alive()
+                         for f in client.file_entities ])
+
+    def test_dead_worker(self):
+        MiB = 1024 * 1024
+        content = os.urandom(3 * 5 * MiB)
+        with open('killed', 'wb') as f:
+            f.write(content)
+
+        # the worker uploading the second part dies, as many times as the
+        # file 'deaths' says
+        upload_multipart = upload_client.upload_multipart
+        def dying(filename, offset, bytes, url, upload_id, part_number,
+                  *args, **kwargs):
+            with open('deaths') as f:
+                deaths = int(f.read())
+            if part_number == 2 and deaths:
+                with open('deaths', 'w') as f:
+                    f.write(str(deaths - 1))
+                os._exit(1)
+            return upload_multipart(filename, offset, bytes, url, upload_id,
+                                    part_number, *args, **kwargs)
+        # pickled by name, as the function it replaces
+        dying.__name__ = upload_multipart.__name__
+        dying.__module__ = upload_multipart.__module__
+
+        def upload(deaths):
+            with open('deaths', 'w') as f:
+                f.write(str(deaths))
+            client = GDCUploadClient(
+                token='token', processes=2, server=base_url,
+                part_size=5 * MiB, files=[
+                    {'id': 'killed', 'project_id': 'TCGA-TEST',
+                     'local_file_path': 'killed'}],
+                manifest_name='manifest.yml', engine='processes')
+            return client.upload()
+
+        upload_client.upload_multipart = dying
+        try:
+            # the part is uploaded again, or the file fails, without hanging
+            assert upload(1) == []
+            assert requests.get(base_url +
+                'v0/submission/TCGA/TEST/files/killed').content == content
+            assert upload(2) == ['killed']
+        finally:
+            upload_client.upload_multipart = upload_multipart
+
+    def test_prefetch_metadata(self):
+        ids = [ 'file{0}'.format(i) for i in range(5) ]
+        for i in ids:
+            open('{0}.bam'.format(i), 'w').close()
+
+        client = GDCUploadClient(
+            token='token', processes=1, server=base_url,
+            part_size=5 * 1024 * 1024, files=[ {'id': i} for i in ids ],
+            manifest_name='manifest.yml')
+
+        queries = []
+        post = requests.post
+        def counted_post(*args, **kwargs):
+            queries.append(kwargs.get('data'))
+            return post(*args, **kwargs)
+
+        requests.post = counted_post
+        try:
+            client.get_files()
+        finally:
+            requests.post = post
+
+        # the types, then the files of every type
+        assert len(queries) == 2
+        assert [ f.file_path for f in client.file_entities ] == \
+               [ '{0}.bam'.format(i) for i in ids ]
+        assert [ f.url.split('/')[-4:-2] for f in client.file_entities ] == \
+               [ ['TCGA', 'TEST'] for _ in ids ]
+
+        # unknown ids are left to get_metadata to report
+        client.prefetch_metadata(['missing'])
+        assert 'missing' not in client._metadata
+
+    def test_preflight(self):
+        for name in ['good1', 'good2', 'short']:
+            with open(name, 'wb') as f:
+                f.write('content')
+
+        files = [
+            {'id': 'good1', 'project_id': 'TCGA-TEST', 'local_file_path': 'good1'},
+            {'id': 'good2', 'project_id': 'TCGA-TEST', 'local_file_path': 'good2',
+             'file_size': 7},
+            {'id': 'short', 'project_id': 'TCGA-TEST', 'local_file_path': 'short',
+             'file_size': 100},
+            {'id': 'absent', 'project_id': 'TCGA-TEST', 'local_file_path': 'absent'},
+            {'project_id': 'TCGA-TEST', 'local_file_path': 'good1'},
+        ]
+
+        client = GDCUploadClient(
+            token='token', processes=1, server=base_url,
+            part_size=5 * 1024 * 1024, files=files,
+            manifest_name='manifest.yml')
+
+        # every problem is found, the other files can still be uploaded
+        assert client.get_files() is False
+        assert [ (f.node_id, f.file_size) for f in client.file_entities ] == \
+               [ ('good1', 7), ('good2', 7) ]
+
+    def test_part_size_for(self):
+        MiB = 1024 * 1024
+
+        # a few parts for each worker, but no smaller than S3 allows
+        assert part_size_for(900 * MiB, 8) == 900 * MiB / 32
+        assert part_size_for(12 * MiB, 8) == MIN_PARTSIZE
+
+        # no more than MAX_PARTS, whatever the part size asked for
+        huge = 100 * 1024 * 1024 * MiB
+        assert part_size_for(huge, 8) * MAX_PARTS >= huge
+        assert part_size_for(huge, 8, 10 * MiB) * MAX_PARTS >= huge
+        assert part_size_for(100 * MiB, 8, 10 * MiB) == 10 * MiB
+
+        # parts are mmap'd, so they start on page boundaries
+        assert part_size_for(12345678, 3) % PAGESIZE == 0
+
+    def test_resume_many_parts(self):
+        MiB = 1024 * 1024
+        content = os.urandom(4 * 5 * MiB + 1000)
+        with open('paged', 'wb') as f:
+            f.write(content)
+
+        # the first three parts were uploaded by a previous run
+        url = base_url + 'v0/submission/TCGA/TEST/files/paged'
+        upload_id = requests.post(url + '?uploads').text.split('<UploadId>')[1] \
+                                                        .split('<')[0]
+        for n in [1, 2, 3]:
+            requests.put(url + '?uploadId={0}&partNumber={1}'.format(upload_id, n),
+                         data='x' * 5 * MiB)
+
+        files = [{'id': 'paged', 'project_id': 'TCGA-TEST',
+                  'local_file_path': 'paged', 'upload_id': upload_id,
+                  'part_size': 5 * MiB}]
+        client = GDCUploadClient(
+            token='token', processes=2, server=base_url,
+            part_size=5 * MiB, files=files,
+            manifest_name='manifest.yml', engine='threads')
+
+        page_size = upload_client.LIST_PARTS_PAGE_SIZE
+        upload_client.LIST_PARTS_PAGE_SIZE = 2
+        try:
+            client.upload()
+        finally:
+            upload_client.LIST_PARTS_PAGE_SIZE = page_size
+
+        # the listed parts were found on every page and not uploaded again
+        assert client.file_entities[0].done
+        assert requests.get(url).content == 'x' * 15 * MiB + content[15 * MiB:]
+
+    def test_resume_part_size(self):
+        MiB = 1024 * 1024
+        content = os.urandom(3 * 5 * MiB + 1000)
+        with open('sized', 'wb') as f:
+            f.write(content)
+
+        # started in parts of 5 MiB, resumed with only the upload id
+        url = base_url + 'v0/submission/TCGA/TEST/files/sized'
+        upload_id = requests.post(url + '?uploads').text.split('<UploadId>')[1] \
+                                                        .split('<')[0]
+        for n in [1, 2]:
+            requests.put(url + '?uploadId={0}&partNumber={1}'.format(upload_id, n),
+                         data=content[(n - 1) * 5 * MiB:n * 5 * MiB])
+
+        files = [{'id': 'sized', 'project_id': 'TCGA-TEST',
+                  'local_file_path': 'sized', 'upload_id': upload_id}]
+        client = GDCUploadClient(
+            token='token', processes=2, server=base_url,
+            part_size=6 * MiB, files=files,
+            manifest_name='manifest.yml', engine='threads')
+        client.upload()
+
+        assert client.file_entities[0].part_size == 5 * MiB
+        assert requests.get(url).content == content
+
+    def test_resume_unknown_part_size(self):
+        MiB = 1024 * 1024
+        content = os.urandom(11 * MiB)
+        with open('unsized', 'wb') as f:
+            f.write(content)
+
+        # 1 MiB for part 3 is the end of the file in parts of 5 MiB, or a
+        # whole part of 1 MiB, so it isn't resumed
+        url = base_url + 'v0/submission/TCGA/TEST/files/unsized'
+        upload_id = requests.post(url + '?uploads').text.split('<UploadId>')[1] \
+                                                        .split('<')[0]
+        requests.put(url + '?uploadId={0}&partNumber=3'.format(upload_id),
+                     data=content[10 * MiB:])
+
+        files = [{'id': 'unsized', 'project_id': 'TCGA-TEST',
+                  'local_file_path': 'unsized', 'upload_id': upload_id}]
+        client = GDCUploadClient(
+            token='token', processes=2, server=base_url,
+            part_size=5 * MiB, files=files,
+            manifest_name='manifest.yml', engine='threads')
+
+        assert client.upload() == ['unsized']
+        assert 'part size' in str(client.file_entities[0].error)
+        assert requests.get(url).status_code == 404
+
+    def test_list_parts_failures(self):
+        MiB = 1024 * 1024
+        content = os.urandom(3 * 5 * MiB)
+        with open('listed', 'wb') as f:
+            f.write(content)
+
+        url = base_url + 'v0/submission/TCGA/TEST/files/listed'
+        upload_id = requests.post(url + '?uploads').text.split('<UploadId>')[1] \
+                                                        .split('<')[0]
+        requests.put(url + '?uploadId={0}&partNumber=1'.format(upload_id),
+                     data=content[:5 * MiB])
+
+        class Failed(object):
+            text = 'failed'
+            def __init__(self, status_code):
+                self.status_code = status_code
+            def close(self):
+                pass
+
+        def upload(failures):
+            files = [{'id': 'listed', 'project_id': 'TCGA-TEST',
+                      'local_file_path': 'listed', 'upload_id': upload_id,
+                      'part_size': 5 * MiB}]
+            client = GDCUploadClient(
+                token='token', processes=2, server=base_url,
+                part_size=5 * MiB, files=files,
+                manifest_name='manifest.yml', engine='threads')
+
+            get, posts = requests.get, []
+            def failing_get(url, *args, **kwargs):
+                if 'uploadId' in url and failures:
+                    return Failed(failures.pop(0))
+                return get(url, *args, **kwargs)
+            post = requests.post
+            def counted_post(url, *args, **kwargs):
+                posts.append(url)
+                return post(url, *args, **kwargs)
+
+            sleep = upload_client.get_sleep_time
+            requests.get, requests.post = failing_get, counted_post
+            upload_client.get_sleep_time = lambda tries: 0
+            try:
+                return client, client.upload(), posts
+            finally:
+                requests.get, requests.post = get, post
+                upload_client.get_sleep_time = sleep
+                if os.path.exists('resume_manifest.yml'):
+                    os.remove('resume_manifest.yml')
+
+        # any other failure is reported, and the upload isn't started over
+        client, failed, posts = upload([403])
+        assert failed == ['listed'] and str(client.file_entities[0].error) == 'failed'
+        assert not [ p for p in posts if p.endswith('?uploads') ]
+
+        # the upload is resumed once the server is back
+        client, failed, posts = upload([503, 500, 503])
+        assert failed == [] and not [ p for p in posts if p.endswith('?uploads') ]
+        assert requests.get(url).content == content
+
+    def test_complete_missing_parts(self):
+        url = base_url + 'v0/submission/TCGA/TEST/files/short'
+        upload_id = requests.post(url + '?uploads').text.split('<UploadId>')[1] \
+                                                        .split('<')[0]
+        for n in [1, 2]:
+            requests.put(url + '?uploadId={0}&partNumber={1}'.format(upload_id, n),
+                         data='x')
+
+        client = GDCUploadClient(
+            token='token', processes=1, server=base_url,
+            part_size=5 * 1024 * 1024, files=[],
+            manifest_name='manifest.yml')
+        f = upload_client.FileEntity()
+        f.node_id, f.url, f.upload_id, f.part_count = \
+            'short', url, upload_id, 3
+        f.multiparts = upload_client.Multiparts()
+
+        # a part the server doesn't list isn't left out of the object
+        self.assertRaises(Exception, client.complete, f)
+        assert requests.get(url).status_code == 404
+
+    def test_resume_from_journal(self):
+        MiB = 1024 * 1024
+        content = os.urandom(4 * 5 * MiB)
+        with open('killed', 'wb') as f:
+            f.write(content)
+
+        # a previous run was killed after uploading three parts, the third
+        # of which was since replaced on the server
+        url = base_url + 'v0/submission/TCGA/TEST/files/killed'
+        upload_id = requests.post(url + '?uploads').text.split('<UploadId>')[1] \
+                                                        .split('<')[0]
+        journal = [{'id': 'killed', 'upload_id': upload_id,
+                    'part_size': 5 * MiB, 'file_size': len(content)}]
+        for n in [1, 2, 3]:
+            data = 'x' * 5 * MiB
+            requests.put(url + '?uploadId={0}&partNumber={1}'.format(upload_id, n),
+                         data=data)
+            md5sum = hashlib.md5(data if n < 3 else 'y').hexdigest()
+            journal.append({'id': 'killed', 'upload_id': upload_id, 'part': n,
+                            'etag': '"{0}"'.format(md5sum), 'size': len(data),
+                            'md5': md5sum})
+
+        with open('resume_manifest.yml.journal', 'w') as f:
+            f.write(''.join([ json.dumps(e) + '\n' for e in journal ]))
+            # cut short by the kill
+            f.write('{"id": "killed", "upl')
+
+        files = [{'id': 'killed', 'project_id': 'TCGA-TEST',
+                  'local_file_path': 'killed'}]
+        client = GDCUploadClient(
+            token='token', processes=2, server=base_url,
+            part_size=5 * MiB, files=files,
+            manifest_name='manifest.yml', engine='threads')
+
+        upload_client.raw_input = lambda prompt: 'y'
+        try:
+            client.upload()
+        finally:
+            del upload_client.raw_input
+
+        assert client.file_entities[0].done
+        assert requests.get(url).content == 'x' * 10 * MiB + content[10 * MiB:]
+        assert not os.path.exists('resume_manifest.yml.journal')
+
+    def test_md5sum(self):
+        MiB = 1024 * 1024
+        contents = {
+            'small': os.urandom(1000),
+            'big': os.urandom(12 * MiB),
+            'changed': os.urandom(12 * MiB),
+            'small_changed': os.urandom(1000),
+        }
+        for name, content in contents.items():
+            with open(name, 'wb') as f:
+                f.write(content)
+
+        # the file changed since its manifest was made
+        md5sums = dict([ (name, hashlib.md5(content).hexdigest())
+                         for name, content in contents.items() ])
+        md5sums['changed'] = hashlib.md5('before').hexdigest()
+        md5sums['small_changed'] = hashlib.md5('before').hexdigest()
+
+        files = [ {'id': name, 'project_id': 'TCGA-TEST',
+                   'local_file_path': name, 'md5sum': md5sums[name]}
+                  for name in sorted(contents) ]
+
+        client = GDCUploadClient(
+            token='token', processes=3, server=base_url,
+            part_size=5 * MiB, files=files,
+            manifest_name='manifest.yml', engine='threads')
+        client.upload()
+
+        done = dict([ (f.node_id, f.done) for f in client.file_entities ])
+        assert done == {'small': True, 'big': True, 'changed': False,
+                        'small_changed': False}
+
+        # the upload of the changed file isn't completed, and the server
+        # refuses the changed file sent whole
+        url = base_url + 'v0/submission/TCGA/TEST/files/{0}'
+        assert requests.get(url.format('big')).content == contents['big']
+        assert requests.get(url.format('small')).content == contents['small']
+        assert requests.get(url.format('changed')).status_code == 404
+        assert requests.get(url.format('small_changed')).status_code == 404
+        assert os.path.exists('resume_manifest.yml')